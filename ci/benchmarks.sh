@@ -0,0 +1,43 @@
+#!/bin/sh
+
+# Compare the benchmarks (see src/sa_api/benchmarks.py) of this revision with
+# those of the branch that it would be merged into, and fail if any of them
+# got more than BENCHMARK_TOLERANCE (default 0.25, i.e. 25%) slower.
+#
+# The baseline is recorded here, on the same machine, right before the
+# comparison: timings from any other machine wouldn't be comparable.  The
+# benchmarks roll back the data that they generate, so the database is left
+# as it was.
+#
+#   ci/benchmarks.sh [<base revision>]
+
+set -e
+
+BASE=${1:-${TRAVIS_BRANCH:-master}}
+TOLERANCE=${BENCHMARK_TOLERANCE:-0.25}
+ROOT=$(pwd)
+WORK=$(mktemp -d)
+trap 'rm -rf "$WORK"' EXIT
+
+git fetch origin "$BASE" || true
+BASE_REVISION=$(git merge-base HEAD FETCH_HEAD 2>/dev/null || git rev-parse "$BASE")
+
+git archive "$BASE_REVISION" | tar -x -C "$WORK"
+cp src/project/local_settings.py "$WORK/src/project/local_settings.py"
+
+if [ ! -f "$WORK/src/sa_api/management/commands/run_benchmarks.py" ]; then
+    echo "$BASE_REVISION has no benchmarks to compare with."
+    exit 0
+fi
+
+# Each tree's code runs against its own schema; South only migrates forward,
+# so the base runs first.
+cd "$WORK"
+python src/manage.py syncdb --noinput
+python src/manage.py migrate --noinput
+python src/manage.py run_benchmarks --save "$WORK/baseline.json"
+
+cd "$ROOT"
+python src/manage.py syncdb --noinput
+python src/manage.py migrate --noinput
+python src/manage.py run_benchmarks --compare "$WORK/baseline.json" --tolerance "$TOLERANCE"
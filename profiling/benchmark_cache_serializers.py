@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Compare the serializers for the values that the API caches for itself (see
+sa_api.cache_serializers) on encoding time, decoding time and size, and
+check that each one gives back the values it was given.
+
+The values are generated in the shapes of the per-dataset submission set and
+attachment maps, and of a set of cached response keys:
+
+    ./benchmark_cache_serializers.py [<number of places>]
+"""
+
+import os
+import sys
+import datetime
+import random
+import time
+from collections import defaultdict
+
+root = os.path.join(os.path.dirname(__file__), '..')
+sys.path[:0] = [os.path.join(root, 'src'),
+                os.path.join(root, 'libs', 'django-rest-framework-0.4')]
+
+from django.conf import settings
+settings.configure(USE_TZ=True)
+
+from django.utils.timezone import utc
+from sa_api import cache_serializers
+
+
+def generate_submission_sets(count):
+  submission_sets = defaultdict(list)
+  for place_id in xrange(1, count + 1):
+    for set_name in random.sample(['comments', 'support', 'surveys'], random.randint(0, 3)):
+      submission_sets[place_id].append({
+        'type': set_name,
+        'length': random.randint(1, 50),
+        'url': '/api/v2/openplans/datasets/chicagobikes/places/%s/%s' % (place_id, set_name),
+      })
+  return submission_sets
+
+
+def generate_attachments(count):
+  start = datetime.datetime(2013, 4, 1, tzinfo=utc)
+  attachments = defaultdict(list)
+  for place_id in random.sample(xrange(1, count + 1), count / 4):
+    created = start + datetime.timedelta(seconds=random.randint(0, 10 ** 7))
+    attachments[place_id].append({
+      'name': 'photo',
+      'url': 'https://shareabouts.s3.amazonaws.com/attachments/%s-photo.jpg' % place_id,
+      'created_datetime': created,
+      'updated_datetime': created,
+    })
+  return attachments
+
+
+def generate_keys(count):
+  prefix = '/api/v2/openplans/datasets/chicagobikes/places'
+  keys = set()
+  for place_id in random.sample(xrange(1, count + 1), count / 10):
+    keys.add('%s/%s:json:' % (prefix, place_id))
+  for page in xrange(1, count / 100 + 1):
+    for format in ['json', 'csv']:
+      keys.add('%s:%s:page=%s' % (prefix, format, page))
+  return keys
+
+
+def best_time(func, repeat=5):
+  times = []
+  for _ in range(repeat):
+    start = time.time()
+    func()
+    times.append(time.time() - start)
+  return min(times)
+
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  values = [
+    ('submission sets', generate_submission_sets(count)),
+    ('attachments', generate_attachments(count)),
+    ('response keys', generate_keys(count)),
+  ]
+
+  serializers = [
+    ('pickle', cache_serializers.PickleSerializer()),
+    ('compact', cache_serializers.CompactSerializer()),
+  ]
+  if cache_serializers.msgpack is not None:
+    serializers.append(('msgpack', cache_serializers.MsgpackSerializer()))
+
+  print 'Values for %s places.' % count
+  for value_name, value in values:
+    print
+    print value_name
+    for serializer_name, serializer in serializers:
+      data = serializer.dumps(value)
+      if serializer.loads(data) != value:
+        print 'ERROR: the %s serializer changed the %s.' % (serializer_name, value_name)
+        return 1
+
+      dumps_time = best_time(lambda: serializer.dumps(value))
+      loads_time = best_time(lambda: serializer.loads(data))
+      print '  %-8s %9s bytes  dumps %0.4fs  loads %0.4fs' % (
+        serializer_name, len(data), dumps_time, loads_time)
+
+if __name__ == '__main__':
+  sys.exit(main())
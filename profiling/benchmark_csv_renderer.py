@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Compare the speed of the CSV renderer against the renderer that it replaced,
+and check that both produce the same output.
+
+Run with the URL of a /table endpoint to render the data from a running
+server (the data is fetched as JSON, which is exactly what the CSV renderer
+gets as input):
+
+    ./benchmark_csv_renderer.py http://localhost:8000/api/v1/user1/datasets/dataset1/places/table
+
+or with no URL to render a generated set of rows shaped like those from the
+places /table endpoint:
+
+    ./benchmark_csv_renderer.py
+"""
+
+import os
+import sys
+import csv
+import json
+import random
+import time
+from StringIO import StringIO
+
+root = os.path.join(os.path.dirname(__file__), '..')
+sys.path[:0] = [os.path.join(root, 'src'),
+                os.path.join(root, 'libs', 'django-rest-framework-0.4')]
+
+from django.conf import settings
+settings.configure()
+
+from sa_api.renderers import CSVRendererWithUnderscores
+
+
+class LegacyCSVRenderer (object):
+  """
+  The renderer that flattened every item recursively before writing any rows.
+  """
+  level_sep = '_'
+
+  def render(self, data):
+    table = self.tablize(data)
+    csv_buffer = StringIO()
+    csv_writer = csv.writer(csv_buffer)
+    for row in table:
+      csv_writer.writerow([
+        elem.encode('utf-8') if isinstance(elem, basestring) else elem
+        for elem in row
+      ])
+    return csv_buffer.getvalue()
+
+  def tablize(self, data):
+    if not data:
+      return []
+    data = [self.flatten_item(item) for item in data]
+    headers = set()
+    for item in data:
+      headers.update(item.keys())
+    headers = sorted(headers)
+    return [headers] + [[item.get(key, None) for key in headers] for item in data]
+
+  def flatten_item(self, item):
+    if isinstance(item, list):
+      pairs = [(str(index), value) for index, value in enumerate(item)]
+    elif isinstance(item, dict):
+      pairs = [(str(key), value) for key, value in item.iteritems()]
+    else:
+      return {'': item}
+
+    flat_item = {}
+    for prefix, value in pairs:
+      for header, val in self.flatten_item(value).iteritems():
+        flat_item[self.level_sep.join([prefix, header]) if header else prefix] = val
+    return flat_item
+
+
+def generate_rows(count):
+  attributes = ['name', 'description', 'category', 'address', 'neighborhood']
+  rows = []
+  for index in xrange(count):
+    row = {
+      'place_id': index,
+      'place_location': {'lat': random.uniform(39, 40), 'lng': random.uniform(-76, -75)},
+      'place_submitter_name': u'Submitter %s' % index,
+      'place_created_datetime': '2013-04-01T12:00:00.000Z',
+      'place_visible': True,
+      'attachments': [{'name': 'photo', 'url': '/photo.jpg'}] * random.randint(0, 2),
+      'comments': random.randint(0, 20),
+      'supports': random.randint(0, 50),
+    }
+    for attr in random.sample(attributes, random.randint(2, len(attributes))):
+      row[attr] = u'Some text for the %s — %s' % (attr, index)
+    rows.append(row)
+  return rows
+
+
+def fetch_rows(url):
+  import requests
+  response = requests.get(url, params={'format': 'json'})
+  response.raise_for_status()
+  return json.loads(response.text)
+
+
+def best_time(func, repeat=5):
+  times = []
+  for _ in range(repeat):
+    start = time.time()
+    func()
+    times.append(time.time() - start)
+  return min(times)
+
+
+def main():
+  if len(sys.argv) > 1:
+    rows = fetch_rows(sys.argv[1])
+  else:
+    rows = generate_rows(10000)
+
+  legacy = lambda: LegacyCSVRenderer().render(rows)
+  planned = lambda: CSVRendererWithUnderscores(None).render(rows)
+
+  if legacy() != planned():
+    print 'ERROR: the renderers produced different output.'
+    return 1
+
+  legacy_time = best_time(legacy)
+  planned_time = best_time(planned)
+
+  print 'Rendered %s rows.' % len(rows)
+  print 'legacy renderer:  %0.3fs' % legacy_time
+  print 'planned renderer: %0.3fs (%0.1fx)' % (planned_time, legacy_time / planned_time)
+
+if __name__ == '__main__':
+  sys.exit(main())
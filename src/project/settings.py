@@ -93,11 +93,15 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'sa_api.middleware.RequestInstrumentation',
+    'sa_api.middleware.RepeatedQueryDetector',
+    'sa_api.middleware.RequestCapture',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'sa_api.middleware.RequestProfiler',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
@@ -159,6 +163,84 @@ INSTALLED_APPS = (
 # large.
 API_CACHE_TIMEOUT = 604800  # a week
 
+# Cached API responses at least this many bytes long are stored compressed,
+# and are served compressed to clients that accept it.
+API_CACHE_COMPRESS_MIN_SIZE = 1024
+
+# Only one worker at a time rebuilds an invalidated API response.  While it
+# does, other workers serve the previously cached response if it was built
+# no more than API_CACHE_MAX_STALENESS seconds ago (0 to never serve stale
+# responses), or else wait up to API_CACHE_LOCK_WAIT seconds for the new
+# one.  A worker can hold on to a rebuild for API_CACHE_LOCK_TIMEOUT seconds
+# at most.
+API_CACHE_MAX_STALENESS = 300
+API_CACHE_LOCK_WAIT = 5
+API_CACHE_LOCK_TIMEOUT = 30
+
+# When an API response is invalidated, re-render it in the background if it
+# is one of the API_CACHE_WARM_COUNT most requested of the responses cleared
+# along with it.  Set to 0 to turn off background warming (and the counting
+# of requests per response that it needs).
+API_CACHE_WARM_COUNT = 0
+
+# Small, frequently read cache values (instance parameters, attachment and
+# submission set maps) are also kept in each process, in a least-recently-
+# used set of up to API_LOCAL_CACHE_SIZE values, for at most
+# API_LOCAL_CACHE_TIMEOUT seconds.  Deletions are broadcast to the other
+# processes with API_LOCAL_CACHE_BROADCAST.  A size of 0 turns the local
+# cache off; it is turned on along with the Redis cache below.
+API_LOCAL_CACHE_SIZE = 0
+API_LOCAL_CACHE_TIMEOUT = 60
+API_LOCAL_CACHE_BROADCAST = 'sa_api.localcache.LocalBroadcast'
+
+# Set API_HOST_CACHE_DIR to a directory on local disk (or tmpfs) to keep a
+# copy of each cached API response there, shared by all of the workers on a
+# host, in at most API_HOST_CACHE_MAX_SIZE bytes.
+API_HOST_CACHE_DIR = None
+API_HOST_CACHE_MAX_SIZE = 512 * 1024 * 1024  # 512 MB
+
+# How the values that the API caches for itself (the attachment and
+# submission set maps, instance parameters, and the sets of cached response
+# keys) are serialized. sa_api.cache_serializers.CompactSerializer makes
+# them smaller; see profiling/benchmark_cache_serializers.py.
+API_CACHE_SERIALIZER = 'sa_api.cache_serializers.PickleSerializer'
+
+# How many places or submissions to read from the database at a time when
+# streaming a dataset export.
+API_EXPORT_CHUNK_SIZE = 500
+
+# The upper bounds (in seconds) of the buckets of the per-view request time
+# histograms (see sa_api.instrumentation and the request_stats command).
+API_REQUEST_TIMING_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# A token that lets a metrics scraper (e.g., Prometheus) read the metrics
+# endpoint by sending it as "Authorization: Bearer <token>".  Superusers can
+# always read it.
+API_METRICS_TOKEN = None
+
+# Log the queries that a request makes more than this many times with only
+# different literals, with the stack that made them (see
+# sa_api.middleware.RepeatedQueryDetector).  For development and staging;
+# None turns the detector off.
+API_REPEATED_QUERY_THRESHOLD = None
+
+# How many requests a minute, across all server processes, superusers can
+# get cProfile profiles of with ?_profile= (see sa_api.profiler).  0 turns
+# request profiling off.
+API_PROFILE_RATE_LIMIT = 10
+
+# A file to append a trace of each request to, as a JSON line: a tree of
+# timed spans for its phases (see sa_api.instrumentation).  Only requests
+# that take at least API_TRACE_MIN_DURATION seconds are written.
+API_TRACE_FILE = None
+API_TRACE_MIN_DURATION = 0
+
+# A file to record a sample of the API requests to (the share of them given
+# by API_CAPTURE_SAMPLE_RATE), for the replay_requests command to replay.
+# Private fields and keys are redacted.
+API_CAPTURE_FILE = None
+API_CAPTURE_SAMPLE_RATE = 1.0
+
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 SOUTH_TESTS_MIGRATE = False
 
@@ -283,6 +365,10 @@ if 'REDIS_URL' in environ:
 
     SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 
+    API_LOCAL_CACHE_SIZE = 10000
+    API_LOCAL_CACHE_BROADCAST = 'sa_api.localcache.RedisBroadcast'
+    API_LOCAL_CACHE_REDIS_URL = environ['REDIS_URL']
+
 if all([key in environ for key in ('SHAREABOUTS_AWS_KEY',
                                    'SHAREABOUTS_AWS_SECRET',
                                    'SHAREABOUTS_AWS_BUCKET')]):
@@ -302,6 +388,36 @@ if 'SHAREABOUTS_ADMIN_EMAIL' in environ:
         ('Shareabouts API Admin', environ.get('SHAREABOUTS_ADMIN_EMAIL')),
     )
 
+if 'API_CACHE_WARM_COUNT' in environ:
+    API_CACHE_WARM_COUNT = int(environ['API_CACHE_WARM_COUNT'])
+
+if 'API_HOST_CACHE_DIR' in environ:
+    API_HOST_CACHE_DIR = environ['API_HOST_CACHE_DIR']
+
+if 'API_CACHE_SERIALIZER' in environ:
+    API_CACHE_SERIALIZER = environ['API_CACHE_SERIALIZER']
+
+if 'API_METRICS_TOKEN' in environ:
+    API_METRICS_TOKEN = environ['API_METRICS_TOKEN']
+
+if 'API_REPEATED_QUERY_THRESHOLD' in environ:
+    API_REPEATED_QUERY_THRESHOLD = int(environ['API_REPEATED_QUERY_THRESHOLD'])
+
+if 'API_PROFILE_RATE_LIMIT' in environ:
+    API_PROFILE_RATE_LIMIT = int(environ['API_PROFILE_RATE_LIMIT'])
+
+if 'API_TRACE_FILE' in environ:
+    API_TRACE_FILE = environ['API_TRACE_FILE']
+
+if 'API_TRACE_MIN_DURATION' in environ:
+    API_TRACE_MIN_DURATION = float(environ['API_TRACE_MIN_DURATION'])
+
+if 'API_CAPTURE_FILE' in environ:
+    API_CAPTURE_FILE = environ['API_CAPTURE_FILE']
+
+if 'API_CAPTURE_SAMPLE_RATE' in environ:
+    API_CAPTURE_SAMPLE_RATE = float(environ['API_CAPTURE_SAMPLE_RATE'])
+
 if 'CONSOLE_LOG_LEVEL' in environ:
     LOGGING['handlers']['console']['level'] = environ.get('CONSOLE_LOG_LEVEL')
 
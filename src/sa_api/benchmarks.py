@@ -0,0 +1,259 @@
+"""
+Microbenchmarks of the API's hot paths: serializing places, rendering place
+collections (as JSON and CSV), making URLs absolute, invalidating the cache
+for each kind of instance, serving a response from the cache, and
+authenticating with an API key (see the run_benchmarks command).
+
+The benchmarks run against a synthetic dataset (see sa_api.synthetic) of a
+given size, in the configured database and cache -- locmem, unless a Redis
+URL is set.  The run_benchmarks command generates the dataset in a
+transaction that it always rolls back, and clears the dataset's responses
+from the cache afterwards, so nothing is left behind even if a run fails.
+
+Each benchmark is timed a number of times, with any preparation (like
+putting responses into the cache to be invalidated) done outside of the
+timing.  Results can be saved as a baseline, and later results compared
+with it, to catch regressions before they are deployed (see
+ci/benchmarks.sh).
+"""
+import copy
+import json
+import time
+from django.contrib.auth.models import AnonymousUser
+from django.core.urlresolvers import reverse
+from django.test.client import RequestFactory
+from . import cache as sa_cache
+from . import renderers
+from . import resources
+from . import synthetic
+from . import views
+from .apikey.auth import APIKeyBackend
+from .models import DataSet, Place, SubmissionSet, Submission, Attachment, Activity
+
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """
+    Register a benchmark.  The decorated function is called with the context
+    (see Context), and returns the function to time, or a pair of a function
+    to call before each timing, and the function to time.
+    """
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+class Context (object):
+    """
+    The synthetic dataset that the benchmarks run against, and helpers for
+    making requests for it.
+    """
+    owner = 'benchmark'
+
+    def __init__(self, places, submissions):
+        self.places_count = places
+        self.submissions_count = submissions
+        self.slug = 'benchmark-%s-%s' % (places, submissions)
+
+        try:
+            self.dataset = DataSet.objects.get(owner__username=self.owner, slug=self.slug)
+        except DataSet.DoesNotExist:
+            generator = synthetic.DataSetGenerator(places=places, submissions=submissions, seed=1)
+            self.dataset = generator.generate(self.owner, self.slug)
+
+        self.api_key = self.dataset.api_keys.all()[0].key
+        self.places = list(Place.objects.filter(dataset=self.dataset).select_related())
+        self.place_data = [resources.PlaceResource().serialize(place) for place in self.places]
+
+    @property
+    def scale(self):
+        return {'places': self.places_count, 'submissions': self.submissions_count}
+
+    def get_path(self, url_name):
+        return reverse(url_name, args=[self.owner, self.slug])
+
+    def get_kwargs(self, url_name):
+        if url_name.startswith('dataset_'):
+            return {'owner__username': self.owner, 'slug': self.slug}
+        if url_name.startswith('activity_'):
+            return {'data__dataset__owner__username': self.owner, 'data__dataset__slug': self.slug}
+        return {'dataset__owner__username': self.owner, 'dataset__slug': self.slug}
+
+    def get(self, view_class, url_name, **extra):
+        request = RequestFactory().get(self.get_path(url_name), **extra)
+        request.user = AnonymousUser()
+        response = view_class.as_view()(request, **self.get_kwargs(url_name))
+        # Read the whole response, in case it's streamed.
+        for chunk in response:
+            pass
+        return response
+
+    def clear_responses(self, url_name):
+        path = self.get_path(url_name)
+        cache = sa_cache.Cache()
+        cache.clear_keys(*cache.get_keys_with_prefixes(path))
+
+    def cache_responses(self):
+        """
+        Put the dataset's responses into the cache, for them to be
+        invalidated.
+        """
+        self.get(views.DataSetInstanceView, 'dataset_instance_by_user')
+        self.get(views.PlaceCollectionView, 'place_collection_by_dataset')
+        self.get(views.ActivityView, 'activity_collection_by_dataset')
+
+
+@benchmark('serialize_places')
+def serialize_places(context):
+    resource = resources.PlaceResource()
+
+    def run():
+        for place in context.places:
+            resource.serialize(place)
+    return run
+
+
+@benchmark('render_place_collection')
+def render_place_collection(context):
+    def prepare():
+        context.clear_responses('place_collection_by_dataset')
+
+    def run():
+        context.get(views.PlaceCollectionView, 'place_collection_by_dataset')
+    return prepare, run
+
+
+@benchmark('render_place_collection_csv')
+def render_place_collection_csv(context):
+    renderer = renderers.CSVRenderer(None)
+
+    def run():
+        renderer.render(context.place_data)
+    return run
+
+
+@benchmark('process_urls')
+def process_urls(context):
+    mixin = views.AbsUrlMixin()
+    mixin.request = RequestFactory().get('/')
+    data = []
+
+    def prepare():
+        data[:] = copy.deepcopy(context.place_data)
+
+    def run():
+        mixin.process_urls(data, 'http://example.com')
+    return prepare, run
+
+
+# The models whose caches are benchmarked, and how to get an instance of
+# each from the context.
+CLEARED_INSTANCES = (
+    (DataSet, lambda context: context.dataset),
+    (Place, lambda context: context.places[0]),
+    (SubmissionSet, lambda context: SubmissionSet.objects.filter(place__dataset=context.dataset)[0]),
+    (Submission, lambda context: Submission.objects.filter(dataset=context.dataset)[0]),
+    (Attachment, lambda context: Attachment.objects.filter(thing__dataset=context.dataset)[0]),
+    (Activity, lambda context: Activity.objects.filter(data__dataset=context.dataset)[0]),
+)
+
+
+def register_clear_instance_benchmark(model, get_instance):
+    @benchmark('clear_instance:%s' % model.__name__)
+    def clear_instance(context):
+        instance = get_instance(context)
+
+        def run():
+            model.cache.clear_instance(instance)
+        return context.cache_responses, run
+
+for model, get_instance in CLEARED_INSTANCES:
+    register_clear_instance_benchmark(model, get_instance)
+
+
+@benchmark('cached_response')
+def cached_response(context):
+    context.get(views.PlaceCollectionView, 'place_collection_by_dataset')
+
+    def run():
+        context.get(views.PlaceCollectionView, 'place_collection_by_dataset')
+    return run
+
+
+@benchmark('apikey_authenticate')
+def apikey_authenticate(context):
+    backend = APIKeyBackend()
+
+    def run():
+        backend.authenticate(key=context.api_key, ip_address='127.0.0.1')
+    return run
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_benchmark(func, context, repeat):
+    """
+    Time a benchmark.  Returns the best and the median of the times, in
+    seconds.
+    """
+    setup = func(context)
+    prepare, run = setup if isinstance(setup, tuple) else (None, setup)
+
+    times = []
+    for _ in xrange(repeat):
+        if prepare is not None:
+            prepare()
+        start_time = time.time()
+        run()
+        times.append(time.time() - start_time)
+    return {'best': min(times), 'median': median(times)}
+
+
+def get_benchmarks(names=None):
+    """
+    Get the benchmarks with the given names, or whose names start with one
+    of the given names followed by a colon (e.g., "clear_instance").
+    """
+    if not names:
+        return list(BENCHMARKS)
+    return [(name, func) for name, func in BENCHMARKS
+            if name in names or name.split(':')[0] in names]
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the best times of some results with those of a baseline.
+    Returns the changes (the ratios of the times to the baseline's, for the
+    benchmarks in both), and the names of the benchmarks that are slower
+    than the baseline by more than the tolerance (e.g., 0.25 for 25%).
+    """
+    changes = {}
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]['best']
+        changes[name] = (result['best'] / base) if base else None
+        if changes[name] is not None and changes[name] > 1 + tolerance:
+            regressions.append(name)
+    return changes, sorted(regressions)
+
+
+def load_baseline(path):
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(path, scale, results):
+    with open(path, 'w') as baseline_file:
+        json.dump({'scale': scale, 'results': results}, baseline_file,
+                  indent=2, sort_keys=True)
@@ -1,8 +1,16 @@
 from collections import defaultdict
 from django.conf import settings
 from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
+import time
+from . import cache_serializers
+from . import instrumentation
+from . import metrics
 from . import utils
+from .hostcache import host_cache
+from .localcache import tiered_cache
+from . import warming
 
 import logging
 logger = logging.getLogger('sa_api.cache')
@@ -19,14 +27,16 @@ class Cache (object):
         keys = set()
         for prefix in prefixes:
             meta_key = self.get_meta_key(prefix)
-            keys |= cache.get(meta_key) or set()
+            keys |= cache_serializers.loads(cache.get(meta_key), set())
             keys.add(meta_key)
         logger.debug('Keys with prefixes "%s": "%s"' % ('", "'.join(prefixes), '", "'.join(keys)))
         return keys
 
     def clear_keys(self, *keys):
         logger.debug('Deleting: "%s"' % '", "'.join(keys))
-        cache.delete_many(keys)
+        tiered_cache.delete_many(keys)
+        if host_cache.enabled:
+            host_cache.delete_many(keys)
 
     def get_instance_params_key(self, inst_key):
         from django.db.models import Model
@@ -38,7 +48,7 @@ class Cache (object):
     def clear_instance_params(self, obj):
         instance_params_key = self.get_instance_params_key(obj)
         logger.debug('Deleting: "%s"' % instance_params_key)
-        cache.delete(instance_params_key)
+        tiered_cache.delete(instance_params_key)
 
     def get_cached_instance_params(self, inst_key, obj_getter):
         """
@@ -48,13 +58,13 @@ class Cache (object):
         so that it does not get evaluated if it doesn't have to be.
         """
         instance_params_key = self.get_instance_params_key(inst_key)
-        params = cache.get(instance_params_key)
+        params = tiered_cache.get(instance_params_key)
 
         if params is None:
             obj = obj_getter()
             params = self.get_instance_params(obj)
             logger.debug('Setting instance parameters for "%s": %r' % (instance_params_key, params))
-            cache.set(instance_params_key, params, settings.API_CACHE_TIMEOUT)
+            tiered_cache.set(instance_params_key, params, settings.API_CACHE_TIMEOUT)
         else:
             logger.debug('Found instance parameters for "%s": %r' % (instance_params_key, params))
         return params
@@ -62,16 +72,38 @@ class Cache (object):
     def get_other_keys(self, **params):
         return set()
 
-    def clear_instance(self, obj):
-        # Collect information for cache keys
-        params = self.get_cached_instance_params(obj.pk, lambda: obj)
-        # Collect the prefixes for cached requests
-        prefixes = self.get_request_prefixes(**params)
-        prefixed_keys = self.get_keys_with_prefixes(*prefixes)
-        # Collect other related keys
-        other_keys = self.get_other_keys(**params) | set([self.get_instance_params_key(obj.pk)])
-        # Clear all the keys
-        self.clear_keys(*(prefixed_keys | other_keys))
+    def clear_instance(self, obj, warm=True):
+        """
+        Clear the cached responses and other values for the instance.  The
+        most requested of the responses are re-rendered in the background,
+        unless warm is False, in which case the caller has to schedule that
+        itself (see CacheClearingModel.delete).  Returns the keys of the
+        cleared responses.
+        """
+        with instrumentation.span('invalidate', model=obj.__class__.__name__):
+            # Collect information for cache keys
+            params = self.get_cached_instance_params(obj.pk, lambda: obj)
+            # Collect the prefixes for cached requests
+            prefixes = self.get_request_prefixes(**params)
+            prefixed_keys = self.get_keys_with_prefixes(*prefixes)
+            # Collect other related keys
+            other_keys = self.get_other_keys(**params) | set([self.get_instance_params_key(obj.pk)])
+            # Clear all the keys
+            self.clear_keys(*(prefixed_keys | other_keys))
+            self.count_invalidation(obj, prefixed_keys | other_keys)
+            # Re-render the most requested of the cleared responses
+            if warm:
+                warming.schedule_invalidated(prefixed_keys)
+            return prefixed_keys
+
+    def count_invalidation(self, obj, keys):
+        """
+        Count the invalidation, and the keys it deleted, for the model class
+        of the object (see the metrics endpoint).
+        """
+        model_name = obj.__class__.__name__
+        metrics.count('cache_invalidations:%s' % model_name)
+        metrics.count('cache_keys_deleted:%s' % model_name, len(keys))
 
 
 class DataSetCache (Cache):
@@ -92,16 +124,93 @@ class DataSetCache (Cache):
         collection_path = reverse('dataset_collection_by_user', args=[owner])
         prefixes.update([instance_path, collection_path])
 
-        # TODO: Deprecated paths
-        instance_path = reverse('dataset_instance_by_user_1', args=[owner, dataset])
-        collection_path = reverse('dataset_collection_by_user_1', args=[owner])
-        prefixes.update([instance_path, collection_path])
-
         return prefixes
 
+    def get_other_keys(self, **params):
+        owner_id = params.get('owner_id')
+        return set([self.get_places_counts_key(owner_id),
+                    self.get_submission_sets_key(owner_id)])
+
     def get_submission_sets_key(self, owner_id):
         return '%s:%s:%s' % (self.__class__.__name__, owner_id, 'submission_sets')
 
+    def get_places_counts_key(self, owner_id):
+        return '%s:%s:%s' % (self.__class__.__name__, owner_id, 'places_counts')
+
+    def calculate_places_counts(self, owner_id):
+        """
+        Count the places in each of the owner's datasets.
+        """
+        # Import Place here to avoid circular dependencies.
+        from django.db.models import Count
+        from .models import Place
+
+        qs = Place.objects.filter(dataset__owner_id=owner_id)
+        qs = qs.values('dataset_id').annotate(length=Count('id'))
+
+        return dict([(places['dataset_id'], places['length'])
+                     for places in qs])
+
+    def get_places_counts(self, owner_id):
+        """
+        A mapping from the ids of an owner's datasets to the number of places
+        in each.
+        """
+        places_counts_key = self.get_places_counts_key(owner_id)
+        places_counts = tiered_cache.get(places_counts_key)
+        if places_counts is None:
+            places_counts = self.calculate_places_counts(owner_id)
+            tiered_cache.set(places_counts_key, places_counts, settings.API_CACHE_TIMEOUT)
+        return places_counts
+
+    def calculate_submission_sets(self, owner_id):
+        """
+        Total up the submissions of each type in each of the owner's
+        datasets.
+        """
+        # Import SubmissionSet here to avoid circular dependencies.
+        from django.db.models import Sum
+        from .models import SubmissionSet
+
+        submission_sets = defaultdict(list)
+
+        # Ignore empty sets
+        qs = SubmissionSet.objects.filter(place__dataset__owner_id=owner_id,
+                                          submission_count__gt=0)
+        qs = qs.values('place__dataset_id', 'place__dataset__owner__username',
+                       'place__dataset__slug', 'submission_type')
+        qs = qs.annotate(length=Sum('submission_count')).order_by('submission_type')
+
+        for submission_set in qs:
+            dataset_id, owner, dataset, set_name, length = \
+                map(submission_set.get, ['place__dataset_id',
+                       'place__dataset__owner__username',
+                       'place__dataset__slug', 'submission_type', 'length'])
+
+            submission_sets[dataset_id].append({
+                'type': set_name,
+                'length': length,
+                'url': reverse('all_submissions_by_dataset', kwargs={
+                    'dataset__owner__username': owner,
+                    'dataset__slug': dataset,
+                    'submission_type': set_name
+                })
+            })
+
+        return submission_sets
+
+    def get_submission_sets(self, owner_id):
+        """
+        A mapping from the ids of an owner's datasets to the type, total
+        length and URL of each type of submission in them.
+        """
+        submission_sets_key = self.get_submission_sets_key(owner_id)
+        submission_sets = tiered_cache.get(submission_sets_key)
+        if submission_sets is None:
+            submission_sets = self.calculate_submission_sets(owner_id)
+            tiered_cache.set(submission_sets_key, submission_sets, settings.API_CACHE_TIMEOUT)
+        return submission_sets
+
 
 class ThingWithAttachmentCache (Cache):
     dataset_cache = DataSetCache()
@@ -117,10 +226,13 @@ class ThingWithAttachmentCache (Cache):
     def get_attachments_key(self, dataset_id):
         return 'dataset:%s:%s' % (dataset_id, 'attachments-by-thing_id')
 
-    def calculate_attachments(self, dataset_id):
+    def calculate_attachments(self, dataset_id, thing_ids=None):
         """
         Cache all the attachments for all the places in the given dataset. Helps
         to cut down on database hits when doing operations on several places.
+
+        If thing_ids is given, only the attachments for those things are
+        collected.
         """
         # Import Attachment here to avoid circular dependencies.
         from .models import Attachment
@@ -128,6 +240,8 @@ class ThingWithAttachmentCache (Cache):
         attachments = defaultdict(list)
 
         qs = Attachment.objects.filter(thing__dataset_id=dataset_id)
+        if thing_ids is not None:
+            qs = qs.filter(thing_id__in=thing_ids)
 #        qs = qs.values('file', 'name', 'thing_id')
         # NOTE: To build the back-reference URL, I'd need information about
         # the thing's dataset (like thing__dataset__owner__username and such),
@@ -151,10 +265,10 @@ class ThingWithAttachmentCache (Cache):
         attachments on each place; we can just do it once.
         """
         attachments_key = self.get_attachments_key(dataset_id)
-        attachments = cache.get(attachments_key)
+        attachments = tiered_cache.get(attachments_key)
         if attachments is None:
             attachments = self.calculate_attachments(dataset_id)
-            cache.set(attachments_key, attachments, settings.API_CACHE_TIMEOUT)
+            tiered_cache.set(attachments_key, attachments, settings.API_CACHE_TIMEOUT)
         return attachments
 
 
@@ -169,6 +283,13 @@ class PlaceCache (ThingWithAttachmentCache, Cache):
         })
         return params
 
+    def get_other_keys(self, **params):
+        # A deleted place takes its submissions out of the dataset's totals.
+        owner_id = params.get('owner_id')
+        places_counts_key = self.dataset_cache.get_places_counts_key(owner_id)
+        submission_sets_key = self.dataset_cache.get_submission_sets_key(owner_id)
+        return set([places_counts_key, submission_sets_key])
+
     def get_request_prefixes(self, **params):
         owner, dataset, place = map(params.get, ('owner', 'dataset', 'place'))
         prefixes = super(PlaceCache, self).get_request_prefixes(**params)
@@ -176,20 +297,39 @@ class PlaceCache (ThingWithAttachmentCache, Cache):
         instance_path = reverse('place_instance_by_dataset', args=[owner, dataset, place])
         collection_path = reverse('place_collection_by_dataset', args=[owner, dataset])
         activity_path = reverse('activity_collection_by_dataset', args=[owner, dataset])
-        prefixes.update([instance_path, collection_path, activity_path])
-
-        # TODO: Deprecated paths
-        instance_path = reverse('place_instance_by_dataset_1', args=[owner, dataset, place])
-        collection_path = reverse('place_collection_by_dataset_1', args=[owner, dataset])
-        activity_path = reverse('activity_collection_by_dataset_1', args=[owner, dataset])
-        prefixes.update([instance_path, collection_path, activity_path])
+        # The dataset's place count and summary change along with its places.
+        dataset_path = reverse('dataset_instance_by_user', args=[owner, dataset])
+        dataset_collection_path = reverse('dataset_collection_by_user', args=[owner])
+        prefixes.update([instance_path, collection_path, activity_path,
+                         dataset_path, dataset_collection_path])
 
         return prefixes
 
+    # How long to wait between tries to lock the submission sets map for
+    # patching (see count_submissions).
+    patch_lock_poll_interval = 0.01
+
     def get_submission_sets_key(self, dataset_id):
         return 'dataset:%s:%s' % (dataset_id, 'submission_sets-by-thing_id')
 
-    def calculate_submission_sets(self, dataset_id):
+    def get_submission_sets_version_key(self, dataset_id):
+        return self.get_submission_sets_key(dataset_id) + ':version'
+
+    def bump_submission_sets_version(self, dataset_id):
+        """
+        Mark the submission counts of the dataset as changed, so that a map
+        calculated from the counts before the change is not cached (see
+        cache_submission_sets).
+        """
+        version_key = self.get_submission_sets_version_key(dataset_id)
+        try:
+            cache.incr(version_key)
+        except ValueError:
+            # The version doesn't exist yet (or has expired).
+            if not cache.add(version_key, 1, settings.API_CACHE_TIMEOUT):
+                cache.incr(version_key)
+
+    def calculate_submission_sets(self, dataset_id, place_ids=None):
         """
         Cache all the submission set metadata for all the places in the given
         dataset. Helps to cut down on database hits when doing operations on
@@ -197,42 +337,97 @@ class PlaceCache (ThingWithAttachmentCache, Cache):
 
         Because of this, it's more efficient to modify many places in a batch,
         as opposed to doing a few places, then a few submissions, etc.
+
+        If place_ids is given, only the submission sets for those places are
+        collected.
         """
         # Import SubmissionSet here to avoid circular dependencies.
-        from django.db.models import Count
         from .models import SubmissionSet
 
         submission_sets = defaultdict(list)
 
-        qs = SubmissionSet.objects.filter(place__dataset_id=dataset_id)
-        qs = qs.annotate(length=Count('children'))
-        qs = qs.values('submission_type', 'length',
+        # Ignore empty sets
+        qs = SubmissionSet.objects.filter(place__dataset_id=dataset_id,
+                                          submission_count__gt=0)
+        if place_ids is not None:
+            qs = qs.filter(place_id__in=place_ids)
+        qs = qs.values('submission_type', 'submission_count',
                        'place__dataset__owner__username',
                        'place__dataset__slug', 'place_id')
 
         for submission_set in qs:
             set_name, length, owner, dataset, place = \
-                map(submission_set.get, ['submission_type', 'length',
+                map(submission_set.get, ['submission_type', 'submission_count',
                        'place__dataset__owner__username',
                        'place__dataset__slug', 'place_id'])
 
-            # Ignore empty sets
-            if length <= 0:
-                continue
-
             submission_sets[place].append({
                 'type': set_name,
                 'length': length,
-                'url': reverse('submission_collection_by_dataset', kwargs={
-                    'dataset__owner__username': owner,
-                    'dataset__slug': dataset,
-                    'place_id': place,
-                    'submission_type': set_name
-                })
+                'url': self.get_submission_set_url(owner, dataset, place, set_name)
             })
 
         return submission_sets
 
+    def get_submission_set_url(self, owner, dataset, place, set_name):
+        return reverse('submission_collection_by_dataset', kwargs={
+            'dataset__owner__username': owner,
+            'dataset__slug': dataset,
+            'place_id': place,
+            'submission_type': set_name
+        })
+
+    def count_submissions(self, owner, dataset, dataset_id, place, set_name, delta):
+        """
+        Add delta to the length of a place's submission set in the cached
+        submission sets map, instead of dropping the whole map to be
+        recalculated.  Patches are made one at a time; if the map can't be
+        locked for patching in time, it is dropped after all.
+        """
+        submission_sets_key = self.get_submission_sets_key(dataset_id)
+        lock_key = submission_sets_key + ':lock'
+
+        # Keep a map that is being calculated now, from the counts before
+        # this change, from being cached (even if there is no map to patch).
+        self.bump_submission_sets_version(dataset_id)
+
+        deadline = time.time() + settings.API_CACHE_LOCK_WAIT
+        while not cache.add(lock_key, True, settings.API_CACHE_LOCK_TIMEOUT):
+            if time.time() > deadline:
+                tiered_cache.delete(submission_sets_key)
+                return
+            time.sleep(self.patch_lock_poll_interval)
+
+        try:
+            submission_sets = tiered_cache.get(submission_sets_key)
+            if submission_sets is None:
+                return
+
+            # The map may have come back from the cache as a plain dict, and
+            # a place's first submission has no entry in it.
+            place_sets = submission_sets.setdefault(place, [])
+            for submission_set in place_sets:
+                if submission_set['type'] == set_name:
+                    submission_set['length'] += delta
+                    break
+            else:
+                place_sets.append({
+                    'type': set_name,
+                    'length': delta,
+                    'url': self.get_submission_set_url(owner, dataset, place, set_name)
+                })
+
+            # Ignore empty sets
+            place_sets = [s for s in place_sets if s['length'] > 0]
+            if place_sets:
+                submission_sets[place] = place_sets
+            else:
+                del submission_sets[place]
+
+            tiered_cache.replace(submission_sets_key, submission_sets, settings.API_CACHE_TIMEOUT)
+        finally:
+            cache.delete(lock_key)
+
     def get_submission_sets(self, dataset_id):
         """
         A mapping from Place ids to attributes.  Helps to cut down
@@ -241,12 +436,30 @@ class PlaceCache (ThingWithAttachmentCache, Cache):
         There should be at most one SubmissionSet of a given type for one place.
         """
         submission_sets_key = self.get_submission_sets_key(dataset_id)
-        submission_sets = cache.get(submission_sets_key)
+        submission_sets = tiered_cache.get(submission_sets_key)
         if submission_sets is None:
+            version = cache.get(self.get_submission_sets_version_key(dataset_id))
             submission_sets = self.calculate_submission_sets(dataset_id)
-            cache.set(submission_sets_key, submission_sets, settings.API_CACHE_TIMEOUT)
+            self.cache_submission_sets(dataset_id, submission_sets, version)
         return submission_sets
 
+    def cache_submission_sets(self, dataset_id, submission_sets, version):
+        """
+        Cache a newly calculated submission sets map, unless the counts have
+        changed since the version it was calculated at, or the map is being
+        patched right now.  Either way, the map may already be out of date.
+        """
+        submission_sets_key = self.get_submission_sets_key(dataset_id)
+        lock_key = submission_sets_key + ':lock'
+        if not cache.add(lock_key, True, settings.API_CACHE_LOCK_TIMEOUT):
+            return
+
+        try:
+            if cache.get(self.get_submission_sets_version_key(dataset_id)) == version:
+                tiered_cache.set(submission_sets_key, submission_sets, settings.API_CACHE_TIMEOUT)
+        finally:
+            cache.delete(lock_key)
+
 
 class SubmissionSetCache (Cache):
     place_cache = PlaceCache()
@@ -269,16 +482,11 @@ class SubmissionSetCache (Cache):
         collection_path = reverse('place_collection_by_dataset', args=[owner, dataset])
         dataset_path = reverse('dataset_instance_by_user', args=[owner, dataset])
         activity_path = reverse('activity_collection_by_dataset', args=[owner, dataset])
+        # The owner's datasets list the submission totals and summary of each.
+        dataset_collection_path = reverse('dataset_collection_by_user', args=[owner])
 
-        prefixes.update([instance_path, collection_path, dataset_path, activity_path])
-
-        # TODO: Deprecated paths
-        instance_path = reverse('place_instance_by_dataset_1', args=[owner, dataset, place])
-        collection_path = reverse('place_collection_by_dataset_1', args=[owner, dataset])
-        dataset_path = reverse('dataset_instance_by_user_1', args=[owner, dataset])
-        activity_path = reverse('activity_collection_by_dataset_1', args=[owner, dataset])
-
-        prefixes.update([instance_path, collection_path, dataset_path, activity_path])
+        prefixes.update([instance_path, collection_path, dataset_path, activity_path,
+                         dataset_collection_path])
 
         return prefixes
 
@@ -297,10 +505,30 @@ class SubmissionCache (ThingWithAttachmentCache, Cache):
         return params
 
     def get_other_keys(self, **params):
-        owner_id, dataset_id = map(params.get, ['owner_id', 'dataset_id'])
+        # The place submission sets map is patched as submissions are added
+        # and removed (see Submission.count_in_parent), so it is not cleared.
+        owner_id = params.get('owner_id')
         dataset_submission_sets_key = self.dataset_cache.get_submission_sets_key(owner_id)
-        place_submission_sets_key = self.place_cache.get_submission_sets_key(dataset_id)
-        return set([dataset_submission_sets_key, place_submission_sets_key])
+        return set([dataset_submission_sets_key])
+
+    def count_submissions(self, submission_obj, delta):
+        try:
+            params = self.get_instance_params(submission_obj)
+        except ObjectDoesNotExist:
+            # The submission's set or place has been deleted along with it.
+            submission_sets_key = self.place_cache.get_submission_sets_key(submission_obj.dataset_id)
+            self.place_cache.bump_submission_sets_version(submission_obj.dataset_id)
+            tiered_cache.delete(submission_sets_key)
+            return
+
+        owner, owner_id, dataset, dataset_id, place, set_name = map(params.get,
+            ['owner', 'owner_id', 'dataset', 'dataset_id', 'place', 'set_name'])
+        self.place_cache.count_submissions(owner, dataset, dataset_id, place, set_name, delta)
+
+        # The dataset totals are read from the new counts, so recalculate
+        # them (a deleted submission's totals may have been recalculated
+        # since the submission's keys were cleared).
+        tiered_cache.delete(self.dataset_cache.get_submission_sets_key(owner_id))
 
     def get_request_prefixes(self, **params):
         owner, dataset, place, set_name, submission = map(params.get, ['owner', 'dataset', 'place', 'set_name', 'submission'])
@@ -314,35 +542,26 @@ class SubmissionCache (ThingWithAttachmentCache, Cache):
         general_all_path = reverse('all_submissions_by_dataset', args=[owner, dataset, 'submissions'])
         dataset_path = reverse('dataset_instance_by_user', args=[owner, dataset])
         activity_path = reverse('activity_collection_by_dataset', args=[owner, dataset])
+        dataset_collection_path = reverse('dataset_collection_by_user', args=[owner])
 
         prefixes.update([specific_instance_path, general_instance_path,
                          specific_collection_path, general_collection_path,
                          specific_all_path, general_all_path, dataset_path,
-                         activity_path])
-
-        # TODO: Deprecated paths
-        specific_instance_path = reverse('submission_instance_by_dataset_1', args=[owner, dataset, place, set_name, submission])
-        general_instance_path = reverse('submission_instance_by_dataset_1', args=[owner, dataset, place, 'submissions', submission])
-        specific_collection_path = reverse('submission_collection_by_dataset_1', args=[owner, dataset, place, set_name])
-        general_collection_path = reverse('submission_collection_by_dataset_1', args=[owner, dataset, place, 'submissions'])
-        specific_all_path = reverse('all_submissions_by_dataset_1', args=[owner, dataset, set_name])
-        general_all_path = reverse('all_submissions_by_dataset_1', args=[owner, dataset, 'submissions'])
-        dataset_path = reverse('dataset_instance_by_user_1', args=[owner, dataset])
-        activity_path = reverse('activity_collection_by_dataset_1', args=[owner, dataset])
-
-        prefixes.update([specific_instance_path, general_instance_path,
-                         specific_collection_path, general_collection_path,
-                         specific_all_path, general_all_path, dataset_path,
-                         activity_path])
+                         activity_path, dataset_collection_path])
 
         return prefixes
 
 
 class ActivityCache (Cache):
-    def clear_instance(self, obj):
-        keys = cache.get('activity_keys') or set()
-        keys.add('activity_keys')
-        cache.delete_many(keys)
+    def clear_instance(self, obj, warm=True):
+        with instrumentation.span('invalidate', model=obj.__class__.__name__):
+            keys = cache_serializers.loads(cache.get('activity_keys'), set())
+            keys.add('activity_keys')
+            cache.delete_many(keys)
+            self.count_invalidation(obj, keys)
+            if warm:
+                warming.schedule_invalidated(keys)
+            return keys
 
 
 class AttachmentCache (Cache):
@@ -0,0 +1,196 @@
+"""
+Serializers for the values that the API keeps in the cache for itself: the
+per-dataset attachment and submission set maps, instance parameters, and
+the sets of cached response keys.  Which one is used is set with the
+API_CACHE_SERIALIZER setting.
+
+A serializer has dumps(value), which returns a string, and loads(string).
+See profiling/benchmark_cache_serializers.py to compare them on the size of
+the values they produce and the time they take.
+"""
+import cPickle as pickle
+import datetime
+import re
+from collections import defaultdict
+from django.conf import settings
+from django.utils.importlib import import_module
+from django.utils.timezone import utc
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class PickleSerializer (object):
+    def dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+# Digit runs in URLs (without leading zeros, so that they can be stored as
+# numbers and written back exactly the same).
+URL_NUMBER_PATTERN = re.compile(r'(?<![0-9])(0|[1-9][0-9]*)(?![0-9])')
+URL_PREFIXES = ('/', 'http://', 'https://')
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class CompactSerializer (object):
+    """
+    Packs values into a smaller form before pickling them:
+
+    * Equal strings are stored once.
+    * URLs are stored as a template (stored once) and the numbers in them,
+      so that, e.g., the URLs of all of the submission sets of one type in
+      a dataset share one template.
+    * Datetimes are stored as a number of microseconds.
+
+    In the packed form, every tuple is a tagged container or value; other
+    types are left as they are:
+
+     tag | holds...
+    -----|--------------------------------------------------------
+     'd' | keys, values of a dict
+     'L' | keys, values of a defaultdict(list)
+     's' | items of a set
+     't' | items of a tuple
+     'u' | template, numbers of a URL
+     'T' | microseconds since the epoch of a UTC datetime
+     'N' | microseconds since the epoch of a naive datetime
+    """
+    version = 1
+
+    def dumps(self, value):
+        packed = self.pack(value, {})
+        return pickle.dumps((self.version, packed), pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        version, packed = pickle.loads(data)
+        if version != self.version:
+            raise ValueError('Unknown compact serialization version %r' % version)
+        return self.unpack(packed)
+
+    def pack(self, value, strings):
+        pack = self.pack
+        if isinstance(value, basestring):
+            if value.startswith(URL_PREFIXES):
+                parts = URL_NUMBER_PATTERN.split(value)
+                if len(parts) > 1:
+                    template = parts[0::2]
+                    template = '%s'.join([part.replace('%', '%%') for part in template])
+                    numbers = tuple([int(number) for number in parts[1::2]])
+                    return ('u', strings.setdefault(template, template), numbers)
+            return strings.setdefault(value, value)
+        elif isinstance(value, dict):
+            tag = 'L' if isinstance(value, defaultdict) and value.default_factory is list else 'd'
+            return (tag, [pack(key, strings) for key in value.iterkeys()],
+                         [pack(val, strings) for val in value.itervalues()])
+        elif isinstance(value, list):
+            return [pack(item, strings) for item in value]
+        elif isinstance(value, (set, frozenset)):
+            return ('s', [pack(item, strings) for item in value])
+        elif isinstance(value, tuple):
+            return ('t', [pack(item, strings) for item in value])
+        elif isinstance(value, datetime.datetime):
+            if value.tzinfo is None:
+                return ('N', self.microseconds(value))
+            return ('T', self.microseconds(value.astimezone(utc).replace(tzinfo=None)))
+        return value
+
+    def unpack(self, packed):
+        unpack = self.unpack
+        if isinstance(packed, list):
+            return [unpack(item) for item in packed]
+        elif not isinstance(packed, tuple):
+            return packed
+
+        tag = packed[0]
+        if tag == 'd':
+            return dict(zip([unpack(key) for key in packed[1]],
+                            [unpack(val) for val in packed[2]]))
+        elif tag == 'L':
+            value = defaultdict(list)
+            value.update(zip([unpack(key) for key in packed[1]],
+                             [unpack(val) for val in packed[2]]))
+            return value
+        elif tag == 'u':
+            return packed[1] % packed[2]
+        elif tag == 's':
+            return set([unpack(item) for item in packed[1]])
+        elif tag == 't':
+            return tuple([unpack(item) for item in packed[1]])
+        elif tag == 'T':
+            return (EPOCH + datetime.timedelta(microseconds=packed[1])).replace(tzinfo=utc)
+        elif tag == 'N':
+            return EPOCH + datetime.timedelta(microseconds=packed[1])
+        raise ValueError('Unknown compact serialization tag %r' % (tag,))
+
+    def microseconds(self, naive_datetime):
+        delta = naive_datetime - EPOCH
+        return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+class MsgpackSerializer (object):
+    """
+    Serializes values with msgpack, which has to be installed.  Sets and
+    datetimes are stored as msgpack extension types; tuples come back as
+    lists, and defaultdicts as dicts.
+    """
+    SET, UTC_DATETIME, NAIVE_DATETIME = range(3)
+
+    def dumps(self, value):
+        return msgpack.packb(value, default=self.encode, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, ext_hook=self.decode, encoding='utf-8')
+
+    def encode(self, value):
+        if isinstance(value, (set, frozenset)):
+            return msgpack.ExtType(self.SET, self.dumps(list(value)))
+        elif isinstance(value, datetime.datetime):
+            if value.tzinfo is None:
+                return msgpack.ExtType(self.NAIVE_DATETIME, self.dumps(value.isoformat()))
+            value = value.astimezone(utc).replace(tzinfo=None)
+            return msgpack.ExtType(self.UTC_DATETIME, self.dumps(value.isoformat()))
+        raise TypeError('Cannot serialize %r' % (value,))
+
+    def decode(self, code, data):
+        value = self.loads(data)
+        if code == self.SET:
+            return set(value)
+        elif code in (self.UTC_DATETIME, self.NAIVE_DATETIME):
+            format = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S'
+            value = datetime.datetime.strptime(value, format)
+            return value.replace(tzinfo=utc) if code == self.UTC_DATETIME else value
+        return msgpack.ExtType(code, data)
+
+
+_serializers = {}
+
+
+def get_serializer(path=None):
+    """
+    Get an instance of the serializer class at the given dotted path
+    (API_CACHE_SERIALIZER, by default).
+    """
+    path = path or settings.API_CACHE_SERIALIZER
+    if path not in _serializers:
+        module_name, class_name = path.rsplit('.', 1)
+        _serializers[path] = getattr(import_module(module_name), class_name)()
+    return _serializers[path]
+
+
+def dumps(value):
+    return get_serializer().dumps(value)
+
+
+def loads(data, default=None):
+    """
+    Load a value stored with dumps, or return the default if there is no
+    data (e.g., on a cache miss).
+    """
+    if data is None:
+        return default
+    return get_serializer().loads(data)
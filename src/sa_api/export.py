@@ -0,0 +1,355 @@
+"""
+Streaming exports of the places and submissions in a dataset.
+
+An export is produced as an iterator of strings, one per chunk of rows read
+from the database, so that a whole dataset never has to be held in memory at
+once.  Rows are read in primary key order, a chunk at a time, which also means
+that an interrupted export can be resumed by passing the id of the last row
+that was received as ``after``.
+"""
+import json
+import zlib
+from operator import attrgetter, itemgetter
+from django.conf import settings
+from django.core.serializers.json import DateTimeAwareJSONEncoder
+from django.db.models import Count, Max
+from StringIO import StringIO
+import ujson
+from . import models
+from . import renderers
+from . import resources
+from . import utils
+
+
+EXPORT_FORMATS = ('geojson', 'ndjson', 'csv')
+
+MEDIA_TYPES = {
+    'geojson': 'application/vnd.geo+json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def iter_chunks(queryset, after=None, chunk_size=None, get_pk=attrgetter('pk')):
+    """
+    Iterate over lists of the objects in the queryset, in primary key order.
+    Each chunk is fetched with its own query, filtered on the last primary key
+    seen (instead of using an offset), so the cost of fetching a chunk does not
+    grow as we get further into the table.
+
+    For querysets that don't return model instances (eg. values_list), pass a
+    get_pk function that picks the primary key out of a row.
+    """
+    chunk_size = chunk_size or settings.API_EXPORT_CHUNK_SIZE
+    last_pk = after
+
+    while True:
+        qs = queryset.order_by('pk')
+        if last_pk is not None:
+            qs = qs.filter(pk__gt=last_pk)
+
+        chunk = list(qs[:chunk_size])
+        if not chunk:
+            return
+
+        yield chunk
+
+        if len(chunk) < chunk_size:
+            return
+        last_pk = get_pk(chunk[-1])
+
+
+def gzip_stream(chunks, compresslevel=6):
+    """
+    Compress an iterator of strings into a gzip stream, as it is consumed.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class ExportResourceMixin (object):
+    """
+    Serializes things using metadata that is fetched for one chunk of things
+    at a time, instead of using the per-dataset maps in the cache (which hold
+    data for the whole dataset).
+    """
+    def __init__(self, view=None, dataset=None, *args, **kwargs):
+        super(ExportResourceMixin, self).__init__(view, *args, **kwargs)
+        self.dataset_obj = dataset
+        self.dataset_params = {
+            'owner': dataset.owner.username,
+            'dataset': dataset.slug,
+        }
+        self.chunk_attachments = {}
+        self.chunk_submission_sets = {}
+
+    def prefetch(self, things):
+        thing_ids = [thing.pk for thing in things]
+        self.chunk_attachments = self.model.cache.calculate_attachments(
+            self.dataset_obj.pk, thing_ids)
+
+    def attachments(self, thing):
+        return self.chunk_attachments.get(thing.pk, [])
+
+
+class ExportPlaceResourceMixin (ExportResourceMixin):
+    def prefetch(self, places):
+        super(ExportPlaceResourceMixin, self).prefetch(places)
+        place_ids = [place.pk for place in places]
+        self.chunk_submission_sets = self.model.cache.calculate_submission_sets(
+            self.dataset_obj.pk, place_ids)
+
+    def instance_params(self, place):
+        return dict(self.dataset_params, place=place.pk)
+
+    def submissions(self, place):
+        return self.chunk_submission_sets.get(place.pk, [])
+
+
+class ExportSubmissionResourceMixin (ExportResourceMixin):
+    def instance_params(self, submission):
+        return dict(self.dataset_params,
+                    place=submission.parent.place_id,
+                    set_name=submission.parent.submission_type,
+                    submission=submission.pk)
+
+
+class ExportPlaceResource (ExportPlaceResourceMixin, resources.PlaceResource):
+    pass
+
+
+class ExportTabularPlaceResource (ExportPlaceResourceMixin, resources.TabularPlaceResource):
+    pass
+
+
+class ExportSubmissionResource (ExportSubmissionResourceMixin, resources.SubmissionResource):
+    pass
+
+
+class ExportTabularSubmissionResource (ExportSubmissionResourceMixin, resources.TabularSubmissionResource):
+    pass
+
+
+class ExportView (object):
+    """
+    Stands in for the API view that a resource normally serializes for.
+    """
+    def __init__(self, show_private_data=False):
+        self.show_private_data = show_private_data
+
+
+class BaseExporter (object):
+    """
+    Writes a sequence of serialized things in some format.  Subclasses
+    override start(), write_chunk() and finish().
+    """
+    tabular = False
+
+    def __init__(self, after=None, url_root=''):
+        self.after = after
+        self.url_root = url_root
+
+    def start(self):
+        return ''
+
+    def write_chunk(self, items):
+        raise NotImplementedError()
+
+    def finish(self):
+        return ''
+
+    def process_urls(self, item):
+        if self.url_root:
+            utils.prefix_urls(item, self.url_root)
+        return item
+
+    def dumps(self, obj):
+        return json.dumps(obj, cls=DateTimeAwareJSONEncoder)
+
+    def export(self, chunks, serialize):
+        yield self.start()
+        for chunk in chunks:
+            items = [self.process_urls(serialize(thing)) for thing in chunk]
+            yield self.write_chunk(items)
+        yield self.finish()
+
+
+class NDJSONExporter (BaseExporter):
+    def write_chunk(self, items):
+        return ''.join([self.dumps(item) + '\n' for item in items])
+
+
+class GeoJSONExporter (BaseExporter):
+    def start(self):
+        self.is_first = True
+        return '{"type": "FeatureCollection", "features": [\n'
+
+    def make_feature(self, item):
+        location = item.pop('location', None)
+        if location is not None:
+            geometry = {'type': 'Point',
+                        'coordinates': [location['lng'], location['lat']]}
+        else:
+            geometry = None
+        return {'type': 'Feature',
+                'id': item.get('id'),
+                'geometry': geometry,
+                'properties': item}
+
+    def write_chunk(self, items):
+        features = ',\n'.join([self.dumps(self.make_feature(item)) for item in items])
+        if not self.is_first:
+            features = ',\n' + features
+        self.is_first = False
+        return features
+
+    def finish(self):
+        return '\n]}\n'
+
+
+class CSVExporter (BaseExporter):
+    """
+    Writes rows in the same shape as the tabular API resources.  The column
+    headers are needed before the first row is written, so they are worked out
+    up front with a pass over the raw data blobs (see csv_headers()), instead
+    of being collected from the serialized rows.
+    """
+    tabular = True
+    renderer_class = renderers.CSVRendererWithUnderscores
+
+    def __init__(self, after=None, url_root='', headers=()):
+        super(CSVExporter, self).__init__(after, url_root)
+        self.renderer = self.renderer_class(None)
+        self.headers = headers
+
+    def writerows(self, rows):
+        csv_buffer = StringIO()
+        self.renderer.writerows(csv_buffer, rows)
+        return csv_buffer.getvalue()
+
+    def start(self):
+        # Leave the header row off of a resumed export, so that it can be
+        # appended to what was already received.
+        if self.after is not None:
+            return ''
+        return self.writerows([self.headers])
+
+    def write_chunk(self, items):
+        return self.writerows(self.renderer.iter_rows(items, self.headers))
+
+
+EXPORTERS = {
+    'geojson': GeoJSONExporter,
+    'ndjson': NDJSONExporter,
+    'csv': CSVExporter,
+}
+
+
+def get_things(dataset, thing_type, include_invisible=False):
+    """
+    Get a queryset of the places (if the thing_type is 'places') or
+    submissions of the given type (or of any type, if the thing_type is
+    'submissions') in the dataset.
+    """
+    if thing_type == 'places':
+        things = models.Place.objects.filter(dataset=dataset)
+    else:
+        things = models.Submission.objects.filter(dataset=dataset).select_related('parent')
+        if thing_type != 'submissions':
+            things = things.filter(parent__submission_type=thing_type)
+
+    if not include_invisible:
+        things = things.filter(visible=True)
+    return things
+
+
+def csv_headers(thing_type, things, include_private=False,
+                level_sep=renderers.CSVRendererWithUnderscores.level_sep):
+    """
+    Work out the set of columns that the tabular representations of the
+    given things will fall into, without serializing any of them.  The fixed
+    fields come from the shape of the tabular resources; the rest come from
+    the submission types and attachment counts in the dataset, and from one
+    pass over the keys in the things' data blobs.
+    """
+    renderer = renderers.CSVRenderer(None)
+    renderer.level_sep = level_sep
+    join = level_sep.join
+    headers = set()
+
+    if thing_type == 'places':
+        for fieldname in ['id', 'submitter_name', 'created_datetime', 'visible']:
+            headers.add('place_' + fieldname)
+        headers.update([join(['place_location', 'lat']),
+                        join(['place_location', 'lng'])])
+
+        # The tabular place resource has a count column for every submission
+        # type with any submissions on the place.
+        submission_types = models.SubmissionSet.objects\
+            .filter(place__in=things, submission_count__gt=0)\
+            .values_list('submission_type', flat=True)\
+            .distinct()
+        headers.update(submission_types)
+
+    else:
+        submission_types = things.values_list('parent__submission_type', flat=True).distinct()
+        for submissionset in submission_types:
+            submissiontype = submissionset[:-1] if submissionset.endswith('s') else submissionset
+            for fieldname in ['id', 'submitter_name', 'created_datetime', 'visible']:
+                headers.add('_'.join([submissiontype, fieldname]))
+        headers.add('place_id')
+
+    max_attachments = things.annotate(attachment_count=Count('attachments'))\
+        .aggregate(Max('attachment_count'))['attachment_count__max'] or 0
+    for index in range(max_attachments):
+        for fieldname in ['name', 'url', 'created_datetime', 'updated_datetime']:
+            headers.add(join(['attachments', str(index), fieldname]))
+
+    blobs = things.values_list('pk', 'data')
+    for chunk in iter_chunks(blobs, get_pk=itemgetter(0)):
+        for pk, data in chunk:
+            data = ujson.loads(data)
+            if not include_private:
+                data = dict([(key, value) for key, value in data.iteritems()
+                             if not key.startswith('private-')])
+            headers.update(renderer.get_plan(data).headers)
+
+    return sorted(headers)
+
+
+def export_things(dataset, thing_type='places', export_format='ndjson',
+                  after=None, include_invisible=False, include_private=False,
+                  url_root='', chunk_size=None):
+    """
+    Return an iterator over the strings that make up an export of the places
+    or submissions in the dataset.  The things are serialized with the same
+    resources that the API uses (the tabular ones, for CSV).
+    """
+    things = get_things(dataset, thing_type, include_invisible)
+    exporter_class = EXPORTERS[export_format]
+    view = ExportView(show_private_data=include_private)
+
+    if thing_type == 'places':
+        resource_class = (ExportTabularPlaceResource if exporter_class.tabular
+                          else ExportPlaceResource)
+    else:
+        resource_class = (ExportTabularSubmissionResource if exporter_class.tabular
+                          else ExportSubmissionResource)
+    resource = resource_class(view, dataset=dataset)
+
+    if exporter_class.tabular:
+        headers = csv_headers(thing_type, things, include_private)
+        exporter = exporter_class(after, url_root, headers=headers)
+    else:
+        exporter = exporter_class(after, url_root)
+
+    def prefetched_chunks():
+        for chunk in iter_chunks(things, after, chunk_size):
+            resource.prefetch(chunk)
+            yield chunk
+
+    return exporter.export(prefetched_chunks(), resource.serialize)
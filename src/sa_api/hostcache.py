@@ -0,0 +1,207 @@
+"""
+A host-local tier for cached API response bodies.
+
+Large responses (like the place collection for a big dataset) are kept in
+the shared cache, so every worker on every host fetches and unpickles the
+same megabytes over the network for every request.  With API_HOST_CACHE_DIR
+set, each body is also written, once, to a file on the host, named for its
+cache key and tagged with its generation.  Workers read the files from the
+OS page cache, which all of the workers on the host share, instead of from
+the network.
+
+Each worker still reads its own copy of a body: the URL root has to be
+filled into uncompressed bodies for every response (see AbsUrlMixin), and
+Django copies the content of a response into a string anyway, so mapping
+the files into memory (with mmap) wouldn't save the copy.
+
+The shared cache still decides which generation of a body is fresh (see
+CachedMixin.get_cached_body), so a file is never served after its response
+has been invalidated.  Files are removed when their keys are cleared (see
+sa_api.cache.Cache.clear_keys) or replaced by a newer generation, and the
+least recently used files are evicted to keep the directory under
+API_HOST_CACHE_MAX_SIZE bytes.
+
+Eviction has to look at every file in the directory, so it isn't done on
+every store.  Each process keeps an estimate of the directory's size, which
+is corrected whenever the directory is scanned, and scans it only when the
+estimate passes the limit, or when it is old (the other workers write to the
+directory too).
+"""
+import cPickle as pickle
+import errno
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+import time
+from django.conf import settings
+
+import logging
+logger = logging.getLogger('sa_api.hostcache')
+
+
+HEADER_FORMAT = '!I'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def get_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class HostCache (object):
+    """
+    Stores a string of content, and a small picklable value of metadata to go
+    with it, for each cache key and generation.
+    """
+    # How old (in seconds) the estimate of the directory's size may get
+    # before the directory is scanned again.
+    scan_interval = 60
+
+    # The share of max_size to evict down to, so that the directory doesn't
+    # have to be scanned again on the next store.
+    low_water = 0.9
+
+    def __init__(self, directory=None, max_size=None):
+        self._directory = directory
+        self._max_size = max_size
+        self.lock = threading.Lock()
+        self.size = None
+        self.scanned_at = 0
+
+    @property
+    def directory(self):
+        if self._directory is None:
+            return settings.API_HOST_CACHE_DIR
+        return self._directory
+
+    @property
+    def max_size(self):
+        if self._max_size is None:
+            return settings.API_HOST_CACHE_MAX_SIZE
+        return self._max_size
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def get_path(self, key):
+        # Keys are built from request paths, which may not be ASCII.
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory, hashlib.md5(key).hexdigest())
+
+    def get(self, key, generation):
+        """
+        Get the (metadata, content) stored for the key and generation, or
+        None.
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as cachefile:
+                meta_size, = struct.unpack(HEADER_FORMAT, cachefile.read(HEADER_SIZE))
+                stored_generation, meta = pickle.loads(cachefile.read(meta_size))
+                # Don't read the content of another generation.
+                if stored_generation != generation:
+                    return None
+                content = cachefile.read()
+        except (IOError, OSError, struct.error):
+            return None
+
+        # Mark the file as recently used, for eviction.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return meta, content
+
+    def set(self, key, generation, meta, content):
+        """
+        Store the metadata and content for the key and generation, in place
+        of any other generations of the key.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        meta = pickle.dumps((generation, meta), pickle.HIGHEST_PROTOCOL)
+        path = self.get_path(key)
+        replaced_size = get_size(path)
+
+        # Write to a temporary file and move it into place (over any other
+        # generation of the key), so that other workers never see a partly
+        # written file.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as cachefile:
+                cachefile.write(struct.pack(HEADER_FORMAT, len(meta)))
+                cachefile.write(meta)
+                cachefile.write(content)
+            os.rename(temp_path, path)
+        except:
+            remove(temp_path)
+            raise
+
+        with self.lock:
+            if self.size is not None:
+                self.size += HEADER_SIZE + len(meta) + len(content) - replaced_size
+            full = (self.size is None or self.size > self.max_size or
+                    time.time() - self.scanned_at > self.scan_interval)
+        if full:
+            self.evict()
+
+    def delete_many(self, keys):
+        removed_size = 0
+        for key in keys:
+            path = self.get_path(key)
+            size = get_size(path)
+            remove(path)
+            removed_size += size
+
+        with self.lock:
+            if self.size is not None:
+                self.size -= removed_size
+
+    def evict(self):
+        """
+        Scan the directory and, if it doesn't fit in max_size bytes, remove
+        the least recently used files until it is down to low_water of
+        max_size.
+        """
+        files = []
+        total_size = 0
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        if total_size > self.max_size:
+            files.sort()
+            while total_size > self.max_size * self.low_water and files:
+                mtime, size, path = files.pop(0)
+                logger.debug('Evicting "%s" from the host cache' % path)
+                remove(path)
+                total_size -= size
+
+        with self.lock:
+            self.size = total_size
+            self.scanned_at = time.time()
+
+
+host_cache = HostCache()
@@ -0,0 +1,534 @@
+"""
+Per-request performance instrumentation.
+
+While a request is handled (see middleware.RequestInstrumentation), a
+RequestProfile is kept for it in a thread local.  SQL queries and shared
+cache operations are counted and timed as they happen, and views time their
+authentication, serialization, URL processing and rendering phases with
+timed().
+
+When the request is done, its profile can be sent back to authorized
+callers (superusers, or anyone when DEBUG is on) in a Server-Timing header,
+and its timings are added to per-view histograms in the shared metrics (see
+the request_stats command).
+
+A profile can also record the SQL and the calling stack of each query (see
+record_queries()), to find queries that are repeated once per row -- e.g., a
+lazy load of a place's dataset in a resource method.
+
+When API_TRACE_FILE is set, each request is also traced: every timed phase,
+and the other major steps of a request (marked with span()), are recorded
+as a tree of spans, which is appended to the trace file as a JSON line when
+the request is done.
+"""
+import datetime
+import json
+import os
+import re
+import threading
+import time
+import traceback
+from collections import defaultdict
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from . import metrics
+
+import logging
+logger = logging.getLogger('sa_api.instrumentation')
+
+
+# The phases that are reported, in the order that they're reported in.
+PHASES = ('auth', 'sql', 'cache', 'serialize', 'urls', 'render')
+
+VIEW_NAMES_KEY = 'request_timing_views'
+LABELS_KEY_PREFIX = 'request_timing_labels:'
+
+# The most spans to record for a request; any more are only counted.
+MAX_SPANS = 2000
+
+
+class Span (object):
+    def __init__(self, name, attrs=None):
+        self.name = name
+        self.attrs = attrs
+        self.start_time = time.time()
+        self.end_time = None
+        self.children = []
+
+    def to_dict(self, origin):
+        """
+        Get the span, and its children, with times in milliseconds from the
+        origin (the start of the request).
+        """
+        end_time = self.end_time or time.time()
+        data = {
+            'name': self.name,
+            'start': round((self.start_time - origin) * 1000, 3),
+            'duration': round((end_time - self.start_time) * 1000, 3),
+        }
+        if self.attrs:
+            data['attrs'] = self.attrs
+        if self.children:
+            data['children'] = [child.to_dict(origin) for child in self.children]
+        return data
+
+
+class RequestProfile (object):
+    def __init__(self):
+        self.start_time = time.time()
+        self.end_time = None
+        self.view_name = None
+        self.show_timing = False
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.labelled_times = defaultdict(float)
+        self.labelled_counts = defaultdict(int)
+        # A list of (sql, stack) pairs, when the queries are recorded.
+        self.queries = None
+        # The top-level spans, when the request is traced.
+        self.spans = None
+        self.open_spans = []
+        self.span_count = 0
+        self.dropped_spans = 0
+
+    def trace(self):
+        if self.spans is None:
+            self.spans = []
+
+    def open_span(self, name, attrs=None):
+        if self.span_count >= MAX_SPANS:
+            self.dropped_spans += 1
+            return None
+        span = Span(name, attrs)
+        self.span_count += 1
+        (self.open_spans[-1].children if self.open_spans else self.spans).append(span)
+        self.open_spans.append(span)
+        return span
+
+    def close_span(self, span):
+        if span is None:
+            return
+        span.end_time = time.time()
+        # Spans are closed in the reverse order that they're opened in.
+        if self.open_spans and self.open_spans[-1] is span:
+            self.open_spans.pop()
+
+    @property
+    def duration(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def add(self, phase, seconds, label=None):
+        self.times[phase] += seconds
+        self.counts[phase] += 1
+        if label is not None:
+            self.labelled_times[(phase, label)] += seconds
+            self.labelled_counts[(phase, label)] += 1
+
+    def count(self, name, delta=1):
+        self.counts[name] += delta
+
+    def get_descriptions(self):
+        counts = self.counts.get
+        return {
+            'sql': '%s queries' % counts('sql', 0),
+            'cache': '%s operations, %s hits, %s misses' % (
+                counts('cache', 0), counts('cache_hits', 0), counts('cache_misses', 0)),
+        }
+
+    def server_timing(self):
+        """
+        Get the value of a Server-Timing header for the profile.  Durations
+        are in milliseconds.
+        """
+        descriptions = self.get_descriptions()
+        entries = ['total;dur=%0.1f' % (self.duration * 1000)]
+        for phase in PHASES:
+            if phase not in self.counts:
+                continue
+            entry = '%s;dur=%0.1f' % (phase, self.times[phase] * 1000)
+            if phase in descriptions:
+                entry += ';desc="%s"' % descriptions[phase]
+            entries.append(entry)
+        return ', '.join(entries)
+
+
+_local = threading.local()
+
+
+def current():
+    return getattr(_local, 'profile', None)
+
+
+def start():
+    profile = RequestProfile()
+    _local.profile = profile
+    return profile
+
+
+def finish(profile):
+    profile.end_time = time.time()
+    if current() is profile:
+        _local.profile = None
+    _local.last_profile = profile
+    if profile.view_name:
+        view_timings.record(profile)
+
+
+def last():
+    """
+    Get the profile of the last request that finished in this thread (e.g.,
+    of a request made with the test client).
+    """
+    return getattr(_local, 'last_profile', None)
+
+
+@contextmanager
+def timed(phase, label=None):
+    """
+    Add the time taken by the block to the phase in the current request's
+    profile, if there is one.  Times with a label (like the name of the
+    authentication backend that took them) are also totaled per label,
+    across all views.
+    """
+    profile = current()
+    if profile is None:
+        yield
+        return
+
+    opened = None
+    if profile.spans is not None:
+        opened = profile.open_span(phase, {'label': label} if label is not None else None)
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        profile.add(phase, time.time() - start_time, label)
+        profile.close_span(opened)
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Record the block as a span in the current request's trace, if the
+    request is being traced.  Spans opened in the block are its children.
+    """
+    profile = current()
+    if profile is None or profile.spans is None:
+        yield
+        return
+
+    opened = profile.open_span(name, attrs)
+    try:
+        yield
+    finally:
+        profile.close_span(opened)
+
+
+def count(name, delta=1):
+    profile = current()
+    if profile is not None:
+        profile.count(name, delta)
+
+
+def get_trace(profile, request, response):
+    """
+    Get the record of a traced request for the trace file.
+    """
+    return {
+        'time': datetime.datetime.utcfromtimestamp(profile.start_time).isoformat() + 'Z',
+        'method': request.method,
+        'path': request.get_full_path(),
+        'view': profile.view_name,
+        'status': response.status_code,
+        'duration': round(profile.duration * 1000, 3),
+        'counts': dict(profile.counts),
+        'spans': [span.to_dict(profile.start_time) for span in profile.spans],
+        'dropped_spans': profile.dropped_spans,
+    }
+
+
+class TraceLog (object):
+    """
+    Appends records to the file named by a setting (the API_TRACE_FILE, by
+    default), as JSON lines.
+    """
+    def __init__(self, path_setting='API_TRACE_FILE'):
+        self.path_setting = path_setting
+        self.lock = threading.Lock()
+
+    def write(self, trace):
+        line = json.dumps(trace, sort_keys=True) + '\n'
+        with self.lock:
+            # Each trace is written with a single append, so that traces from
+            # different processes don't get mixed up.
+            with open(getattr(settings, self.path_setting), 'a') as trace_file:
+                trace_file.write(line)
+
+trace_log = TraceLog()
+
+
+def record_queries():
+    """
+    Record the SQL and the calling stack of each of the current request's
+    queries from now on.
+    """
+    profile = current()
+    if profile is not None and profile.queries is None:
+        profile.queries = []
+
+
+# The frames that are left out of the stacks of recorded queries.
+STACK_EXCLUDED_FILES = ('instrumentation.py', 'middleware.py')
+
+
+def get_stack(limit=8):
+    """
+    Get the innermost frames of the current stack that are in the API's own
+    code, or the innermost frames overall if there are none.
+    """
+    frames = traceback.extract_stack()
+    api_dir = os.path.dirname(os.path.abspath(__file__))
+    own = [frame for frame in frames
+           if os.path.abspath(frame[0]).startswith(api_dir)
+           and os.path.basename(frame[0]) not in STACK_EXCLUDED_FILES]
+    return (own or frames[:-2])[-limit:]
+
+
+def record_query(sql):
+    profile = current()
+    if profile is not None and profile.queries is not None:
+        profile.queries.append((sql, get_stack()))
+
+
+def fingerprint(sql):
+    """
+    Get the shape of a query: its SQL with the literals and parameters
+    replaced, so that the same query made for different rows reads the
+    same.
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b|%s', '?', sql)
+    sql = re.sub(r'IN \(\?(?:, \?)*\)', 'IN (...)', sql)
+    return ' '.join(sql.split())
+
+
+def find_repeated_queries(queries, threshold):
+    """
+    Group recorded queries by their fingerprints, and get the groups of more
+    than threshold queries, largest first, as (fingerprint, count, stack)
+    with the stack of the first query of each group.
+    """
+    groups = {}
+    for sql, stack in queries:
+        key = fingerprint(sql)
+        if key in groups:
+            groups[key][0] += 1
+        else:
+            groups[key] = [1, stack]
+    repeated = [(key, count, stack) for key, (count, stack) in groups.items()
+                if count > threshold]
+    return sorted(repeated, key=lambda group: (-group[1], group[0]))
+
+
+def show_timing():
+    """
+    Send the current request's profile back in a Server-Timing header.
+    """
+    profile = current()
+    if profile is not None:
+        profile.show_timing = True
+
+
+class InstrumentedCursor (object):
+    """
+    Wraps a database cursor, to time the queries run with it.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, *args, **kwargs):
+        record_query(sql)
+        with timed('sql'):
+            return self.cursor.execute(sql, *args, **kwargs)
+
+    def executemany(self, sql, *args, **kwargs):
+        record_query(sql)
+        with timed('sql'):
+            return self.cursor.executemany(sql, *args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def instrument_cache_method(method, name):
+    def instrumented(*args, **kwargs):
+        # Some backends implement operations with other ones (like get_many
+        # with get); only count the outermost one.
+        if getattr(_local, 'in_cache', False):
+            return method(*args, **kwargs)
+
+        _local.in_cache = True
+        try:
+            with timed('cache'):
+                result = method(*args, **kwargs)
+        finally:
+            _local.in_cache = False
+
+        if name == 'get':
+            count('cache_hits' if result is not None else 'cache_misses')
+        elif name == 'get_many':
+            keys = args[0] if args else kwargs['keys']
+            count('cache_hits', len(result))
+            count('cache_misses', len(keys) - len(result))
+        return result
+    return instrumented
+
+
+CACHE_METHODS = ('get', 'get_many', 'set', 'set_many', 'add', 'delete', 'delete_many', 'incr')
+
+_install_lock = threading.Lock()
+_installed = False
+
+
+def install():
+    """
+    Start timing the SQL queries run on any database connection, and the
+    operations on the shared cache.  Safe to call more than once.
+    """
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+
+        from django.db.backends import BaseDatabaseWrapper
+        make_cursor = BaseDatabaseWrapper.cursor
+
+        def cursor(self, *args, **kwargs):
+            return InstrumentedCursor(make_cursor(self, *args, **kwargs))
+        BaseDatabaseWrapper.cursor = cursor
+
+        for name in CACHE_METHODS:
+            setattr(cache, name, instrument_cache_method(getattr(cache, name), name))
+
+        _installed = True
+
+
+class ViewTimings (object):
+    """
+    Histograms of how long each view's requests take, and totals of the time
+    spent in each phase.  Requests are counted in-process, and the counts are
+    added to the shared metrics every so often (see metrics.Counts).
+
+    Bucket counts are not cumulative; a request is counted in the first
+    bucket (of API_REQUEST_TIMING_BUCKETS seconds) that it fits in, or in
+    the "inf" bucket.  Times are totaled in microseconds.
+    """
+    def __init__(self):
+        self.counts = metrics.Counts()
+
+    @property
+    def buckets(self):
+        return settings.API_REQUEST_TIMING_BUCKETS
+
+    def get_bucket(self, seconds):
+        for bucket in self.buckets:
+            if seconds <= bucket:
+                return str(bucket)
+        return 'inf'
+
+    def record(self, profile):
+        view = profile.view_name
+        duration = profile.duration
+        deltas = defaultdict(int)
+        names = {VIEW_NAMES_KEY: [view]}
+
+        deltas[get_bucket_name(view, self.get_bucket(duration))] += 1
+        deltas[get_count_name(view)] += 1
+        deltas[get_sum_name(view)] += int(duration * 1000000)
+        for phase, seconds in profile.times.items():
+            deltas[get_sum_name(view, phase)] += int(seconds * 1000000)
+        for (phase, label), seconds in profile.labelled_times.items():
+            names.setdefault(LABELS_KEY_PREFIX + phase, []).append(label)
+            deltas[get_label_count_name(phase, label)] += profile.labelled_counts[(phase, label)]
+            deltas[get_label_sum_name(phase, label)] += int(seconds * 1000000)
+
+        self.counts.count_many(deltas, names)
+
+    def flush_counts(self):
+        self.counts.flush_counts()
+
+
+def get_bucket_name(view, bucket):
+    return 'request_seconds_bucket:%s:%s' % (view, bucket)
+
+
+def get_count_name(view):
+    return 'request_seconds_count:%s' % view
+
+
+def get_sum_name(view, phase='total'):
+    return 'request_microseconds_sum:%s:%s' % (view, phase)
+
+
+def get_label_count_name(phase, label):
+    return '%s_count:%s' % (phase, label)
+
+
+def get_label_sum_name(phase, label):
+    return '%s_microseconds_sum:%s' % (phase, label)
+
+
+def get_view_names():
+    return metrics.get_names(VIEW_NAMES_KEY)
+
+
+def get_labels(phase):
+    return metrics.get_names(LABELS_KEY_PREFIX + phase)
+
+
+def get_buckets():
+    return [str(bucket) for bucket in settings.API_REQUEST_TIMING_BUCKETS] + ['inf']
+
+
+def get_metric_names(view):
+    return ([get_count_name(view)] +
+            [get_bucket_name(view, bucket) for bucket in get_buckets()] +
+            [get_sum_name(view, phase) for phase in ('total',) + PHASES])
+
+
+def get_view_stats(view):
+    """
+    Get the request count, bucket counts, and times (in seconds) per phase
+    recorded for a view.
+    """
+    values = metrics.get_many(get_metric_names(view))
+    return {
+        'count': values[get_count_name(view)],
+        'buckets': [(bucket, values[get_bucket_name(view, bucket)])
+                    for bucket in get_buckets()],
+        'seconds': [(phase, values[get_sum_name(view, phase)] / 1000000.0)
+                    for phase in ('total',) + PHASES],
+    }
+
+
+
+def get_label_stats(phase):
+    """
+    Get the number of times and the time (in seconds) recorded for each label
+    of a phase, as (label, count, seconds) tuples.
+    """
+    labels = sorted(get_labels(phase))
+    names = ([get_label_count_name(phase, label) for label in labels] +
+             [get_label_sum_name(phase, label) for label in labels])
+    values = metrics.get_many(names)
+    return [(label,
+             values[get_label_count_name(phase, label)],
+             values[get_label_sum_name(phase, label)] / 1000000.0)
+            for label in labels]
+
+
+view_timings = ViewTimings()
@@ -0,0 +1,224 @@
+"""
+An in-process tier in front of the shared (Django) cache, for the small
+values that the API looks up many times per request and that rarely change,
+like the instance parameters and the per-dataset attachment and submission
+set maps in the cache module.
+
+Each process keeps a bounded, least-recently-used set of values.  When a key
+is deleted, the deletion is broadcast to every other process (over a Redis
+pub/sub channel in production), so that they drop their local copies too.
+As a safety net against missed messages, local values also expire after
+API_LOCAL_CACHE_TIMEOUT seconds.
+
+Lookups are counted per tier, with the shared metrics' in-process counts
+(see metrics.count and the cache_stats command).
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.importlib import import_module
+from . import metrics
+from .cache_serializers import get_serializer
+
+import logging
+logger = logging.getLogger('sa_api.localcache')
+
+
+CHANNEL = 'sa_api_local_cache_invalidations'
+
+
+class LocalBroadcast (object):
+    """
+    Delivers invalidations to the subscribers in this process only.  Stands
+    in for a real pub/sub channel when there is just one process, and in
+    tests.
+    """
+    def __init__(self):
+        self.subscribers = []
+
+    def publish(self, keys):
+        for callback in self.subscribers:
+            callback(keys)
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+
+class RedisBroadcast (object):
+    """
+    Delivers invalidations to every process subscribed to a Redis pub/sub
+    channel.  Each process listens in a daemon thread.
+    """
+    reconnect_interval = 1
+
+    def __init__(self, url=None, channel=CHANNEL):
+        import redis
+        self.client = redis.StrictRedis.from_url(url or settings.API_LOCAL_CACHE_REDIS_URL)
+        self.channel = channel
+
+    def publish(self, keys):
+        self.client.publish(self.channel, json.dumps(keys))
+
+    def subscribe(self, callback):
+        listener = threading.Thread(target=self.listen, args=(callback,),
+                                    name='sa_api-local-cache-invalidations')
+        listener.daemon = True
+        listener.start()
+
+    def listen(self, callback):
+        while True:
+            try:
+                pubsub = self.client.pubsub()
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        callback(json.loads(message['data']))
+            except Exception:
+                logger.exception('Lost the local cache invalidation channel')
+
+            # Invalidations may have been missed while disconnected, so
+            # nothing cached locally can be trusted.
+            callback(None)
+            time.sleep(self.reconnect_interval)
+
+
+def get_broadcast_class(path=None):
+    module_name, class_name = (path or settings.API_LOCAL_CACHE_BROADCAST).rsplit('.', 1)
+    return getattr(import_module(module_name), class_name)
+
+
+class TieredCache (object):
+    """
+    Looks values up in the process's own LRU first, and then in the shared
+    cache.  Values are stored in both tiers as serialized with the
+    API_CACHE_SERIALIZER (see sa_api.cache_serializers), so callers get their
+    own copy of a value to change.
+
+    With a max_entries of 0 (the default API_LOCAL_CACHE_SIZE), every lookup
+    goes straight to the shared cache.
+    """
+    def __init__(self, max_entries=None, timeout=None, broadcast=None, serializer=None):
+        self._max_entries = max_entries
+        self._timeout = timeout
+        self._serializer = serializer
+        self._broadcast = broadcast
+        self.subscribed = False
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    @property
+    def max_entries(self):
+        if self._max_entries is None:
+            return settings.API_LOCAL_CACHE_SIZE
+        return self._max_entries
+
+    @property
+    def timeout(self):
+        if self._timeout is None:
+            return settings.API_LOCAL_CACHE_TIMEOUT
+        return self._timeout
+
+    @property
+    def serializer(self):
+        if self._serializer is None:
+            return get_serializer()
+        return self._serializer
+
+    @property
+    def broadcast(self):
+        with self.lock:
+            if self._broadcast is None:
+                self._broadcast = get_broadcast_class()()
+            if not self.subscribed:
+                self._broadcast.subscribe(self.invalidate_local)
+                self.subscribed = True
+        return self._broadcast
+
+    def get(self, key, default=None):
+        if not self.max_entries:
+            data = cache.get(key)
+            return default if data is None else self.serializer.loads(data)
+
+        data = self.get_local(key)
+        if data is not None:
+            metrics.count('local_cache_hits')
+            return self.serializer.loads(data)
+        metrics.count('local_cache_misses')
+
+        data = cache.get(key)
+        if data is None:
+            metrics.count('shared_cache_misses')
+            return default
+        metrics.count('shared_cache_hits')
+
+        self.set_local(key, data)
+        return self.serializer.loads(data)
+
+    def set(self, key, value, timeout=None):
+        data = self.serializer.dumps(value)
+        cache.set(key, data, timeout)
+        if self.max_entries:
+            self.set_local(key, data)
+
+    def replace(self, key, value, timeout=None):
+        """
+        Set a new value for a key that other processes may have cached
+        locally.  They drop their copies, and get the new value from the
+        shared cache the next time that they look it up.
+        """
+        cache.set(key, self.serializer.dumps(value), timeout)
+        if self.max_entries:
+            self.invalidate_local([key])
+            self.broadcast.publish([key])
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        cache.delete_many(keys)
+        if self.max_entries:
+            self.invalidate_local(keys)
+            self.broadcast.publish(keys)
+
+    def get_local(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+
+            expires, data = entry
+            if expires < time.time():
+                return None
+
+            # Move the key to the most recently used end.
+            self.entries[key] = entry
+        return data
+
+    def set_local(self, key, data):
+        # Listen for invalidations before holding on to anything.
+        self.broadcast
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.timeout, data)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate_local(self, keys):
+        """
+        Drop the given keys from the local tier, or everything if keys is
+        None.
+        """
+        with self.lock:
+            if keys is None:
+                self.entries.clear()
+            else:
+                for key in keys:
+                    self.entries.pop(key, None)
+
+
+tiered_cache = TieredCache()
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from sa_api import metrics
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--reset', action='store_true', dest='reset', default=False,
+            help='Reset the counters to zero after printing them.'),
+    )
+    help = 'Print the counters that measure the API response cache.'
+
+    def handle(self, *args, **options):
+        names = [name for name, _ in metrics.COUNTERS]
+        values = metrics.get_many(names)
+
+        for name, description in metrics.COUNTERS:
+            self.stdout.write('%s: %s\n' % (description, values[name]))
+
+        if options['reset']:
+            metrics.reset(names)
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from sa_api import export
+from sa_api import models
+import sys
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--type', default='places', dest='thing_type',
+            help='Export "places", "submissions", or the submissions of a '
+                 'particular type (e.g. "comments"). Defaults to "places".'),
+        make_option('--format', default='ndjson', dest='format',
+            help='One of %s. Defaults to "ndjson".' % ', '.join(export.EXPORT_FORMATS)),
+        make_option('--after', default=None, dest='after', type='int',
+            help='Only export things with ids greater than the given id, to '
+                 'resume an interrupted export.'),
+        make_option('--all', action='store_true', dest='include_invisible', default=False,
+            help='Include invisible places and submissions.'),
+        make_option('--private', action='store_true', dest='include_private', default=False,
+            help='Include private data.'),
+        make_option('--url-root', default='', dest='url_root',
+            help='A scheme and host (e.g. "http://api.shareabouts.org") to '
+                 'make the URLs in the export absolute.'),
+        make_option('--gzip', action='store_true', dest='gzip', default=False,
+            help='Compress the output with gzip.'),
+        make_option('-o', '--output', default=None, dest='output',
+            help='The file to write the export to. Defaults to stdout.'),
+    )
+    help = 'Stream the places or submissions in a dataset to a file.'
+    args = '<owner> <dataset>'
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Specify the owner and slug of the dataset to export.')
+
+        owner, slug = args
+        try:
+            dataset = models.DataSet.objects.select_related('owner').get(owner__username=owner, slug=slug)
+        except models.DataSet.DoesNotExist:
+            raise CommandError('No dataset "%s" owned by "%s".' % (slug, owner))
+
+        if options['format'] not in export.EXPORT_FORMATS:
+            raise CommandError('Unknown export format "%s".' % options['format'])
+
+        content = export.export_things(
+            dataset, options['thing_type'], options['format'],
+            after=options['after'],
+            include_invisible=options['include_invisible'],
+            include_private=options['include_private'],
+            url_root=options['url_root'])
+
+        if options['gzip']:
+            content = export.gzip_stream(content)
+
+        outfile = open(options['output'], 'ab' if options['after'] else 'wb') \
+            if options['output'] else sys.stdout
+        try:
+            for chunk in content:
+                outfile.write(chunk)
+        finally:
+            if outfile is not sys.stdout:
+                outfile.close()
@@ -0,0 +1,61 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from sa_api import models
+from sa_api import synthetic
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--owners', action='store', type='int', dest='owners', default=1,
+            help='The number of owners to generate datasets for.  Defaults to 1.'),
+        make_option('--datasets', action='store', type='int', dest='datasets', default=1,
+            help='The number of datasets to generate for each owner.  Defaults to 1.'),
+        make_option('--places', action='store', type='int', dest='places', default=1000,
+            help='The number of places in each dataset.  Defaults to 1000.'),
+        make_option('--submissions', action='store', type='int', dest='submissions', default=10000,
+            help='The number of submissions (comments and support) in each '
+                 'dataset.  Defaults to 10000.'),
+        make_option('--attachments', action='store', type='float', dest='attachments', default=0.05,
+            help='The share of places that have an attachment.  Defaults to 0.05.'),
+        make_option('--no-activity', action='store_false', dest='activity', default=True,
+            help="Don't generate the activity history."),
+        make_option('--alpha', action='store', type='float', dest='alpha', default=1.2,
+            help='The shape of the power law that submissions are spread '
+                 'over places with; lower is more skewed.  Defaults to 1.2.'),
+        make_option('--prefix', action='store', dest='prefix', default='synthetic',
+            help='The prefix of the generated owner names and dataset '
+                 'slugs (e.g., "synthetic-1").  Defaults to "synthetic".'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=5000,
+            help='The number of rows to insert at a time.  Defaults to 5000.'),
+        make_option('--seed', action='store', type='int', dest='seed', default=None,
+            help='Seed the random numbers, to generate the same data again.'),
+    )
+    help = ('Generate owners with large, realistic datasets, for benchmarks '
+            'and query plan checks.')
+
+    def handle(self, *args, **options):
+        generator = synthetic.DataSetGenerator(
+            places=options['places'],
+            submissions=options['submissions'],
+            attachment_share=options['attachments'],
+            activity=options['activity'],
+            alpha=options['alpha'],
+            batch_size=options['batch_size'],
+            seed=options['seed'],
+            log=lambda message: self.stdout.write('  %s\n' % message))
+
+        names = []
+        for owner_number in xrange(1, options['owners'] + 1):
+            owner = '%s-%s' % (options['prefix'], owner_number)
+            for dataset_number in xrange(1, options['datasets'] + 1):
+                slug = '%s-%s' % (options['prefix'], dataset_number)
+                if models.DataSet.objects.filter(owner__username=owner, slug=slug).exists():
+                    raise CommandError('The dataset %s/%s already exists.' % (owner, slug))
+                names.append((owner, slug))
+
+        for owner, slug in names:
+            self.stdout.write('%s/%s\n' % (owner, slug))
+            start_time = time.time()
+            generator.generate(owner, slug)
+            self.stdout.write('  Done in %0.1fs\n' % (time.time() - start_time))
@@ -0,0 +1,106 @@
+import json
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from sa_api import replay
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrency', action='store', type='int', dest='concurrency', default=1,
+            help='The number of requests to send at once.  Defaults to 1.'),
+        make_option('--url', action='store', dest='url', default=None,
+            help='Send the requests to the server at this URL (e.g., '
+                 '"http://localhost:8000", for a local gunicorn using the '
+                 'same database) instead of through the test client in '
+                 'this process.'),
+        make_option('--header', action='append', dest='headers', default=[],
+            help='A "<Name>: <value>" header to send to the server with '
+                 'each request.  May be given more than once.'),
+        make_option('--limit', action='store', type='int', dest='limit', default=None,
+            help='Replay at most this many requests.'),
+        make_option('--read-only', action='store_true', dest='read_only', default=False,
+            help='Skip the requests that would change the fixture dataset.'),
+        make_option('--owner', action='store', dest='owner', default='replay',
+            help='The owner of the fixture dataset.  Defaults to "replay".'),
+        make_option('--dataset', action='store', dest='dataset', default='replay',
+            help='The slug of the fixture dataset.  Defaults to "replay".'),
+        make_option('--places', action='store', type='int', dest='places', default=100,
+            help='The number of places to put in the fixture dataset, if '
+                 'it has to be created.  Defaults to 100.'),
+        make_option('--output', action='store', dest='output', default=None,
+            help='Also write the summary of the replay, as JSON, to this file.'),
+    )
+    help = ('Replay the requests in API traces (nginx access logs, "<METHOD> '
+            '<path>" lines, or JSON lines) against a fixture dataset, and '
+            'report the throughput, and the response times and query counts '
+            'per URL name.  Reads the trace from standard input if no '
+            'files are given.')
+    args = '[<trace file> ...]'
+
+    def read_requests(self, paths, limit=None):
+        files = [open(path) for path in paths] or [sys.stdin]
+        requests = []
+        for trace_file in files:
+            for traced in replay.read_trace(trace_file):
+                if limit is not None and len(requests) >= limit:
+                    return requests
+                requests.append(traced)
+        return requests
+
+    def get_sender(self, options):
+        if options['url'] is None:
+            return replay.InProcessSender()
+
+        headers = {}
+        for header in options['headers']:
+            name, _, value = header.partition(':')
+            if not value:
+                raise CommandError('Give headers as "<Name>: <value>", not "%s".' % header)
+            headers[name.strip()] = value.strip()
+        return replay.HttpSender(options['url'], headers)
+
+    def handle(self, *args, **options):
+        fixture = replay.Fixture.create(options['owner'], options['dataset'],
+                                        places=options['places'])
+
+        mapped_requests = []
+        skipped = 0
+        for traced in self.read_requests(args, options['limit']):
+            if options['read_only'] and traced.method not in replay.SAFE_METHODS:
+                skipped += 1
+                continue
+            mapped = fixture.map_request(traced)
+            if mapped is None:
+                skipped += 1
+                continue
+            mapped_requests.append(mapped)
+
+        if not mapped_requests:
+            raise CommandError('There are no API requests to replay.')
+
+        results, seconds = replay.replay(mapped_requests, self.get_sender(options),
+                                         options['concurrency'])
+        summary = replay.summarize(results, seconds)
+        summary['skipped'] = skipped
+        self.write_summary(summary)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(summary, output, indent=2, sort_keys=True)
+
+    def write_summary(self, summary):
+        self.stdout.write('%s requests in %0.2fs (%0.1f per second); %s skipped\n' % (
+            summary['count'], summary['seconds'], summary['throughput'], summary['skipped']))
+        self.stdout.write('%-45s %6s %8s %8s %8s %8s  %s\n' % (
+            'URL name', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'statuses'))
+
+        rows = [(url_name, stats) for url_name, stats in summary['url_names'].items()]
+        rows.append(('(all)', summary))
+        for url_name, stats in sorted(rows):
+            queries = '%0.1f' % stats['queries'] if stats['queries'] is not None else '-'
+            statuses = ', '.join(['%s: %s' % (status, count)
+                                  for status, count in sorted(stats['statuses'].items())])
+            self.stdout.write('%-45s %6s %8.1f %8.1f %8.1f %8s  %s\n' % (
+                url_name, stats['count'], stats['p50'] * 1000, stats['p95'] * 1000,
+                stats['p99'] * 1000, queries, statuses))
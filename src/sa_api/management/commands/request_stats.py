@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from sa_api import instrumentation
+from sa_api import metrics
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--reset', action='store_true', dest='reset', default=False,
+            help='Reset the histograms to zero after printing them.'),
+    )
+    help = ('Print the histograms of how long each view takes to respond, '
+            'and how the time was spent.  Counts are only added up every '
+            'so many requests per server process.')
+
+    def handle(self, *args, **options):
+        for view in sorted(instrumentation.get_view_names()):
+            stats = instrumentation.get_view_stats(view)
+            if not stats['count']:
+                continue
+
+            self.stdout.write('%s: %s requests\n' % (view, stats['count']))
+            for bucket, count in stats['buckets']:
+                label = ('<= %ss' % bucket) if bucket != 'inf' else 'longer'
+                self.stdout.write('  %s: %s\n' % (label, count))
+            for phase, seconds in stats['seconds']:
+                self.stdout.write('  %s: %0.1fms per request\n' % (
+                    phase, seconds * 1000 / stats['count']))
+
+            if options['reset']:
+                metrics.reset(instrumentation.get_metric_names(view))
@@ -0,0 +1,88 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+from optparse import make_option
+from sa_api import benchmarks
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--places', action='store', type='int', dest='places', default=200,
+            help='The number of places in the benchmark dataset.  Defaults to 200.'),
+        make_option('--submissions', action='store', type='int', dest='submissions', default=1000,
+            help='The number of submissions in the benchmark dataset.  Defaults to 1000.'),
+        make_option('--repeat', action='store', type='int', dest='repeat', default=5,
+            help='The number of times to time each benchmark.  Defaults to 5.'),
+        make_option('--save', action='store', dest='save', default=None,
+            help='Save the results as a baseline in this file.'),
+        make_option('--compare', action='store', dest='compare', default=None,
+            help='Compare the results with the baseline in this file, and '
+                 'fail if any benchmark got slower than the tolerance allows.'),
+        make_option('--tolerance', action='store', type='float', dest='tolerance', default=0.25,
+            help='How much slower than the baseline a benchmark may get '
+                 '(e.g., 0.25 for 25%).  Defaults to 0.25.'),
+    )
+    help = ('Time the serialization, rendering, caching, invalidation and '
+            'authentication hot paths of the API against a synthetic dataset '
+            '(generated for the run in a transaction that is rolled back '
+            'afterwards, so nothing is left in the database).  Give the names '
+            'of benchmarks (or of groups, like "clear_instance") to run only '
+            'those.')
+    args = '[<benchmark> ...]'
+
+    def handle(self, *args, **options):
+        selected = benchmarks.get_benchmarks(args)
+        if not selected:
+            raise CommandError('There are no benchmarks named %s.' % ', '.join(args))
+
+        baseline = None
+        if options['compare']:
+            baseline = benchmarks.load_baseline(options['compare'])
+
+        scale = {'places': options['places'], 'submissions': options['submissions']}
+        if baseline is not None and baseline['scale'] != scale:
+            raise CommandError('The baseline is for %(places)s places and %(submissions)s '
+                               'submissions; run with the same scale to compare.' % baseline['scale'])
+
+        results = self.run_benchmarks(selected, options)
+        changes, regressions = {}, []
+        if baseline is not None:
+            changes, regressions = benchmarks.compare(results, baseline['results'], options['tolerance'])
+
+        self.stdout.write('%-32s %10s %10s %10s\n' % ('benchmark', 'best ms', 'median ms', 'change'))
+        for name, _ in selected:
+            change = changes.get(name)
+            self.stdout.write('%-32s %10.2f %10.2f %10s\n' % (
+                name, results[name]['best'] * 1000, results[name]['median'] * 1000,
+                ('%+.0f%%' % ((change - 1) * 100)) if change is not None else '-'))
+
+        if options['save']:
+            benchmarks.save_baseline(options['save'], scale, results)
+
+        if regressions:
+            raise CommandError('Slower than the baseline: %s' % ', '.join(regressions))
+
+    @transaction.commit_manually
+    def run_benchmarks(self, selected, options):
+        """
+        Run the benchmarks against a synthetic dataset that is never
+        committed: whether or not they succeed, the transaction is rolled
+        back and the dataset's responses are cleared from the cache.
+
+        Cache warming is turned off, since the warmer's own connection
+        can't see the uncommitted dataset.
+        """
+        context = None
+        try:
+            with override_settings(API_CACHE_WARM_COUNT=0):
+                context = benchmarks.Context(options['places'], options['submissions'])
+                results = {}
+                for name, func in selected:
+                    results[name] = benchmarks.run_benchmark(func, context, options['repeat'])
+            return results
+        finally:
+            try:
+                if context is not None:
+                    context.dataset.cache.clear_instance(context.dataset, warm=False)
+            finally:
+                transaction.rollback()
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from optparse import make_option
+from sa_api import models
+from sa_api import warming
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='append', dest='formats', default=[],
+            help='A format (e.g. "json" or "csv") to warm the responses '
+                 'in.  May be given more than once.  Defaults to "json", '
+                 'which JSONP responses are made from too.'),
+        make_option('--path', action='append', dest='paths', default=[],
+            help='Also warm the response for this API path (with an '
+                 'optional query string).  May be given more than once.'),
+    )
+    help = ('Prime the API response cache (e.g., after a deploy or a cache '
+            'restart) with the dataset, places and activity of the given '
+            'datasets, or of all datasets.')
+    args = '[<owner>/<dataset> ...]'
+
+    def get_datasets(self, names):
+        datasets = models.DataSet.objects.select_related('owner')
+        if not names:
+            return datasets.all()
+
+        selected = []
+        for name in names:
+            try:
+                owner, slug = name.split('/')
+                selected.append(datasets.get(owner__username=owner, slug=slug))
+            except ValueError:
+                raise CommandError('Name datasets as <owner>/<dataset>, not "%s".' % name)
+            except models.DataSet.DoesNotExist:
+                raise CommandError('No dataset "%s".' % name)
+        return selected
+
+    def get_paths(self, dataset):
+        args = [dataset.owner.username, dataset.slug]
+        return [
+            reverse('dataset_instance_by_user', args=args),
+            reverse('place_collection_by_dataset', args=args),
+            reverse('activity_collection_by_dataset', args=args),
+        ]
+
+    def handle(self, *args, **options):
+        paths = list(options['paths'])
+        for dataset in self.get_datasets(args):
+            paths.extend(self.get_paths(dataset))
+
+        for path in paths:
+            path, _, querystring = path.partition('?')
+            for format in options['formats'] or ['json']:
+                key = ':'.join([path, format, querystring])
+                status = warming.warm_key(key)
+                if status is None:
+                    self.stderr.write('%s is not an API path\n' % path)
+                    break
+                self.stdout.write('%s %s (%s)\n' % (status, path, format))
@@ -0,0 +1,139 @@
+"""
+Counters for measuring the API's caching.  The counters are kept in the
+shared cache, so that they add up the counts from all of the server
+processes.
+
+Events on the response path are counted with count(), which adds them up
+in-process and adds them to the shared counters every so often, so that
+counting doesn't cost a round trip to the shared cache per event.  incr()
+adds to a shared counter right away.
+"""
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import cache
+from . import cache_serializers
+
+import logging
+logger = logging.getLogger('sa_api.metrics')
+
+
+KEY_PREFIX = 'sa_api_metrics:'
+
+# The counters that measure the API response cache, and what they count.
+COUNTERS = (
+    ('cache_hits', 'Responses served fresh from the cache'),
+    ('cache_misses', 'Responses rebuilt'),
+    ('cache_data_hits', 'Responses rendered from data cached for another format'),
+    ('cache_stale_hits', 'Stale responses served while another worker rebuilt them'),
+    ('cache_lock_waits', 'Responses served after waiting for another worker to rebuild them'),
+    ('cache_lock_timeouts', 'Responses rebuilt after waiting too long for another worker'),
+    ('cache_uncacheable', 'Responses to GET requests that could not be cached'),
+    ('cache_entries_compressed', 'Responses stored compressed in the cache'),
+    ('cache_bytes_saved', 'Bytes of cache memory saved by compression'),
+    ('responses_compressed', 'Compressed responses served from the cache'),
+    ('response_bytes_saved', 'Bytes of response bodies saved by compression'),
+    ('cache_keys_warmed', 'Invalidated responses re-rendered in the background'),
+    ('local_cache_hits', 'Lookups served from the in-process cache'),
+    ('local_cache_misses', 'Lookups not in the in-process cache'),
+    ('shared_cache_hits', 'Of those, lookups served from the shared cache'),
+    ('shared_cache_misses', 'Lookups in neither cache'),
+    ('host_cache_hits', 'Responses read from the host cache'),
+    ('host_cache_misses', 'Responses copied into the host cache from the shared cache'),
+)
+
+
+def incr(name, delta=1):
+    key = KEY_PREFIX + name
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # The counter doesn't exist yet (or has expired).
+        if not cache.add(key, delta, settings.API_CACHE_TIMEOUT):
+            cache.incr(key, delta)
+
+
+class Counts (object):
+    """
+    Counts that are added up in-process, and added to the shared counters
+    after every flush_counts_every events, or once flush_interval seconds
+    have passed since they were last added.
+    """
+    flush_counts_every = 100
+    flush_interval = 10
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.names = defaultdict(set)
+        self.events = 0
+        self.last_flush = time.time()
+
+    def count(self, name, delta=1):
+        self.count_many({name: delta})
+
+    def count_many(self, deltas, names=None):
+        """
+        Add up several counts for one event.  names maps groups to names
+        to register in them (see register_names) along with the counts.
+        """
+        with self.lock:
+            for name, delta in deltas.items():
+                self.counts[name] += delta
+            for group, group_names in (names or {}).items():
+                self.names[group].update(group_names)
+            self.events += 1
+            full = (self.events >= self.flush_counts_every or
+                    time.time() - self.last_flush >= self.flush_interval)
+        if full:
+            self.flush_counts()
+
+    def flush_counts(self):
+        with self.lock:
+            counts, self.counts, self.events = self.counts, defaultdict(int), 0
+            names, self.names = self.names, defaultdict(set)
+            self.last_flush = time.time()
+
+        try:
+            for name, delta in counts.items():
+                incr(name, delta)
+            for group, group_names in names.items():
+                register_names(group, group_names)
+        except Exception:
+            logger.exception('Failed to record the counts')
+
+
+counts = Counts()
+
+
+def count(name, delta=1):
+    counts.count(name, delta)
+
+
+def get(name):
+    return cache.get(KEY_PREFIX + name) or 0
+
+
+def get_many(names):
+    values = cache.get_many([KEY_PREFIX + name for name in names])
+    return dict([(name, values.get(KEY_PREFIX + name) or 0) for name in names])
+
+
+def reset(names):
+    cache.delete_many([KEY_PREFIX + name for name in names])
+
+
+def get_names(group):
+    """
+    Get the names registered in a group (e.g., the names of the views that
+    have been timed), for metrics that are kept per name.
+    """
+    return cache_serializers.loads(cache.get(KEY_PREFIX + group), set())
+
+
+def register_names(group, names):
+    if set(names) - get_names(group):
+        cache.set(KEY_PREFIX + group,
+                  cache_serializers.dumps(set(names) | get_names(group)),
+                  settings.API_CACHE_TIMEOUT)
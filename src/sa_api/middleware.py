@@ -1,16 +1,29 @@
+import random
 import time
 import logging
+import traceback
+import urllib
+import urlparse
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from djangorestframework.authentication import BasicAuthentication
+from . import instrumentation
+from . import profiler
+from . import replay
 
 class RequestTimeLogger (object):
     def process_request(self, request):
-        self.start_time = time.time()
+        # Keep the start time on the request; the middleware instance is
+        # shared by every request (and thread).
+        request.start_time = time.time()
 
     def process_response(self, request, response):
         # NOTE: If there was some exception, or some other reason that the
         # process_request method was not called, we won't know the start time.
         # Check that we know it first.
-        if hasattr(self, 'start_time'):
-            duration = time.time() - self.start_time
+        if hasattr(request, 'start_time'):
+            duration = time.time() - request.start_time
 
             # Log the time information
             logger = logging.getLogger('utils.request_timer')
@@ -22,3 +35,183 @@ class RequestTimeLogger (object):
             ))
 
         return response
+
+
+class RequestInstrumentation (object):
+    """
+    Profiles each request (see sa_api.instrumentation).  Put it first in the
+    middleware, so that the profile covers the rest of the middleware too.
+    """
+    def __init__(self):
+        instrumentation.install()
+
+    def process_request(self, request):
+        request.profile = instrumentation.start()
+        if settings.API_TRACE_FILE:
+            request.profile.trace()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, 'profile'):
+            request.profile.view_name = getattr(view_func, '__name__', None)
+
+    def process_response(self, request, response):
+        if not hasattr(request, 'profile'):
+            return response
+
+        profile = request.profile
+        instrumentation.finish(profile)
+
+        user = getattr(request, 'user', None)
+        if settings.DEBUG or profile.show_timing or getattr(user, 'is_superuser', False):
+            response['Server-Timing'] = profile.server_timing()
+
+        if profile.spans is not None and profile.duration >= settings.API_TRACE_MIN_DURATION:
+            try:
+                instrumentation.trace_log.write(instrumentation.get_trace(profile, request, response))
+            except IOError:
+                logging.getLogger('sa_api.instrumentation').exception('Could not write the request trace')
+
+        return response
+
+
+class RepeatedQueryDetector (object):
+    """
+    Logs the queries that a request makes over and over with different
+    literals (more than API_REPEATED_QUERY_THRESHOLD times), along with the
+    stack that made them -- usually a lazy load of a related object (like a
+    place's dataset) per row.  Meant for development and staging; it is only
+    used when the threshold is set.  Put it after RequestInstrumentation.
+    """
+    def __init__(self):
+        if not settings.API_REPEATED_QUERY_THRESHOLD:
+            raise MiddlewareNotUsed()
+        instrumentation.install()
+
+    def process_request(self, request):
+        instrumentation.record_queries()
+
+    def process_response(self, request, response):
+        profile = getattr(request, 'profile', None)
+        if profile is None or profile.queries is None:
+            return response
+
+        threshold = settings.API_REPEATED_QUERY_THRESHOLD
+        logger = logging.getLogger('sa_api.repeated_queries')
+        for sql, count, stack in instrumentation.find_repeated_queries(profile.queries, threshold):
+            logger.warning('"%s %s" made %s queries like: %s\n%s' % (
+                request.method, request.get_full_path(), count, sql,
+                ''.join(traceback.format_list(stack)).rstrip()))
+
+        return response
+
+
+class RequestProfiler (object):
+    """
+    Sends superusers the cProfile profile of an API request instead of its
+    response, when they ask for one with ?_profile=<format> or an
+    X-Shareabouts-Profile header (see sa_api.profiler for the formats).
+    Put it after the authentication middleware.
+    """
+    param = '_profile'
+    header = 'HTTP_X_SHAREABOUTS_PROFILE'
+
+    def get_profile_format(self, request):
+        if self.param in request.GET:
+            profile_format = request.GET[self.param]
+        else:
+            profile_format = request.META.get(self.header)
+        if profile_format is None:
+            return None
+        return profile_format if profile_format in profiler.FORMATS else 'stats'
+
+    def remove_param(self, request):
+        """
+        Take the profile parameter out of the request, so that it doesn't
+        filter the response data, or change its cache key.
+        """
+        get_params = request.GET.copy()
+        get_params.pop(self.param)
+        request.GET = get_params
+
+        params = urlparse.parse_qsl(request.META.get('QUERY_STRING', ''), keep_blank_values=True)
+        request.META['QUERY_STRING'] = urllib.urlencode(
+            [(name, value) for name, value in params if name != self.param])
+
+    def is_superuser(self, request):
+        user = getattr(request, 'user', None)
+        if getattr(user, 'is_superuser', False):
+            return True
+        user = BasicAuthentication(None).authenticate(request)
+        return getattr(user, 'is_superuser', False)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profile_format = self.get_profile_format(request)
+        if profile_format is None:
+            return None
+        if self.param in request.GET:
+            self.remove_param(request)
+        # A rate limit of 0 turns profiling off.
+        if not settings.API_PROFILE_RATE_LIMIT:
+            return None
+        if not getattr(view_func, '__module__', '').startswith('sa_api.'):
+            return None
+        if not self.is_superuser(request):
+            return None
+
+        if not profiler.rate_limit.acquire():
+            return HttpResponse('Too many requests are being profiled; try again in a minute.\n',
+                                status=429, content_type='text/plain')
+        try:
+            def respond():
+                response = view_func(request, *view_args, **view_kwargs)
+                # Read streamed responses as well.
+                response.content
+                return response
+
+            request_profiler, response = profiler.profile_call(respond)
+        finally:
+            profiler.rate_limit.release()
+
+        profile = instrumentation.current()
+        phases = profile.server_timing() if profile is not None else None
+        profiled = HttpResponse(profiler.format_profile(request_profiler, profile_format, phases),
+                                content_type=profiler.CONTENT_TYPES[profile_format])
+        if profile_format == 'pstats':
+            profiled['Content-Disposition'] = 'attachment; filename=request.pstats'
+        profiled['X-Shareabouts-Profiled-Status'] = str(response.status_code)
+        return profiled
+
+
+class RequestCapture (object):
+    """
+    Records a sample (API_CAPTURE_SAMPLE_RATE) of the API requests to the
+    API_CAPTURE_FILE, as JSON lines that the replay_requests command can
+    replay, with private fields and keys redacted (see sa_api.replay).  It
+    is only used when the file is set.
+    """
+    def __init__(self):
+        if not settings.API_CAPTURE_FILE:
+            raise MiddlewareNotUsed()
+
+    def process_request(self, request):
+        if random.random() >= settings.API_CAPTURE_SAMPLE_RATE:
+            return
+
+        request.capture_start_time = time.time()
+        request.capture_content_type = replay.get_captured_content_type(request)
+        # Read the body before the view does, so that it's kept.
+        request.capture_body = request.body if request.capture_content_type else None
+
+    def process_response(self, request, response):
+        if not hasattr(request, 'capture_start_time'):
+            return response
+
+        seconds = time.time() - request.capture_start_time
+        try:
+            capture = replay.get_capture(request, response, seconds,
+                                         request.capture_body, request.capture_content_type)
+            if capture is not None:
+                replay.capture_log.write(capture)
+        except IOError:
+            logging.getLogger('sa_api.replay').exception('Could not write the request capture')
+        return response
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'DataSetSummary'
+        db.create_table('sa_api_datasetsummary', (
+            ('dataset', self.gf('django.db.models.fields.related.OneToOneField')(related_name='summary', unique=True, primary_key=True, to=orm['sa_api.DataSet'])),
+            ('place_count', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('submission_counts', self.gf('django.db.models.fields.TextField')(default='{}')),
+            ('attribute_keys', self.gf('django.db.models.fields.TextField')(default='[]')),
+            ('min_lng', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('min_lat', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('max_lng', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('max_lat', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('last_modified', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+        ))
+        db.send_create_signal('sa_api', ['DataSetSummary'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'DataSetSummary'
+        db.delete_table('sa_api_datasetsummary')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'sa_api.activity': {
+            'Meta': {'object_name': 'Activity'},
+            'action': ('django.db.models.fields.CharField', [], {'default': "'create'", 'max_length': '16'}),
+            'created_datetime': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'data': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sa_api.SubmittedThing']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'updated_datetime': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        },
+        'sa_api.attachment': {
+            'Meta': {'object_name': 'Attachment'},
+            'created_datetime': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'file': ('django.db.models.fields.files.FileField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '128', 'null': 'True', 'blank': 'True'}),
+            'thing': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'attachments'", 'to': "orm['sa_api.SubmittedThing']"}),
+            'updated_datetime': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        },
+        'sa_api.dataset': {
+            'Meta': {'unique_together': "(('owner', 'slug'),)", 'object_name': 'DataSet'},
+            'display_name': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'owner': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'slug': ('django.db.models.fields.SlugField', [], {'default': "u''", 'max_length': '128'})
+        },
+        'sa_api.datasetsummary': {
+            'Meta': {'object_name': 'DataSetSummary'},
+            'attribute_keys': ('django.db.models.fields.TextField', [], {'default': "'[]'"}),
+            'dataset': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'summary'", 'unique': 'True', 'primary_key': 'True', 'to': "orm['sa_api.DataSet']"}),
+            'last_modified': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'max_lat': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'max_lng': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'min_lat': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'min_lng': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'place_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'submission_counts': ('django.db.models.fields.TextField', [], {'default': "'{}'"})
+        },
+        'sa_api.place': {
+            'Meta': {'object_name': 'Place', '_ormbases': ['sa_api.SubmittedThing']},
+            'location': ('django.contrib.gis.db.models.fields.PointField', [], {}),
+            'submittedthing_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['sa_api.SubmittedThing']", 'unique': 'True', 'primary_key': 'True'})
+        },
+        'sa_api.submission': {
+            'Meta': {'object_name': 'Submission', '_ormbases': ['sa_api.SubmittedThing']},
+            'parent': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'children'", 'to': "orm['sa_api.SubmissionSet']"}),
+            'submittedthing_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['sa_api.SubmittedThing']", 'unique': 'True', 'primary_key': 'True'})
+        },
+        'sa_api.submissionset': {
+            'Meta': {'unique_together': "(('place', 'submission_type'),)", 'object_name': 'SubmissionSet'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'place': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'submission_sets'", 'to': "orm['sa_api.Place']"}),
+            'submission_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'submission_type': ('django.db.models.fields.CharField', [], {'max_length': '128'})
+        },
+        'sa_api.submittedthing': {
+            'Meta': {'object_name': 'SubmittedThing'},
+            'created_datetime': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'data': ('django.db.models.fields.TextField', [], {'default': "'{}'"}),
+            'dataset': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'submitted_thing_set'", 'blank': 'True', 'to': "orm['sa_api.DataSet']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'submitter_name': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            'updated_datetime': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'visible': ('django.db.models.fields.BooleanField', [], {'default': 'True'})
+        }
+    }
+
+    complete_apps = ['sa_api']
\ No newline at end of file
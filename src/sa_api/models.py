@@ -1,10 +1,18 @@
 from django.contrib.auth.models import User
 from django.contrib.gis.db import models
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.files.storage import get_storage_class
 from django.core.urlresolvers import reverse
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max, Sum
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from . import cache
 from . import utils
+from . import warming
+import json
 
 
 class TimeStampedModel (models.Model):
@@ -25,10 +33,18 @@ class CacheClearingModel (object):
         return result
 
     def delete(self, *args, **kwargs):
+        invalidated = None
         if hasattr(self, 'cache'):
-            self.cache.clear_instance(self)
+            invalidated = self.cache.clear_instance(self, warm=False)
+
+        result = super(CacheClearingModel, self).delete(*args, **kwargs)
 
-        return super(CacheClearingModel, self).delete(*args, **kwargs)
+        # Only re-render the cleared responses once the instance is gone, so
+        # that it isn't cached in them again.
+        if invalidated:
+            warming.schedule_invalidated(invalidated)
+
+        return result
 
 
 class ModelWithDataBlob (models.Model):
@@ -118,6 +134,10 @@ class SubmissionSet (CacheClearingModel, models.Model):
     place = models.ForeignKey(Place, related_name='submission_sets')
     submission_type = models.CharField(max_length=128)
 
+    # The number of submissions in the set, kept up to date as submissions
+    # are added and removed (see Submission.count_in_parent).
+    submission_count = models.PositiveIntegerField(default=0)
+
     cache = cache.SubmissionSetCache()
 
     class Meta(object):
@@ -135,6 +155,249 @@ class Submission (SubmittedThing):
 
     cache = cache.SubmissionCache()
 
+    def count_in_parent(self, delta):
+        """
+        Add delta to the submission count of the submission's set, in the
+        database and in the cached submission sets map.
+        """
+        SubmissionSet.objects.filter(pk=self.parent_id)\
+            .update(submission_count=F('submission_count') + delta)
+        self.cache.count_submissions(self, delta)
+
+
+# The counts are updated from signals, so that a new submission is counted
+# before the cached responses that include its set are cleared.
+@receiver(post_save, sender=Submission)
+def count_new_submission(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        instance.count_in_parent(1)
+
+
+@receiver(post_delete, sender=Submission)
+def uncount_deleted_submission(sender, instance, **kwargs):
+    instance.count_in_parent(-1)
+
+
+def get_data_keys(data):
+    data = json.loads(data)
+    return set(data) if isinstance(data, dict) else set()
+
+
+class DataSetSummary (models.Model):
+    """
+    Totals and bounds for a dataset -- how many places and submissions of
+    each type it has, the extent of its places, the attributes that have
+    been used in it, and when it was last changed -- that are kept up to
+    date as its places and submissions are written, so that they can be read
+    without scanning the dataset.
+
+    The extent and the attributes only grow; they bound what's in the
+    dataset.  A summary is calculated from scratch the first time that it is
+    needed.
+
+    Each change locks the summary's row (see record_change), so the writes
+    to one dataset wait for each other's summary updates, until the end of
+    their transactions.  The changes (merging attribute keys and counts,
+    growing the extent) can't be made as single UPDATE statements, and the
+    writes to a dataset come from its users' submissions, which are rarely
+    frequent enough for the lock to matter.
+    """
+    dataset = models.OneToOneField(DataSet, related_name='summary', primary_key=True)
+    place_count = models.PositiveIntegerField(default=0)
+    submission_counts = models.TextField(default='{}')
+    attribute_keys = models.TextField(default='[]')
+    min_lng = models.FloatField(null=True, blank=True)
+    min_lat = models.FloatField(null=True, blank=True)
+    max_lng = models.FloatField(null=True, blank=True)
+    max_lat = models.FloatField(null=True, blank=True)
+    last_modified = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def calculate(cls, dataset_id):
+        summary = cls(dataset_id=dataset_id)
+
+        places = Place.objects.filter(dataset_id=dataset_id)
+        summary.place_count = places.count()
+        if summary.place_count:
+            summary.min_lng, summary.min_lat, summary.max_lng, summary.max_lat = places.extent()
+
+        submission_sets = SubmissionSet.objects.filter(place__dataset_id=dataset_id, submission_count__gt=0)
+        submission_counts = submission_sets.values('submission_type')\
+            .annotate(length=Sum('submission_count'))
+        summary.set_submission_counts(dict([(counts['submission_type'], counts['length'])
+                                            for counts in submission_counts]))
+
+        things = SubmittedThing.objects.filter(dataset_id=dataset_id)
+        summary.last_modified = things.aggregate(last_modified=Max('updated_datetime'))['last_modified']
+        attribute_keys = set()
+        for data in things.values_list('data', flat=True).iterator():
+            attribute_keys.update(get_data_keys(data))
+        summary.set_attribute_keys(attribute_keys)
+
+        return summary
+
+    @classmethod
+    def get_for_dataset(cls, dataset_id, for_update=False):
+        """
+        Get the dataset's summary, calculating it if it doesn't exist yet.
+        Return the summary (None if the dataset doesn't exist), and whether
+        it was just calculated.  With for_update, the summary's row is locked
+        until the end of the transaction.
+        """
+        summaries = cls.objects.select_for_update() if for_update else cls.objects
+        try:
+            return summaries.get(dataset_id=dataset_id), False
+        except cls.DoesNotExist:
+            pass
+
+        # The dataset may be being deleted, along with its places.
+        if not DataSet.objects.filter(pk=dataset_id).exists():
+            return None, True
+
+        summary = cls.calculate(dataset_id)
+        try:
+            sid = transaction.savepoint()
+            summary.save(force_insert=True)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Another process calculated it first.
+            transaction.savepoint_rollback(sid)
+            return summaries.get(dataset_id=dataset_id), False
+        return summary, True
+
+    @classmethod
+    def record_change(cls, thing, change):
+        """
+        Apply change (a function of the summary) to the summary of the
+        thing's dataset, and mark the dataset as modified.  A summary that
+        has to be calculated already includes the change.
+
+        Inside a caller's transaction, the change is made in a savepoint, so
+        that the caller's transaction is neither committed early nor rolled
+        back if the change fails.
+        """
+        if not transaction.is_managed():
+            with transaction.commit_on_success():
+                cls.apply_change(thing, change)
+            return
+
+        sid = transaction.savepoint()
+        try:
+            cls.apply_change(thing, change)
+        except:
+            transaction.savepoint_rollback(sid)
+            raise
+        transaction.savepoint_commit(sid)
+
+    @classmethod
+    def apply_change(cls, thing, change):
+        summary, calculated = cls.get_for_dataset(thing.dataset_id, for_update=True)
+        if not calculated:
+            change(summary)
+            summary.last_modified = timezone.now()
+            summary.save()
+
+    def get_submission_counts(self):
+        return json.loads(self.submission_counts)
+
+    def set_submission_counts(self, counts):
+        self.submission_counts = json.dumps(counts, sort_keys=True)
+
+    def count_submission(self, submission_type, delta):
+        counts = self.get_submission_counts()
+        counts[submission_type] = counts.get(submission_type, 0) + delta
+        if counts[submission_type] <= 0:
+            del counts[submission_type]
+        self.set_submission_counts(counts)
+
+    def get_attribute_keys(self):
+        return json.loads(self.attribute_keys)
+
+    def set_attribute_keys(self, keys):
+        self.attribute_keys = json.dumps(sorted(keys))
+
+    def add_attribute_keys(self, thing):
+        keys = get_data_keys(thing.data)
+        if not keys.issubset(self.get_attribute_keys()):
+            self.set_attribute_keys(keys.union(self.get_attribute_keys()))
+
+    def add_location(self, location):
+        self.min_lng = location.x if self.min_lng is None else min(self.min_lng, location.x)
+        self.min_lat = location.y if self.min_lat is None else min(self.min_lat, location.y)
+        self.max_lng = location.x if self.max_lng is None else max(self.max_lng, location.x)
+        self.max_lat = location.y if self.max_lat is None else max(self.max_lat, location.y)
+
+    def get_bbox(self):
+        if self.min_lng is None:
+            return None
+        return [self.min_lng, self.min_lat, self.max_lng, self.max_lat]
+
+    def document(self, include_private=False):
+        attribute_keys = self.get_attribute_keys()
+        if not include_private:
+            attribute_keys = [key for key in attribute_keys
+                              if not key.startswith('private-')]
+        return {
+            'places': {'length': self.place_count},
+            'submissions': self.get_submission_counts(),
+            'bbox': self.get_bbox(),
+            'attributes': attribute_keys,
+            'last_modified': self.last_modified,
+        }
+
+
+@receiver(post_save, sender=DataSet)
+def summarize_new_dataset(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        DataSetSummary.objects.create(dataset=instance)
+
+
+@receiver(post_save, sender=Place)
+def summarize_saved_place(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    def change(summary):
+        if created:
+            summary.place_count += 1
+        summary.add_location(instance.location)
+        summary.add_attribute_keys(instance)
+    DataSetSummary.record_change(instance, change)
+
+
+@receiver(post_delete, sender=Place)
+def summarize_deleted_place(sender, instance, **kwargs):
+    def change(summary):
+        summary.place_count = max(summary.place_count - 1, 0)
+    DataSetSummary.record_change(instance, change)
+
+
+@receiver(post_save, sender=Submission)
+def summarize_saved_submission(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    def change(summary):
+        if created:
+            summary.count_submission(instance.parent.submission_type, 1)
+        summary.add_attribute_keys(instance)
+    DataSetSummary.record_change(instance, change)
+
+
+@receiver(post_delete, sender=Submission)
+def summarize_deleted_submission(sender, instance, **kwargs):
+    try:
+        submission_type = instance.parent.submission_type
+    except ObjectDoesNotExist:
+        # The submission's set has been deleted along with it, so start the
+        # summary over.
+        DataSetSummary.objects.filter(dataset_id=instance.dataset_id).delete()
+        return
+
+    def change(summary):
+        summary.count_submission(submission_type, -1)
+    DataSetSummary.record_change(instance, change)
+
 
 class Activity (CacheClearingModel, TimeStampedModel):
     """
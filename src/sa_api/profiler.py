@@ -0,0 +1,211 @@
+"""
+On-demand profiling of single requests with cProfile (see
+middleware.RequestProfiler).
+
+A superuser adds ?_profile=<format> (or an X-Shareabouts-Profile header) to
+any API request, and gets back the profile of the request instead of its
+response, in one of these formats:
+
+* stats -- a summary of where the time went (by instrumentation phase, and
+  by component: DRF dispatch, serialization, rendering, cache and SQL),
+  followed by the pstats listing of the slowest functions.
+* collapsed -- "frame;frame;frame microseconds" lines for flamegraph.pl or
+  speedscope.  cProfile only records callers and callees, so each
+  function's time is split between the stacks that it was called from in
+  proportion to the time spent in it from each caller.
+* pstats -- the raw stats, for pstats, snakeviz or gprof2dot.
+
+Profiling is rate limited across all of the server processes, and only one
+request at a time is profiled in each process, so that it can be left on in
+production.
+"""
+import cProfile
+import marshal
+import pstats
+import threading
+import time
+from collections import defaultdict
+from StringIO import StringIO
+from django.conf import settings
+from django.core.cache import cache
+
+
+FORMATS = ('stats', 'collapsed', 'pstats')
+
+CONTENT_TYPES = {
+    'stats': 'text/plain; charset=utf-8',
+    'collapsed': 'text/plain; charset=utf-8',
+    'pstats': 'application/octet-stream',
+}
+
+RATE_KEY_PREFIX = 'request_profiles:'
+
+# The components that the time in a profile is split between, and the
+# strings that pick out their functions (from "<file>:<function name>").
+# The first component that matches a function gets its time.
+COMPONENTS = (
+    ('sql', ('django/db/', 'django/contrib/gis/db/', 'psycopg2')),
+    ('cache', ('django/core/cache/', 'redis', 'sa_api/cache.py', 'sa_api/localcache.py',
+               'sa_api/hostcache.py', 'sa_api/cache_serializers.py', 'zlib')),
+    ('serialization', ('sa_api/resources.py', 'djangorestframework/resources.py',
+                       'djangorestframework/serializer.py')),
+    ('rendering', ('sa_api/renderers.py', 'djangorestframework/renderers.py', 'json')),
+    ('drf dispatch', ('djangorestframework/',)),
+)
+
+# How many functions to list in the stats format.
+STATS_LIMIT = 60
+
+# How deep to follow the call graph for the collapsed format, and the least
+# time (in seconds) to give a stack of its own; the time of deeper or
+# quicker calls is counted as their callers' own.
+MAX_STACK_DEPTH = 64
+MIN_STACK_SECONDS = 0.00005
+
+
+def get_function_name(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return '%s:%s(%s)' % (filename, line, name)
+
+
+def get_component(func):
+    filename, line, name = func
+    described = '%s:%s' % (filename, name)
+    for component, patterns in COMPONENTS:
+        for pattern in patterns:
+            if pattern in described:
+                return component
+    return 'other'
+
+
+def get_component_times(stats):
+    """
+    Total the time spent in each component's own functions (not counting
+    the functions that they call), in seconds.
+    """
+    times = defaultdict(float)
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        times[get_component(func)] += tt
+    return dict(times)
+
+
+def format_stats(stats, phases=None):
+    """
+    Summarize a profile, and list its slowest functions by cumulative time.
+    """
+    output = StringIO()
+    if phases:
+        output.write('Phases: %s\n' % phases)
+
+    times = get_component_times(stats)
+    total = sum(times.values()) or 1
+    output.write('Time by component (excluding the functions that each calls):\n')
+    for component, seconds in sorted(times.items(), key=lambda item: -item[1]):
+        output.write('  %-14s %9.1f ms %5.1f%%\n' % (component, seconds * 1000, seconds * 100 / total))
+    output.write('\n')
+
+    stats.stream = output
+    stats.sort_stats('cumulative').print_stats(STATS_LIMIT)
+    return output.getvalue()
+
+
+def format_collapsed(stats):
+    """
+    Turn a profile into collapsed stacks, one "frame;frame;... microseconds"
+    line per stack.
+    """
+    callees = defaultdict(list)
+    roots = []
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers:
+            roots.append(func)
+        for caller, edge in callers.items():
+            # The edge's last item is the time spent in func when called
+            # from the caller.
+            callees[caller].append((func, edge[3]))
+
+    totals = defaultdict(float)
+
+    def walk(func, seconds, stack):
+        cc, nc, tt, ct, callers = stats.stats[func]
+        stack = stack + (get_function_name(func),)
+        share = (seconds / ct) if ct else 0
+        children = 0
+        if len(stack) < MAX_STACK_DEPTH:
+            for callee, callee_seconds in callees[func]:
+                callee_seconds *= share
+                if callee_seconds < MIN_STACK_SECONDS or get_function_name(callee) in stack:
+                    # Too quick, or recursion.
+                    continue
+                walk(callee, callee_seconds, stack)
+                children += callee_seconds
+        totals[stack] += max(seconds - children, 0)
+
+    for root in roots:
+        walk(root, stats.stats[root][3], ())
+
+    lines = ['%s %d' % (';'.join(stack), round(seconds * 1000000))
+             for stack, seconds in sorted(totals.items())
+             if round(seconds * 1000000) > 0]
+    return '\n'.join(lines) + '\n'
+
+
+def format_pstats(stats):
+    # The same format as pstats.Stats.dump_stats writes.
+    return marshal.dumps(stats.stats)
+
+
+def format_profile(profiler, profile_format, phases=None):
+    stats = pstats.Stats(profiler)
+    if profile_format == 'collapsed':
+        return format_collapsed(stats)
+    if profile_format == 'pstats':
+        return format_pstats(stats)
+    return format_stats(stats, phases)
+
+
+class RateLimit (object):
+    """
+    Lets through at most API_PROFILE_RATE_LIMIT profiled requests a minute
+    across all processes (counted in the shared cache), and one at a time in
+    this process.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        limit = settings.API_PROFILE_RATE_LIMIT
+        if not limit or not self.lock.acquire(False):
+            return False
+
+        key = RATE_KEY_PREFIX + str(int(time.time() // 60))
+        if cache.add(key, 1, 120):
+            count = 1
+        else:
+            try:
+                count = cache.incr(key)
+            except ValueError:
+                # The counter has just expired.
+                count = 1
+        if count > limit:
+            self.lock.release()
+            return False
+        return True
+
+    def release(self):
+        self.lock.release()
+
+
+rate_limit = RateLimit()
+
+
+def profile_call(func, *args, **kwargs):
+    """
+    Call a function under cProfile.  Returns the profiler and the function's
+    result.
+    """
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args, **kwargs)
+    return profiler, result
@@ -0,0 +1,159 @@
+"""
+The API's metrics in the Prometheus text exposition format (see
+views.MetricsView).
+
+The counts are the ones kept in the shared cache (see sa_api.metrics and
+sa_api.instrumentation), so every server process reports the totals for all
+of them.  Counts are kept for as long as API_CACHE_TIMEOUT, and request
+timings are only added to them every so many requests per process, so they
+can lag behind, and can go back to zero.
+"""
+from . import instrumentation
+from . import metrics
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+METRIC_PREFIX = 'shareabouts_'
+
+# The response cache counters that count lookups in the cache, for the hit
+# ratio.
+RESPONSE_CACHE_HITS = ('cache_hits', 'cache_stale_hits', 'cache_lock_waits')
+RESPONSE_CACHE_MISSES = ('cache_misses', 'cache_data_hits', 'cache_lock_timeouts')
+
+
+def escape_label_value(value):
+    return unicode(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Exposition (object):
+    """
+    Collects samples into families of metrics, and writes them in the text
+    format, with the HELP and TYPE lines of each family before its samples.
+    """
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, metric_type, help_text):
+        self.lines.append('# HELP %s%s %s' % (METRIC_PREFIX, name, help_text.replace('\\', r'\\')))
+        self.lines.append('# TYPE %s%s %s' % (METRIC_PREFIX, name, metric_type))
+
+    def sample(self, name, value, **labels):
+        if labels:
+            labels = ','.join(['%s="%s"' % (label, escape_label_value(labels[label]))
+                               for label in sorted(labels)])
+            name = '%s{%s}' % (name, labels)
+        self.lines.append('%s%s %s' % (METRIC_PREFIX, name, format_value(value)))
+
+    def text(self):
+        return u'\n'.join(self.lines) + u'\n'
+
+
+def get_ratio(hits, misses):
+    lookups = hits + misses
+    return (float(hits) / lookups) if lookups else 0.0
+
+
+def get_invalidated_model_names():
+    """
+    The names of the models whose instances clear cached responses when they
+    are saved or deleted (see cache.Cache.count_invalidation).
+    """
+    from django.db.models import get_app, get_models
+    from .cache import Cache
+
+    return sorted([model.__name__ for model in get_models(get_app('sa_api'))
+                   if isinstance(getattr(model, 'cache', None), Cache)])
+
+
+def add_counters(exposition):
+    values = metrics.get_many([name for name, _ in metrics.COUNTERS])
+    for name, description in metrics.COUNTERS:
+        exposition.family(name + '_total', 'counter', description)
+        exposition.sample(name + '_total', values[name])
+
+    ratios = [
+        ('response', RESPONSE_CACHE_HITS, RESPONSE_CACHE_MISSES),
+        ('local', ('local_cache_hits',), ('local_cache_misses',)),
+        ('shared', ('shared_cache_hits',), ('shared_cache_misses',)),
+        ('host', ('host_cache_hits',), ('host_cache_misses',)),
+    ]
+    exposition.family('cache_hit_ratio', 'gauge',
+                      'Share of the lookups in each cache that were hits, since the counts were reset')
+    for cache_name, hit_names, miss_names in ratios:
+        hits = sum([values[name] for name in hit_names])
+        misses = sum([values[name] for name in miss_names])
+        exposition.sample('cache_hit_ratio', get_ratio(hits, misses), cache=cache_name)
+
+
+def add_invalidations(exposition, model_names):
+    names = []
+    for model_name in model_names:
+        names.append('cache_invalidations:%s' % model_name)
+        names.append('cache_keys_deleted:%s' % model_name)
+    values = metrics.get_many(names)
+
+    exposition.family('cache_invalidations_total', 'counter',
+                      'Saves and deletes that cleared cached responses, by model')
+    for model_name in model_names:
+        exposition.sample('cache_invalidations_total',
+                          values['cache_invalidations:%s' % model_name], model=model_name)
+
+    exposition.family('cache_keys_deleted_total', 'counter',
+                      'Cache keys deleted by invalidations, by model')
+    for model_name in model_names:
+        exposition.sample('cache_keys_deleted_total',
+                          values['cache_keys_deleted:%s' % model_name], model=model_name)
+
+
+def add_request_timings(exposition):
+    views = sorted(instrumentation.get_view_names())
+    stats = [(view, instrumentation.get_view_stats(view)) for view in views]
+
+    exposition.family('request_duration_seconds', 'histogram',
+                      'How long requests took to handle, by view')
+    for view, view_stats in stats:
+        # The histograms are kept with a count per bucket; Prometheus buckets
+        # count everything up to their bound.
+        cumulative = 0
+        for bucket, count in view_stats['buckets']:
+            cumulative += count
+            exposition.sample('request_duration_seconds_bucket', cumulative,
+                              view=view, le=('+Inf' if bucket == 'inf' else bucket))
+        exposition.sample('request_duration_seconds_sum', dict(view_stats['seconds'])['total'], view=view)
+        exposition.sample('request_duration_seconds_count', view_stats['count'], view=view)
+
+    exposition.family('request_phase_seconds_total', 'counter',
+                      'Time spent in each phase of handling requests, by view')
+    for view, view_stats in stats:
+        for phase, seconds in view_stats['seconds']:
+            if phase != 'total':
+                exposition.sample('request_phase_seconds_total', seconds, view=view, phase=phase)
+
+    auth_stats = instrumentation.get_label_stats('auth')
+    exposition.family('auth_attempts_total', 'counter',
+                      'Requests checked by each authentication backend')
+    for backend, count, seconds in auth_stats:
+        exposition.sample('auth_attempts_total', count, backend=backend)
+    exposition.family('auth_seconds_total', 'counter',
+                      'Time spent in each authentication backend')
+    for backend, count, seconds in auth_stats:
+        exposition.sample('auth_seconds_total', seconds, backend=backend)
+
+
+def render(model_names=None):
+    """
+    Get all of the metrics in the text exposition format.
+    """
+    if model_names is None:
+        model_names = get_invalidated_model_names()
+
+    exposition = Exposition()
+    add_counters(exposition)
+    add_invalidations(exposition, model_names)
+    add_request_timings(exposition)
+    return exposition.text()
@@ -1,127 +1,241 @@
 import csv
 from collections import defaultdict
+from itertools import imap, izip
+from operator import itemgetter
 from djangorestframework import renderers
 from StringIO import StringIO
 
+
+class ColumnPlan (object):
+    """
+    A compiled description of how to flatten items of one particular shape
+    (i.e., with the same keys, in the same order, holding the same types of
+    values) into table columns.
+
+    The headers are the names of the columns that the item's values fall
+    into, in the same order that values() returns the values in.  Nested
+    lists and dictionaries are planned recursively, with the headers of a
+    nested plan namespaced by the key it is found under.  For example:
+
+     header... | under key... | becomes...
+    -----------|--------------|----------------
+     'lat'     | 'location'   | 'location.lat'
+     ''        | '0'          | '0'
+     'votes.1' | 'user'       | 'user.votes.1'
+
+    """
+    def __init__(self, kind, headers, nested=()):
+        self.kind = kind
+        self.headers = headers
+        self.nested = nested
+
+    def values(self, item):
+        """
+        Get the leaf values in the item, in column order.
+        """
+        if self.kind is None:
+            return [item]
+
+        values = item.values() if self.kind is dict else list(item)
+        if self.nested:
+            flat_values = []
+            start = 0
+            for index, plan in self.nested:
+                flat_values.extend(values[start:index])
+                flat_values.extend(plan.values(values[index]))
+                start = index + 1
+            flat_values.extend(values[start:])
+            values = flat_values
+        return values
+
+    def row_getter(self, headers):
+        """
+        Build a function that picks a row, with a value (or None) for each of
+        the given headers, out of the values of an item with this shape.
+        Columns that are not in the headers are left out.
+        """
+        missing = len(self.headers)
+        positions = dict(izip(self.headers, xrange(missing)))
+        indexes = [positions.get(header, missing) for header in headers]
+
+        if not indexes:
+            return lambda values: []
+        elif len(indexes) == 1:
+            index = indexes[0]
+            return lambda values: [(values + [None])[index]]
+        else:
+            getter = itemgetter(*indexes)
+            def get_row(values):
+                values.append(None)
+                return getter(values)
+            return get_row
+
+
 class CSVRenderer(renderers.BaseRenderer):
     """
-    Renderer which serializes to JSON
+    Renderer which serializes to CSV
     """
 
     media_type = 'text/csv'
     format = 'csv'
     level_sep = '.'
 
+    # The number of rows to write into each chunk of a streamed response.
+    rows_per_chunk = 1000
+
+    def __init__(self, view):
+        super(CSVRenderer, self).__init__(view)
+        self.plans = {}
+        self.nested_positions = {}
+
     def render(self, obj=None, media_type=None):
         """
-        Renders *obj* into serialized CSV.
+        Renders *obj* into serialized CSV.  When rendering for a view, the CSV
+        is returned as an iterator over chunks of rows, so that it can be
+        written to the response as it is produced.
         """
         if obj is None:
             return ''
 
-        table = self.tablize(obj)
-        csv_buffer = StringIO()
-        csv_writer = csv.writer(csv_buffer)
-        for row in table:
+        chunks = self.render_chunks(obj)
+        if self.view is None:
+            return ''.join(chunks)
+        return chunks
+
+    def render_chunks(self, data):
+        """
+        Iterate over chunks of serialized CSV for the given data, with the
+        header row at the start of the first chunk.
+        """
+        table = self.iter_table(data)
+        while True:
+            csv_buffer = StringIO()
+            self.writerows(csv_buffer, table, self.rows_per_chunk)
+            chunk = csv_buffer.getvalue()
+            if not chunk:
+                return
+            yield chunk
+
+    def writerows(self, outfile, rows, count=None):
+        """
+        Write rows (up to count of them, if given) from the iterable of rows
+        into the file as CSV.
+        """
+        csv_writer = csv.writer(outfile)
+        if count is not None:
+            rows = (row for _, row in izip(xrange(count), rows))
+        for row in rows:
             # Assume that strings should be encoded as UTF-8
             csv_writer.writerow([
-                elem.encode('utf-8') if isinstance(elem, basestring) else elem 
+                elem.encode('utf-8') if isinstance(elem, unicode) else elem
                 for elem in row
             ])
 
-        return csv_buffer.getvalue()
-
     def tablize(self, data):
         """
         Convert a list of data into a table.
         """
         if data:
-
-            # First, flatten the data (i.e., convert it to a list of
-            # dictionaries that are each exactly one level deep).  The key for
-            # each item designates the name of the column that the item will
-            # fall into.
-            data = self.flatten_data(data)
-
-            # Get the set of all unique headers, and sort them.
-            headers = set()
-            for item in data:
-                headers.update(item.keys())
-            headers = sorted(headers)
-
-            # Create a row for each dictionary, filling in columns for which the
-            # item has no data with None values.
-            rows = []
-            for item in data:
-                row = []
-                for key in headers:
-                    row.append(item.get(key, None))
-                rows.append(row)
-
-            # Return your "table", with the headers as the first row.
-            return [headers] + rows
-
+            return [list(row) for row in self.iter_table(data)]
         else:
             return []
 
-    def flatten_data(self, data):
+    def iter_table(self, data):
+        """
+        Iterate over the rows in the table for a list of data, with the headers
+        as the first row.
+        """
+        if not data:
+            return
+
+        # First, get the plan for flattening each item.  Items with the same
+        # shape share a plan, so this is cheap after the first of each shape.
+        plans = map(self.get_plan, data)
+
+        # Get the set of all unique headers, and sort them.
+        headers = set()
+        for plan in set(plans):
+            headers.update(plan.headers)
+        headers = sorted(headers)
+
+        yield headers
+        for row in self.iter_rows(data, headers, plans):
+            yield row
+
+    def iter_rows(self, data, headers, plans=None):
         """
-        Convert the given data collection to a list of dictionaries that are
-        each exactly one level deep. The key for each value in the dictionaries
-        designates the name of the column that the value will fall into.
+        Iterate over a row for each item in the data, with the item's values
+        (or None) in the columns named by headers.
         """
-        flat_data = []
-        for item in data:
-            flat_item = self.flatten_item(item)
-            flat_data.append(flat_item)
+        if plans is None:
+            plans = imap(self.get_plan, data)
 
-        return flat_data
+        row_getters = {}
+        for item, plan in izip(data, plans):
+            get_row = row_getters.get(plan)
+            if get_row is None:
+                get_row = row_getters[plan] = plan.row_getter(headers)
+            yield get_row(plan.values(item))
 
-    def flatten_item(self, item):
-        if isinstance(item, list):
-            flat_item = self.flatten_list(item)
-        elif isinstance(item, dict):
-            flat_item = self.flatten_dict(item)
+    def get_plan(self, item):
+        """
+        Get the column plan for items shaped like the given item.
+        """
+        shape = self.get_shape(item)
+        plan = self.plans.get(shape)
+        if plan is None:
+            plan = self.plans[shape] = self.compile_plan(item)
+        return plan
+
+    def get_shape(self, item):
+        """
+        Get a hashable key that is the same for any two items that can be
+        flattened with the same plan.
+        """
+        if isinstance(item, dict):
+            keys = tuple(item)
+            values = item.values()
+        elif isinstance(item, list):
+            keys = len(item)
+            values = item
+        else:
+            return None
+
+        types = tuple(map(type, values))
+        nested = self.nested_positions.get(types)
+        if nested is None:
+            nested = self.nested_positions[types] = tuple([
+                index for index, value_type in enumerate(types)
+                if issubclass(value_type, (dict, list))])
+
+        if nested:
+            return (keys, types, tuple([self.get_shape(values[index]) for index in nested]))
+        return (keys, types)
+
+    def compile_plan(self, item):
+        if isinstance(item, dict):
+            kind = dict
+            keys = [key if isinstance(key, basestring) else str(key) for key in item]
+            values = item.values()
+        elif isinstance(item, list):
+            kind = list
+            keys = [str(index) for index in xrange(len(item))]
+            values = item
         else:
-            flat_item = {'': item}
-
-        return flat_item
-
-    def nest_flat_item(self, flat_item, prefix):
-        """
-        Given a "flat item" (a dictionary exactly one level deep), nest all of
-        the column headers in a namespace designated by prefix.  For example:
-
-         header... | with prefix... | becomes...
-        -----------|----------------|----------------
-         'lat'     | 'location'     | 'location.lat'
-         ''        | '0'            | '0'
-         'votes.1' | 'user'         | 'user.votes.1'
-
-        """
-        nested_item = {}
-        for header, val in flat_item.iteritems():
-            nested_header = self.level_sep.join([prefix, header]) if header else prefix
-            nested_item[nested_header] = val
-        return nested_item
-
-    def flatten_list(self, l):
-        flat_list = {}
-        for index, item in enumerate(l):
-            index = str(index)
-            flat_item = self.flatten_item(item)
-            nested_item = self.nest_flat_item(flat_item, index)
-            flat_list.update(nested_item)
-        return flat_list
-
-    def flatten_dict(self, d):
-        flat_dict = {}
-        for key, item in d.iteritems():
-            key = str(key)
-            flat_item = self.flatten_item(item)
-            nested_item = self.nest_flat_item(flat_item, key)
-            flat_dict.update(nested_item)
-        return flat_dict
+            return ColumnPlan(None, [''])
+
+        headers = []
+        nested = []
+        for index, (key, value) in enumerate(izip(keys, values)):
+            if isinstance(value, (dict, list)):
+                plan = self.compile_plan(value)
+                nested.append((index, plan))
+                headers.extend([self.level_sep.join([key, header]) if header else key
+                                for header in plan.headers])
+            else:
+                headers.append(key)
+
+        return ColumnPlan(kind, headers, nested)
 
 
 class CSVRendererWithUnderscores (CSVRenderer):
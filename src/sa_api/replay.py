@@ -0,0 +1,558 @@
+"""
+Replaying recorded API traffic against a synthetic dataset, to compare the
+performance of builds without access to the production deployment (see the
+replay_requests command).
+
+Traces are read a request per line, in any of these forms:
+
+* nginx access log lines (the request is taken from the first quoted
+  field, as in profiling/extract_api_calls.py),
+* "<METHOD> <path>" lines (the output of extract_api_calls.py), or
+* JSON objects with a method, a path (which may have a query string, or
+  may be a full URL), and optionally a query_string, a body and a
+  content_type.  This is the format that middleware.RequestCapture records
+  requests in (see get_capture()), with the URL name and arguments, the
+  response status and size, and the response time as well.
+
+Each traced request is mapped onto a fixture dataset: the owner and dataset
+in its path are replaced with the fixture's, and each distinct place,
+submission type and submission in the trace is consistently replaced with
+one of the fixture's.  Requests for paths that aren't API paths, or with
+methods that the API doesn't handle, are skipped.
+
+The mapped requests are then sent through the Django test client in this
+process, or to a running server, from a number of threads at once.  For
+each URL name, the replay reports the number of requests, their statuses,
+the 50th, 95th and 99th percentile response times, and the mean number of
+SQL queries per request (in this process, from the request profiles; from
+a server, only if it sends Server-Timing headers).
+"""
+import datetime
+import itertools
+import json
+import math
+import re
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+from django.core.urlresolvers import resolve, reverse, Resolver404
+from django.db import connection
+from django.test.client import Client
+from . import instrumentation
+from . import utils
+
+import logging
+logger = logging.getLogger('sa_api.replay')
+
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+REPLAYED_METHODS = SAFE_METHODS + ('POST', 'PUT', 'DELETE')
+SERVER_TIMING_QUERIES_PATTERN = re.compile(r'(?:^|,)\s*sql;[^,]*desc="(\d+) queries"')
+
+
+class TracedRequest (object):
+    def __init__(self, method, path, query_string='', body=None, content_type=None):
+        self.method = method.upper()
+        self.path = path
+        self.query_string = query_string
+        self.body = body
+        self.content_type = content_type
+
+    @property
+    def full_path(self):
+        if self.query_string:
+            return '%s?%s' % (self.path, self.query_string)
+        return self.path
+
+    def __repr__(self):
+        return '<TracedRequest %s %s>' % (self.method, self.full_path)
+
+
+def split_path(path):
+    """
+    Split a path or full URL into its path and its query string.
+    """
+    parts = urlparse.urlsplit(path)
+    return parts.path, parts.query
+
+
+def parse_line(line):
+    """
+    Parse a line of a trace into a TracedRequest, or return None if the line
+    isn't a request.
+    """
+    line = line.strip()
+    if not line:
+        return None
+
+    if line.startswith('{'):
+        record = json.loads(line)
+        path, query_string = split_path(record.get('path') or record['url'])
+        body = record.get('body')
+        if body is not None and not isinstance(body, basestring):
+            body = json.dumps(body)
+        return TracedRequest(record.get('method', 'GET'), path,
+                             record.get('query_string') or query_string,
+                             body, record.get('content_type'))
+
+    # An access log line; the request is the first quoted field.
+    if '"' in line:
+        line = line.split('"')[1]
+        line = line.rsplit(' HTTP/', 1)[0]
+
+    try:
+        method, path = line.split(None, 1)
+    except ValueError:
+        return None
+    path, query_string = split_path(path.strip())
+    return TracedRequest(method, path, query_string)
+
+
+def read_trace(lines):
+    """
+    Get the requests in the lines of a trace, skipping the lines that can't
+    be parsed.
+    """
+    for number, line in enumerate(lines, 1):
+        try:
+            request = parse_line(line)
+        except (ValueError, KeyError, IndexError):
+            logger.warning('Skipping line %s of the trace; it is not a request.' % number)
+            continue
+        if request is not None:
+            yield request
+
+
+# What redacted values are replaced with, and the names of the fields and
+# query string parameters that are redacted (besides private- fields).
+REDACTED = 'REDACTED'
+REDACTED_NAMES = ('key', 'apikey', 'api_key', 'password')
+
+# The bodies that are recorded when capturing requests, and the largest.
+CAPTURED_CONTENT_TYPES = ('application/json', 'application/x-www-form-urlencoded')
+MAX_CAPTURED_BODY_SIZE = 64 * 1024
+
+capture_log = instrumentation.TraceLog('API_CAPTURE_FILE')
+
+
+def is_redacted(name):
+    name = name.lower()
+    return name.startswith('private-') or name in REDACTED_NAMES
+
+
+def redact(data):
+    """
+    Replace the values of private fields (and keys and passwords) in some
+    request data, at any depth.
+    """
+    if isinstance(data, dict):
+        return dict([(name, REDACTED if is_redacted(name) else redact(value))
+                     for name, value in data.items()])
+    if isinstance(data, list):
+        return [redact(value) for value in data]
+    return data
+
+
+def redact_query_string(query_string):
+    params = urlparse.parse_qsl(query_string, keep_blank_values=True)
+    return urllib.urlencode([(name, REDACTED if is_redacted(name) else value)
+                             for name, value in params])
+
+
+def get_captured_content_type(request):
+    content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip()
+    if content_type not in CAPTURED_CONTENT_TYPES:
+        return None
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return None
+    if not 0 < length <= MAX_CAPTURED_BODY_SIZE:
+        return None
+    return content_type
+
+
+def get_captured_body(body, content_type):
+    """
+    Get a request body, redacted, for a capture.  JSON bodies are kept as
+    data; form bodies as strings.
+    """
+    if content_type == 'application/json':
+        try:
+            return redact(json.loads(body))
+        except ValueError:
+            return None
+    return redact_query_string(body)
+
+
+def get_capture(request, response, seconds, body=None, content_type=None):
+    """
+    Get the record of a request for a capture trace, or None if it's not for
+    an API view.  The URL name is the canonical one, for requests on the
+    deprecated routes.
+    """
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        return None
+    if match.url_name is None:
+        return None
+
+    url_name = match.url_name
+    if url_name.endswith(utils.DEPRECATED_URL_NAME_SUFFIX):
+        url_name = url_name[:-len(utils.DEPRECATED_URL_NAME_SUFFIX)]
+
+    if response.has_header('Content-Length'):
+        size = int(response['Content-Length'])
+    elif response._base_content_is_iter:
+        # Don't read a streamed response that hasn't been sent yet.
+        size = None
+    else:
+        size = len(response.content)
+
+    return {
+        'time': datetime.datetime.utcnow().isoformat() + 'Z',
+        'method': request.method,
+        'path': utils.get_canonical_path(request),
+        'query_string': redact_query_string(request.META.get('QUERY_STRING', '')),
+        'url_name': url_name,
+        'kwargs': match.kwargs,
+        'body': get_captured_body(body, content_type) if body is not None else None,
+        'content_type': content_type if body is not None else None,
+        'status': response.status_code,
+        'size': size,
+        'duration': round(seconds * 1000, 3),
+    }
+
+
+class Fixture (object):
+    """
+    A synthetic dataset for traced requests to be mapped onto.  Every place
+    has the same number of submissions of each type, so that any traced
+    submission can be mapped onto one of the same type on the mapped place.
+    """
+    def __init__(self, owner, dataset, api_key, place_ids, submission_ids):
+        self.owner = owner
+        self.dataset = dataset
+        self.api_key = api_key
+        self.place_ids = place_ids
+        # A map from (place id, submission type) to submission ids.
+        self.submission_ids = submission_ids
+        self.submission_types = sorted(set([set_type for _, set_type in submission_ids]))
+
+        self.mapped_ids = {}
+        self.counters = {}
+
+    @classmethod
+    def load(cls, owner, dataset):
+        """
+        Load the fixture from an existing dataset.
+        """
+        from .models import DataSet, Place, Submission
+
+        dataset_obj = DataSet.objects.get(owner__username=owner, slug=dataset)
+        api_key = dataset_obj.api_keys.all()[0].key
+        place_ids = sorted(Place.objects.filter(dataset=dataset_obj)
+                           .values_list('id', flat=True))
+        submission_ids = {}
+        submissions = Submission.objects.filter(dataset=dataset_obj)\
+            .values_list('parent__place_id', 'parent__submission_type', 'id')\
+            .order_by('id')
+        for place_id, submission_type, submission_id in submissions:
+            submission_ids.setdefault((place_id, submission_type), []).append(submission_id)
+        return cls(owner, dataset, api_key, place_ids, submission_ids)
+
+    @classmethod
+    def create(cls, owner, dataset, places=100, submission_types=('comments', 'support'),
+               submissions_per_set=2):
+        """
+        Create the fixture dataset, or load it if it already exists.
+        """
+        from django.contrib.auth.models import User
+        from .apikey.models import ApiKey, generate_unique_api_key
+        from .models import DataSet, Place, SubmissionSet, Submission
+
+        user, _ = User.objects.get_or_create(username=owner)
+        dataset_obj, created = DataSet.objects.get_or_create(
+            owner=user, slug=dataset, defaults={'display_name': dataset})
+
+        if created:
+            key = ApiKey.objects.create(user=user, key=generate_unique_api_key())
+            dataset_obj.api_keys.add(key)
+
+            for number in xrange(places):
+                place = Place(dataset=dataset_obj,
+                              location='POINT(%s %s)' % (-75 + number * 0.001, 40),
+                              data=json.dumps({'name': 'Place %s' % number, 'test_data': True}))
+                place.save(silent=True)
+                for submission_type in submission_types:
+                    parent = SubmissionSet.objects.create(place=place, submission_type=submission_type)
+                    for _ in xrange(submissions_per_set):
+                        submission = Submission(dataset=dataset_obj, parent=parent,
+                                                data=json.dumps({'test_data': True}))
+                        submission.save(silent=True)
+
+        return cls.load(owner, dataset)
+
+    def map_id(self, kind, original, choices):
+        """
+        Consistently map an id (or name) from the trace onto one of the
+        choices, taking the choices in turn as new ids are seen.
+        """
+        if not choices:
+            return original
+
+        key = (kind, original)
+        if key not in self.mapped_ids:
+            counter = self.counters.setdefault(kind, itertools.count())
+            self.mapped_ids[key] = choices[next(counter) % len(choices)]
+        return self.mapped_ids[key]
+
+    def map_kwargs(self, url_name, kwargs):
+        kwargs = dict(kwargs)
+        place_id = None
+        for name in kwargs:
+            if name.endswith('owner__username'):
+                kwargs[name] = self.owner
+            elif name.endswith('slug'):
+                kwargs[name] = self.dataset
+
+        if 'submission_type' in kwargs:
+            kwargs['submission_type'] = self.map_id(
+                'submission_type', kwargs['submission_type'], self.submission_types)
+
+        if 'place_id' in kwargs:
+            place_id = kwargs['place_id'] = self.map_id(
+                'place', kwargs['place_id'], self.place_ids)
+
+        # Instances and attachments are of places, unless they're under a
+        # submission set.
+        for name in ('pk', 'thing_id'):
+            if name not in kwargs:
+                continue
+            if place_id is not None:
+                submission_ids = self.submission_ids.get(
+                    (place_id, kwargs['submission_type']), [])
+                kwargs[name] = self.map_id('submission', kwargs[name], submission_ids)
+            elif url_name.startswith('place_'):
+                kwargs[name] = self.map_id('place', kwargs[name], self.place_ids)
+        return kwargs
+
+    def make_body(self, url_name, traced):
+        """
+        Make up a body for a write with no body in the trace.
+        """
+        if traced.body is not None:
+            return traced.body, traced.content_type or 'application/json'
+
+        data = {'test_data': True}
+        if url_name.startswith('place_'):
+            data['location'] = {'lat': 40, 'lng': -75}
+        return json.dumps(data), 'application/json'
+
+    def map_request(self, traced):
+        """
+        Map a traced request onto the fixture.  Returns a MappedRequest, or
+        None if the request is not for an API view.
+        """
+        if traced.method not in REPLAYED_METHODS:
+            return None
+        try:
+            match = resolve(traced.path)
+        except Resolver404:
+            return None
+        if match.url_name is None:
+            return None
+
+        kwargs = self.map_kwargs(match.url_name, match.kwargs)
+        path = reverse(match.url_name, kwargs=kwargs)
+
+        body = content_type = None
+        headers = {}
+        if traced.method not in SAFE_METHODS:
+            if traced.method in ('POST', 'PUT'):
+                body, content_type = self.make_body(match.url_name, traced)
+            headers['X-Shareabouts-Key'] = self.api_key
+
+        return MappedRequest(match.url_name, traced.method, path,
+                             traced.query_string, body, content_type, headers)
+
+
+class MappedRequest (object):
+    def __init__(self, url_name, method, path, query_string, body, content_type, headers):
+        self.url_name = url_name
+        self.method = method
+        self.path = path
+        self.query_string = query_string
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers
+
+    @property
+    def full_path(self):
+        if self.query_string:
+            return '%s?%s' % (self.path, self.query_string)
+        return self.path
+
+
+class Result (object):
+    def __init__(self, url_name, status, seconds, queries=None):
+        self.url_name = url_name
+        self.status = status
+        self.seconds = seconds
+        self.queries = queries
+
+
+class InProcessSender (object):
+    """
+    Sends requests through the Django test client, in this process.  Each
+    thread gets its own client.
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    def get_client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = Client()
+        return self.local.client
+
+    def __call__(self, mapped):
+        client = self.get_client()
+        extra = dict([('HTTP_' + name.upper().replace('-', '_'), value)
+                      for name, value in mapped.headers.items()])
+
+        method = getattr(client, mapped.method.lower())
+        start_time = time.time()
+        try:
+            if mapped.body is not None:
+                response = method(mapped.full_path, data=mapped.body,
+                                  content_type=mapped.content_type, **extra)
+            else:
+                response = method(mapped.full_path, **extra)
+            status = response.status_code
+        except Exception:
+            logger.exception('Error replaying %s %s' % (mapped.method, mapped.full_path))
+            status = 500
+        seconds = time.time() - start_time
+
+        profile = instrumentation.last()
+        queries = profile.counts.get('sql', 0) if profile is not None else None
+        return Result(mapped.url_name, status, seconds, queries)
+
+    def close(self):
+        connection.close()
+
+
+class HttpSender (object):
+    """
+    Sends requests to a running server.
+    """
+    def __init__(self, base_url, headers=None):
+        self.base_url = base_url.rstrip('/')
+        self.headers = headers or {}
+
+    def __call__(self, mapped):
+        request = urllib2.Request(self.base_url + mapped.full_path, data=mapped.body)
+        request.get_method = lambda: mapped.method
+        for name, value in self.headers.items() + mapped.headers.items():
+            request.add_header(name, value)
+        if mapped.content_type:
+            request.add_header('Content-Type', mapped.content_type)
+
+        start_time = time.time()
+        try:
+            response = urllib2.urlopen(request)
+            response.read()
+        except urllib2.HTTPError as response:
+            response.read()
+        except urllib2.URLError as e:
+            logger.error('Error replaying %s %s: %s' % (mapped.method, mapped.full_path, e))
+            return Result(mapped.url_name, 0, time.time() - start_time)
+        seconds = time.time() - start_time
+
+        match = SERVER_TIMING_QUERIES_PATTERN.search(response.info().get('Server-Timing', ''))
+        queries = int(match.group(1)) if match else None
+        return Result(mapped.url_name, response.code, seconds, queries)
+
+    def close(self):
+        pass
+
+
+def replay(requests, send, concurrency=1):
+    """
+    Send the requests with the sender, from the given number of threads.
+    Returns the results, in no particular order, and the number of seconds
+    that the replay took.
+    """
+    requests = iter(requests)
+    lock = threading.Lock()
+    results = []
+
+    def work():
+        try:
+            while True:
+                with lock:
+                    mapped = next(requests, None)
+                if mapped is None:
+                    return
+                result = send(mapped)
+                with lock:
+                    results.append(result)
+        finally:
+            send.close()
+
+    start_time = time.time()
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.time() - start_time
+
+
+def percentile(sorted_values, fraction):
+    """
+    Get the nearest-rank percentile of some sorted values.
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(fraction * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def summarize_results(results):
+    times = sorted([result.seconds for result in results])
+    queries = [result.queries for result in results if result.queries is not None]
+    statuses = {}
+    for result in results:
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+
+    return {
+        'count': len(results),
+        'statuses': statuses,
+        'p50': percentile(times, 0.5),
+        'p95': percentile(times, 0.95),
+        'p99': percentile(times, 0.99),
+        'queries': (float(sum(queries)) / len(queries)) if queries else None,
+    }
+
+
+def summarize(results, seconds):
+    """
+    Summarize the results of a replay, overall and per URL name.  Times are
+    in seconds.
+    """
+    by_url_name = {}
+    for result in results:
+        by_url_name.setdefault(result.url_name, []).append(result)
+
+    summary = summarize_results(results)
+    summary.update({
+        'seconds': seconds,
+        'throughput': (len(results) / seconds) if seconds else None,
+        'url_names': dict([(url_name, summarize_results(url_name_results))
+                           for url_name, url_name_results in by_url_name.items()]),
+    })
+    return summary
@@ -3,7 +3,6 @@ DjangoRestFramework resources for the Shareabouts REST API.
 """
 import ujson as json
 import apikey.models
-from collections import defaultdict
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.db.models import Count
@@ -186,65 +185,8 @@ class PlaceResource (ModelResourceWithDataBlob):
 class DataSetResource (resources.ModelResource):
     model = models.DataSet
     form = forms.DataSetForm
-    fields = ['id', 'url', 'owner', 'places', 'slug', 'display_name', 'keys', 'submissions']
-    queryset = model.objects.all().select_related()
-
-    # TODO: Move this to the cache module. Invalidate on place save.
-    @utils.cached_property
-    def places_counts(self):
-        # TODO: We should check the view attached to the resource to see whether
-        #       it refers to a user or a dataset so that we can filter and not
-        #       get ALL the places, which is wasteful.
-        qs = models.Place.objects.values('dataset_id').annotate(length=Count('dataset'))
-
-        places_counts = dict([(places['dataset_id'], places['length'])
-                              for places in qs])
-        return places_counts
-
-    # TODO: Move this to the cache module. Invalidate on submission save.
-    @utils.cached_property
-    def submission_sets(self):
-        """
-        A mapping from DataSet ids to attributes.  Helps to cut down
-        significantly on the number of queries.
-        """
-        submission_sets = defaultdict(set)
-        submission_counts = defaultdict(lambda: defaultdict(int))
-
-        qs = models.SubmissionSet.objects.all().select_related()
-        for submission_set in qs.annotate(length=Count('children')):
-            # Ignore empty sets
-            if submission_set.length <= 0:
-                continue
-
-            ds_id = submission_set.place.dataset_id
-            ss_type = submission_set.submission_type
-
-            # Keep a total of how many of each submission type you've seen
-            submission_counts[ds_id][ss_type] += submission_set.length
-
-            # Build a list of unique submission set types; use tuples so that
-            # we can compare values.
-            submission_sets[ds_id].add((
-                ('type', ss_type),
-                ('url', reverse('all_submissions_by_dataset', kwargs={
-                    'dataset__owner__username': submission_set.place.dataset.owner.username,
-                    'dataset__slug': submission_set.place.dataset.slug,
-                    'submission_type': ss_type
-                }))
-            ))
-
-        # Go through and create a dictionary from all the tuple sets
-        for dataset_id, submission_sets_data in submission_sets.items():
-            submission_sets[dataset_id] = [dict(data) for data in submission_sets_data]
-
-        # Attach the counts to the dictionaries
-        for dataset_id, type_counts in submission_counts.items():
-            for submission_set in submission_sets[dataset_id]:
-                submission_type = submission_set['type']
-                submission_set['length'] = type_counts[submission_type]
-
-        return submission_sets
+    fields = ['id', 'url', 'owner', 'places', 'slug', 'display_name', 'keys', 'submissions', 'summary']
+    queryset = model.objects.all().select_related('owner', 'summary')
 
     def owner(self, dataset):
         return simple_user(dataset.owner)
@@ -255,10 +197,25 @@ class DataSetResource (resources.ModelResource):
                       kwargs={
                          'dataset__owner__username': dataset.owner.username,
                          'dataset__slug': dataset.slug})
-        return {'url': url, 'length': self.places_counts.get(dataset.id, 0)}
+        places_counts = self.model.cache.get_places_counts(dataset.owner_id)
+        return {'url': url, 'length': places_counts.get(dataset.id, 0)}
 
     def submissions(self, dataset):
-        return self.submission_sets[dataset.id]
+        submission_sets = self.model.cache.get_submission_sets(dataset.owner_id)
+        return submission_sets.get(dataset.id, [])
+
+    def summary(self, dataset):
+        try:
+            summary = dataset.summary
+        except models.DataSetSummary.DoesNotExist:
+            summary = None
+        if summary is None:
+            summary, _ = models.DataSetSummary.get_for_dataset(dataset.id)
+        document = summary.document()
+        document['url'] = reverse('dataset_summary_by_user',
+                                  kwargs={'owner__username': dataset.owner.username,
+                                          'slug': dataset.slug})
+        return document
 
     # TODO: construct with the cache's instance_params.
     def url(self, instance):
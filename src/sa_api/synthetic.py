@@ -0,0 +1,321 @@
+"""
+Generating large synthetic datasets, for benchmarks and query plan checks
+(see the generate_dataset command).
+
+A generated dataset looks like a real one at scale:
+
+* Places are clustered around a number of centers (like the neighborhoods
+  of a city), with normally distributed offsets.
+* Data blobs have a few attributes that nearly every place has, and a tail
+  of attributes that fewer and fewer places have.
+* Submissions are spread over the places with a power law, so that most
+  places have few or no comments or votes, and a few have very many.
+* Some places have an attachment, and every place and submission has a
+  create activity (and some places an update activity), timestamped over
+  the history of the dataset.
+
+Rows are written with multi-row inserts, bypassing save() and the signals
+(so that the caches aren't cleared for each row).  Since Django can't bulk
+insert models with multi-table inheritance, ids are reserved from the
+database sequences first, and the parent and child rows of places and
+submissions are inserted separately.  This needs PostgreSQL, like the rest
+of the API.
+
+Afterwards, the submission counts of the submission sets are already
+right, the dataset summaries are recalculated, and the caches for the
+datasets are cleared.
+"""
+import datetime
+import json
+import random
+from django.contrib.auth.models import User
+from django.db import connection, router, transaction
+from django.utils import timezone
+from . import utils
+from .apikey.models import ApiKey, generate_unique_api_key
+from .models import (DataSet, DataSetSummary, SubmittedThing, Place, SubmissionSet,
+                     Submission, Attachment, Activity)
+
+
+WORDS = (
+    'bike lane street corner park school bus stop crosswalk sidewalk light '
+    'signal traffic safe dangerous busy quiet path trail bridge river market '
+    'library garden tree bench rack parking station train corner avenue block '
+    'neighborhood community people children walk ride cross wide narrow new '
+    'old broken needs more better great love would like here there every day '
+    'morning evening weekend summer winter'
+).split()
+
+LOCATION_TYPES = ('school', 'park', 'intersection', 'business', 'bike_rack', 'transit', 'other')
+
+# The attributes of places, from the most to the least common, and the share
+# of places that have each.
+PLACE_ATTRIBUTES = (
+    ('name', 1.0),
+    ('location_type', 0.95),
+    ('description', 0.8),
+    ('private-email', 0.35),
+    ('address', 0.25),
+    ('private-phone', 0.08),
+    ('url', 0.04),
+    ('rating', 0.02),
+)
+
+# The types of submissions, and the share of the submissions of each.
+SUBMISSION_TYPES = (
+    ('comments', 0.3),
+    ('support', 0.7),
+)
+
+# The share of places that are updated after they are created.
+UPDATED_PLACE_SHARE = 0.1
+
+
+def reserve_ids(model, count):
+    """
+    Take count ids from the sequence of the model's table.
+    """
+    if not count:
+        return []
+    cursor = connection.cursor()
+    cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                   [model._meta.db_table, model._meta.pk.column, count])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def insert(model, objs, batch_size):
+    """
+    Insert the rows of the model's own table for the objects, which all have
+    their ids set, as they are (auto_now fields are not touched).
+    """
+    fields = model._meta.local_fields
+    using = router.db_for_write(model)
+    for start in xrange(0, len(objs), batch_size):
+        model._base_manager._insert(objs[start:start + batch_size], fields=fields,
+                                    raw=True, using=using)
+
+
+def get_power_law_counts(total, count, alpha, rng):
+    """
+    Split total into count parts, in proportion to Pareto distributed
+    weights.
+    """
+    if not count:
+        return []
+    weights = [rng.paretovariate(alpha) for _ in xrange(count)]
+    scale = total / sum(weights)
+    counts = [int(weight * scale) for weight in weights]
+
+    # Hand the rounding remainder out to the heaviest parts.
+    remainder = total - sum(counts)
+    heaviest = sorted(xrange(count), key=weights.__getitem__, reverse=True)
+    for index in heaviest[:remainder]:
+        counts[index] += 1
+    return counts
+
+
+class DataSetGenerator (object):
+    def __init__(self, places=1000, submissions=10000, attachment_share=0.05,
+                 activity=True, clusters=10, alpha=1.2, days=365,
+                 bbox=(-87.9, 41.65, -87.5, 42.05), batch_size=5000,
+                 seed=None, log=None):
+        self.places = places
+        self.submissions = submissions
+        self.attachment_share = attachment_share
+        self.activity = activity
+        self.alpha = alpha
+        self.days = days
+        self.batch_size = batch_size
+        self.rng = random.Random(seed)
+        self.log = log or (lambda message: None)
+
+        # Cluster centers, and how spread out each cluster is (in degrees).
+        min_lng, min_lat, max_lng, max_lat = bbox
+        self.clusters = [(self.rng.uniform(min_lng, max_lng),
+                          self.rng.uniform(min_lat, max_lat),
+                          self.rng.uniform(0.002, 0.02))
+                         for _ in xrange(clusters)]
+
+    def words(self, low, high):
+        return ' '.join([self.rng.choice(WORDS) for _ in xrange(self.rng.randint(low, high))])
+
+    def make_location(self):
+        lng, lat, spread = self.rng.choice(self.clusters)
+        return 'POINT(%r %r)' % (self.rng.gauss(lng, spread), self.rng.gauss(lat, spread))
+
+    def make_place_data(self, number):
+        data = {}
+        for key, share in PLACE_ATTRIBUTES:
+            if self.rng.random() >= share:
+                continue
+            if key == 'name':
+                data[key] = self.words(1, 4).title()
+            elif key == 'location_type':
+                data[key] = self.rng.choice(LOCATION_TYPES)
+            elif key == 'description':
+                data[key] = self.words(3, int(self.rng.expovariate(1 / 20.0)) + 4)
+            elif key == 'private-email':
+                data[key] = 'user%s@example.com' % self.rng.randint(1, self.places)
+            elif key == 'address':
+                data[key] = '%s %s St' % (self.rng.randint(1, 9999), self.rng.choice(WORDS).title())
+            elif key == 'private-phone':
+                data[key] = '555-%04d' % self.rng.randint(0, 9999)
+            elif key == 'url':
+                data[key] = 'http://example.com/places/%s' % number
+            elif key == 'rating':
+                data[key] = self.rng.randint(1, 5)
+        return json.dumps(data)
+
+    def make_submission_data(self, submission_type):
+        if submission_type == 'comments':
+            data = {'comment': self.words(2, int(self.rng.expovariate(1 / 15.0)) + 3)}
+            if self.rng.random() < 0.2:
+                data['private-email'] = 'user%s@example.com' % self.rng.randint(1, self.places)
+        else:
+            data = {'user_token': 'session:%032x' % self.rng.getrandbits(128)}
+        return json.dumps(data)
+
+    def make_submitter_name(self):
+        if self.rng.random() < 0.6:
+            return self.rng.choice(WORDS).title()
+        return None
+
+    def make_time(self, after=None):
+        now = self.now
+        start = after or (now - datetime.timedelta(days=self.days))
+        # timedelta.total_seconds() is new in Python 2.7.
+        delta = now - start
+        seconds = delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+        return start + datetime.timedelta(seconds=self.rng.uniform(0, seconds))
+
+    def generate(self, owner, slug):
+        """
+        Generate a dataset with the given slug, for the owner with the given
+        username (who is created if they don't exist).  Returns the dataset.
+
+        The dataset is committed in one transaction, unless the caller
+        manages the transaction, in which case it's left to the caller to
+        commit or roll back.
+        """
+        self.now = timezone.now()
+        if transaction.is_managed():
+            dataset = self.insert_dataset(owner, slug)
+        else:
+            with transaction.commit_on_success():
+                dataset = self.insert_dataset(owner, slug)
+
+        dataset.cache.clear_instance(dataset)
+        return dataset
+
+    def insert_dataset(self, owner, slug):
+        user, _ = User.objects.get_or_create(username=owner)
+        dataset = DataSet.objects.create(owner=user, slug=slug, display_name=slug)
+        key = ApiKey.objects.create(user=user, key=generate_unique_api_key())
+        dataset.api_keys.add(key)
+
+        places = self.generate_places(dataset)
+        self.generate_submissions(dataset, places)
+
+        # The summary was created empty, with the dataset.
+        DataSetSummary.objects.filter(dataset=dataset).delete()
+        DataSetSummary.get_for_dataset(dataset.id)
+        return dataset
+
+    def generate_places(self, dataset):
+        """
+        Insert the places, their attachments and their activity.  Returns
+        the ids and creation times of the places.
+        """
+        self.log('Generating %s places' % self.places)
+        ids = reserve_ids(SubmittedThing, self.places)
+        times = []
+        places = []
+        for number, place_id in enumerate(ids):
+            created = self.make_time()
+            times.append(created)
+            places.append(Place(
+                id=place_id, submittedthing_ptr_id=place_id, dataset=dataset,
+                location=self.make_location(), data=self.make_place_data(number),
+                submitter_name=self.make_submitter_name(), visible=True,
+                created_datetime=created, updated_datetime=created))
+
+            if len(places) >= self.batch_size:
+                self.insert_places(places)
+                places = []
+        self.insert_places(places)
+
+        return zip(ids, times)
+
+    def insert_places(self, places):
+        if not places:
+            return
+        insert(SubmittedThing, places, self.batch_size)
+        insert(Place, places, self.batch_size)
+
+        attached = [place for place in places if self.rng.random() < self.attachment_share]
+        attachments = [
+            Attachment(id=attachment_id, thing_id=place.id, name='photo',
+                       file='attachments/%s-photo.jpg' % utils.to_base(place.id, 62),
+                       created_datetime=place.created_datetime,
+                       updated_datetime=place.created_datetime)
+            for attachment_id, place in zip(reserve_ids(Attachment, len(attached)), attached)]
+        insert(Attachment, attachments, self.batch_size)
+
+        if self.activity:
+            activities = [('create', place, place.created_datetime) for place in places]
+            activities.extend([('update', place, self.make_time(place.created_datetime))
+                               for place in places if self.rng.random() < UPDATED_PLACE_SHARE])
+            self.insert_activity(activities)
+
+    def insert_activity(self, activities):
+        ids = reserve_ids(Activity, len(activities))
+        insert(Activity, [
+            Activity(id=activity_id, action=action, data_id=thing.id,
+                     created_datetime=when, updated_datetime=when)
+            for activity_id, (action, thing, when) in zip(ids, activities)], self.batch_size)
+
+    def generate_submissions(self, dataset, places):
+        """
+        Insert the submission sets, and their submissions and activity.  The
+        submissions of each type are spread over the places with a power law.
+        """
+        for submission_type, share in SUBMISSION_TYPES:
+            total = int(round(self.submissions * share))
+            counts = get_power_law_counts(total, len(places), self.alpha, self.rng)
+            self.log('Generating %s %s (at most %s on a place)' % (
+                total, submission_type, max(counts or [0])))
+
+            sets = [(place, count) for place, count in zip(places, counts) if count]
+            set_ids = reserve_ids(SubmissionSet, len(sets))
+            insert(SubmissionSet, [
+                SubmissionSet(id=set_id, place_id=place_id, submission_type=submission_type,
+                              submission_count=count)
+                for set_id, ((place_id, _), count) in zip(set_ids, sets)], self.batch_size)
+
+            submissions = []
+            for set_id, ((_, place_created), count) in zip(set_ids, sets):
+                for _ in xrange(count):
+                    submissions.append((set_id, submission_type, place_created))
+                    if len(submissions) >= self.batch_size:
+                        self.insert_submissions(dataset, submissions)
+                        submissions = []
+            self.insert_submissions(dataset, submissions)
+
+    def insert_submissions(self, dataset, submissions):
+        if not submissions:
+            return
+        ids = reserve_ids(SubmittedThing, len(submissions))
+        objs = []
+        for submission_id, (set_id, submission_type, place_created) in zip(ids, submissions):
+            created = self.make_time(place_created)
+            objs.append(Submission(
+                id=submission_id, submittedthing_ptr_id=submission_id,
+                dataset=dataset, parent_id=set_id,
+                data=self.make_submission_data(submission_type),
+                submitter_name=self.make_submitter_name(), visible=True,
+                created_datetime=created, updated_datetime=created))
+        insert(SubmittedThing, objs, self.batch_size)
+        insert(Submission, objs, self.batch_size)
+
+        if self.activity:
+            self.insert_activity([('create', obj, obj.created_datetime) for obj in objs])
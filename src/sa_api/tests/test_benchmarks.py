@@ -0,0 +1,37 @@
+from django.core.management import call_command
+from django.test import TransactionTestCase
+from nose.tools import istest, assert_equal, assert_in, assert_not_in
+from StringIO import StringIO
+from .. import benchmarks
+from ..models import DataSet
+
+
+class TestBenchmarks (object):
+
+    @istest
+    def selects_benchmarks_by_name_or_group(self):
+        names = [name for name, _ in benchmarks.get_benchmarks(['clear_instance', 'process_urls'])]
+        assert_in('clear_instance:Place', names)
+        assert_in('clear_instance:Submission', names)
+        assert_in('process_urls', names)
+        assert_not_in('serialize_places', names)
+
+    @istest
+    def finds_regressions_beyond_the_tolerance(self):
+        baseline = {'a': {'best': 1.0, 'median': 1.1},
+                    'b': {'best': 2.0, 'median': 2.0}}
+        results = {'a': {'best': 1.2, 'median': 1.2},
+                   'b': {'best': 3.0, 'median': 3.0},
+                   'c': {'best': 9.0, 'median': 9.0}}
+        changes, regressions = benchmarks.compare(results, baseline, 0.25)
+        assert_equal(changes, {'a': 1.2, 'b': 1.5})
+        assert_equal(regressions, ['b'])
+
+
+class TestRunBenchmarksCommand (TransactionTestCase):
+
+    @istest
+    def leaves_no_dataset_behind(self):
+        call_command('run_benchmarks', 'serialize_places', places=5, submissions=10,
+                     repeat=1, stdout=StringIO())
+        assert_equal(DataSet.objects.filter(owner__username='benchmark').count(), 0)
@@ -0,0 +1,52 @@
+import datetime
+from collections import defaultdict
+from django.utils.timezone import utc
+from nose.tools import istest, assert_equal, assert_is_instance, assert_less
+from ..cache_serializers import CompactSerializer, PickleSerializer
+
+
+class TestCompactSerializer (object):
+
+    def setup(self):
+        self.serializer = CompactSerializer()
+
+    def round_trip(self, value):
+        return self.serializer.loads(self.serializer.dumps(value))
+
+    @istest
+    def round_trips_the_submission_sets_map(self):
+        submission_sets = defaultdict(list)
+        for place_id in [1, 2, 30]:
+            submission_sets[place_id].append({
+                'type': 'comments',
+                'length': 3,
+                'url': u'/api/v2/user/datasets/ds/places/%s/comments' % place_id,
+            })
+
+        loaded = self.round_trip(submission_sets)
+        assert_equal(loaded, submission_sets)
+        assert_is_instance(loaded, defaultdict)
+        assert_equal(loaded[4], [])
+
+    @istest
+    def round_trips_urls_exactly(self):
+        urls = ['/places/007/', '/places/0/comments', 'https://example.com:8000/a%20b/12',
+                '/no/numbers', u'/caf\xe9/10', '/places/1/2/3?page=4']
+        assert_equal(self.round_trip(urls), urls)
+        assert_equal(map(type, self.round_trip(urls)), map(type, urls))
+
+    @istest
+    def round_trips_datetimes_and_containers(self):
+        value = {
+            'created_datetime': datetime.datetime(2013, 4, 1, 12, 30, 15, 123, tzinfo=utc),
+            'naive': datetime.datetime(1960, 1, 1),
+            'keys': set(['/places:json:', '/places:csv:page=2']),
+            'pair': (1, 'a'),
+            'nothing': None,
+        }
+        assert_equal(self.round_trip(value), value)
+
+    @istest
+    def makes_sets_of_keys_smaller_than_pickle_does(self):
+        keys = set(['/api/v2/user/datasets/ds/places/%s:json:' % n for n in range(100)])
+        assert_less(len(self.serializer.dumps(keys)), len(PickleSerializer().dumps(keys)))
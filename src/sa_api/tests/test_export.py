@@ -0,0 +1,177 @@
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from nose.tools import istest, assert_equal, assert_in, assert_not_in
+from ..models import DataSet, Place, Submission, SubmissionSet
+from .. import export
+import csv
+import gzip
+import json
+import mock
+from StringIO import StringIO
+
+
+class TestExport (TestCase):
+
+    def setUp(self):
+        User.objects.all().delete()
+        DataSet.objects.all().delete()
+        Place.objects.all().delete()
+        Submission.objects.all().delete()
+        SubmissionSet.objects.all().delete()
+        cache.clear()
+
+        self.owner = User.objects.create(username='user')
+        self.dataset = DataSet.objects.create(slug='data', owner=self.owner)
+        self.places = [
+            Place.objects.create(location='POINT(%s 1)' % i,
+                                 dataset=self.dataset,
+                                 data=json.dumps({'name': 'place %s' % i,
+                                                  'private-email': 'a@b.c'}))
+            for i in range(5)
+        ]
+        self.invisible_place = Place.objects.create(
+            location='POINT(0 0)', dataset=self.dataset, visible=False)
+
+        comments = SubmissionSet.objects.create(place=self.places[0],
+                                                submission_type='comments')
+        self.comments = [
+            Submission.objects.create(parent=comments, dataset=self.dataset,
+                                      data=json.dumps({'comment': 'hi %s' % i}))
+            for i in range(3)
+        ]
+
+    def _export(self, *args, **kwargs):
+        return ''.join(export.export_things(self.dataset, *args, **kwargs))
+
+    @istest
+    def exports_visible_places_as_ndjson(self):
+        content = self._export('places', 'ndjson')
+        places = [json.loads(line) for line in content.splitlines()]
+
+        assert_equal([place['id'] for place in places],
+                     [place.id for place in self.places])
+        assert_equal(places[0]['name'], 'place 0')
+        assert_equal(places[0]['submissions'][0]['length'], 3)
+        assert_not_in('private-email', places[0])
+
+    @istest
+    def exports_invisible_and_private_data_when_asked(self):
+        content = self._export('places', 'ndjson', include_invisible=True,
+                               include_private=True)
+        places = [json.loads(line) for line in content.splitlines()]
+
+        assert_equal(len(places), 6)
+        assert_equal(places[0]['private-email'], 'a@b.c')
+
+    @istest
+    def exports_places_as_geojson(self):
+        content = self._export('places', 'geojson')
+        collection = json.loads(content)
+
+        assert_equal(collection['type'], 'FeatureCollection')
+        assert_equal(len(collection['features']), 5)
+        feature = collection['features'][1]
+        assert_equal(feature['geometry'], {'type': 'Point', 'coordinates': [1, 1]})
+        assert_equal(feature['properties']['name'], 'place 1')
+
+    @istest
+    def exports_places_as_csv_in_tabular_form(self):
+        content = self._export('places', 'csv')
+        rows = list(csv.reader(StringIO(content)))
+
+        headers = rows[0]
+        assert_equal(headers, sorted(headers))
+        for header in ['place_id', 'place_location_lat', 'place_location_lng', 'name', 'comments']:
+            assert_in(header, headers)
+        assert_not_in('private-email', headers)
+        assert_equal(len(rows), 6)
+
+        first = dict(zip(headers, rows[1]))
+        assert_equal(first['name'], 'place 0')
+        assert_equal(first['comments'], '3')
+
+    @istest
+    def exports_submissions_of_a_type(self):
+        content = self._export('comments', 'ndjson')
+        comments = [json.loads(line) for line in content.splitlines()]
+
+        assert_equal([comment['comment'] for comment in comments],
+                     ['hi 0', 'hi 1', 'hi 2'])
+        assert_equal(comments[0]['type'], 'comments')
+
+    @istest
+    def resumes_after_the_given_id(self):
+        with self.settings(API_EXPORT_CHUNK_SIZE=2):
+            content = self._export('places', 'ndjson', after=self.places[1].id)
+        places = [json.loads(line) for line in content.splitlines()]
+
+        assert_equal([place['id'] for place in places],
+                     [place.id for place in self.places[2:]])
+
+    @istest
+    def resumed_csv_export_has_no_header_row(self):
+        content = self._export('places', 'csv', after=self.places[3].id)
+        rows = list(csv.reader(StringIO(content)))
+        assert_equal(len(rows), 1)
+
+    @istest
+    def gzip_stream_is_valid_gzip(self):
+        content = ''.join(export.gzip_stream(iter(['hello ', 'world'])))
+        assert_equal(gzip.GzipFile(fileobj=StringIO(content)).read(), 'hello world')
+
+
+class TestDataSetExportView (TestCase):
+
+    def setUp(self):
+        User.objects.all().delete()
+        DataSet.objects.all().delete()
+        Place.objects.all().delete()
+
+        self.owner = User.objects.create(username='user')
+        self.dataset = DataSet.objects.create(slug='data', owner=self.owner)
+        self.place = Place.objects.create(location='POINT(1 1)', dataset=self.dataset)
+
+        self.kwargs = {'owner__username': 'user', 'slug': 'data',
+                       'thing_type': 'places', 'export_format': 'ndjson'}
+        self.url = reverse('dataset_export', kwargs=self.kwargs)
+
+        from ..views import DataSetExportView
+        self.view = DataSetExportView.as_view()
+
+    def _get(self, url, **extra):
+        request = RequestFactory().get(url, **extra)
+        request.user = mock.Mock(**{'is_authenticated.return_value': False,
+                                    'is_superuser': False})
+        return self.view(request, **self.kwargs)
+
+    @istest
+    def streams_the_export_with_absolute_urls(self):
+        response = self._get(self.url)
+        assert_equal(response.status_code, 200)
+        assert_equal(response['Content-Type'], 'application/x-ndjson')
+
+        place = json.loads(''.join(response))
+        assert_equal(place['url'], 'http://testserver/api/v1/user/datasets/data/places/%s/' % self.place.id)
+
+    @istest
+    def compresses_when_the_client_accepts_gzip(self):
+        response = self._get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        assert_equal(response['Content-Encoding'], 'gzip')
+
+        content = gzip.GzipFile(fileobj=StringIO(''.join(response))).read()
+        assert_equal(json.loads(content)['id'], self.place.id)
+
+    @istest
+    def does_not_compress_when_the_client_refuses_gzip(self):
+        for accept_encoding in ['gzip;q=0, deflate', 'x-gzip-ish']:
+            response = self._get(self.url, HTTP_ACCEPT_ENCODING=accept_encoding)
+            assert_equal(response.get('Content-Encoding'), None)
+            assert_equal(json.loads(''.join(response))['id'], self.place.id)
+
+    @istest
+    def private_data_requires_the_owner(self):
+        response = self._get(self.url + '?show_private')
+        assert_equal(response.status_code, 403)
@@ -0,0 +1,71 @@
+from mock import patch
+from nose.tools import istest, assert_equal, assert_is_none
+from ..hostcache import HostCache
+import os
+import shutil
+import tempfile
+
+
+class TestHostCache (object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.host_cache = HostCache(directory=self.directory, max_size=150)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    @istest
+    def stores_content_by_key_and_generation(self):
+        self.host_cache.set('key', 'gen1', {'status': 200}, 'content')
+
+        assert_equal(self.host_cache.get('key', 'gen1'), ({'status': 200}, 'content'))
+        assert_is_none(self.host_cache.get('key', 'gen2'))
+        assert_is_none(self.host_cache.get('other', 'gen1'))
+
+    @istest
+    def stores_content_for_non_ascii_keys(self):
+        key = u'/api/v2/user/datasets/caf\xe9/places:json:'
+        self.host_cache.set(key, 'gen1', None, 'content')
+
+        assert_equal(self.host_cache.get(key, 'gen1'), (None, 'content'))
+        self.host_cache.delete_many([key])
+        assert_is_none(self.host_cache.get(key, 'gen1'))
+
+    @istest
+    def replaces_older_generations(self):
+        self.host_cache.set('key', 'gen1', None, 'old content')
+        self.host_cache.set('key', 'gen2', None, 'new content')
+
+        assert_is_none(self.host_cache.get('key', 'gen1'))
+        assert_equal(len(os.listdir(self.directory)), 1)
+
+    @istest
+    def deletes_keys(self):
+        self.host_cache.set('key', 'gen1', None, 'content')
+        self.host_cache.delete_many(['key'])
+
+        assert_is_none(self.host_cache.get('key', 'gen1'))
+
+    @istest
+    def evicts_the_least_recently_used_files(self):
+        self.host_cache.set('a', 'gen', None, 'x' * 40)
+        self.host_cache.set('b', 'gen', None, 'x' * 40)
+        os.utime(self.host_cache.get_path('a'), (0, 0))
+        self.host_cache.set('c', 'gen', None, 'x' * 40)
+
+        assert_is_none(self.host_cache.get('a', 'gen'))
+        assert_equal(self.host_cache.get('b', 'gen'), (None, 'x' * 40))
+        assert_equal(self.host_cache.get('c', 'gen'), (None, 'x' * 40))
+
+    @istest
+    def only_scans_the_directory_when_it_may_be_full(self):
+        self.host_cache.set('a', 'gen', None, 'x' * 10)
+        with patch('os.listdir', wraps=os.listdir) as listdir:
+            self.host_cache.set('b', 'gen1', None, 'x' * 10)
+            self.host_cache.set('b', 'gen2', None, 'x' * 10)
+            self.host_cache.delete_many(['a'])
+            assert_equal(listdir.call_count, 0)
+
+            self.host_cache.set('c', 'gen', None, 'x' * 150)
+            assert_equal(listdir.call_count, 1)
@@ -0,0 +1,170 @@
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from mock import patch
+from nose.tools import istest, assert_equal, assert_in, assert_not_in, assert_true, assert_raises
+from .. import instrumentation
+from ..middleware import RequestInstrumentation, RepeatedQueryDetector
+import json
+import tempfile
+
+
+class TestRequestInstrumentation (object):
+
+    def setup(self):
+        cache.clear()
+        self.middleware = RequestInstrumentation()
+
+    def handle(self, view, user=None):
+        request = RequestFactory().get('/api/v1/')
+        if user is not None:
+            request.user = user
+        self.middleware.process_request(request)
+        self.middleware.process_view(request, view, (), {})
+        return self.middleware.process_response(request, view(request))
+
+    @istest
+    def times_cache_operations_and_phases(self):
+        def view(request):
+            cache.set('a', 1)
+            cache.get('a')
+            cache.get_many(['a', 'b'])
+            with instrumentation.timed('render'):
+                pass
+            instrumentation.show_timing()
+            return HttpResponse()
+
+        response = self.handle(view)
+        timing = response['Server-Timing']
+        assert_true(timing.startswith('total;dur='))
+        assert_in('cache;dur=', timing)
+        assert_in('desc="3 operations, 2 hits, 1 misses"', timing)
+        assert_in('render;dur=', timing)
+        assert_not_in('sql;', timing)
+
+    @istest
+    def only_shows_timing_to_authorized_callers(self):
+        class User (object):
+            is_superuser = False
+
+        response = self.handle(lambda request: HttpResponse(), User())
+        assert_not_in('Server-Timing', response)
+
+        User.is_superuser = True
+        response = self.handle(lambda request: HttpResponse(), User())
+        assert_in('Server-Timing', response)
+
+    @istest
+    def adds_requests_to_the_view_histograms(self):
+        def timed_view(request):
+            return HttpResponse()
+
+        for _ in range(3):
+            self.handle(timed_view)
+        instrumentation.view_timings.flush_counts()
+
+        assert_in('timed_view', instrumentation.get_view_names())
+        stats = instrumentation.get_view_stats('timed_view')
+        assert_equal(stats['count'], 3)
+        assert_equal(sum([count for bucket, count in stats['buckets']]), 3)
+
+
+class TestRepeatedQueryDetector (object):
+
+    def handle(self, view):
+        instrumentation_middleware = RequestInstrumentation()
+        with patch('django.conf.settings.API_REPEATED_QUERY_THRESHOLD', 2):
+            detector = RepeatedQueryDetector()
+            request = RequestFactory().get('/api/v1/')
+            instrumentation_middleware.process_request(request)
+            detector.process_request(request)
+            response = detector.process_response(request, view(request))
+        return instrumentation_middleware.process_response(request, response)
+
+    @istest
+    def is_not_used_without_a_threshold(self):
+        with patch('django.conf.settings.API_REPEATED_QUERY_THRESHOLD', None):
+            assert_raises(MiddlewareNotUsed, RepeatedQueryDetector)
+
+    @istest
+    def fingerprints_queries_without_their_literals(self):
+        assert_equal(
+            instrumentation.fingerprint("SELECT * FROM t WHERE id = 12 AND name = 'it''s'"),
+            instrumentation.fingerprint('SELECT * FROM t WHERE id = %s AND name = %s'))
+        assert_equal(
+            instrumentation.fingerprint('SELECT * FROM t2 WHERE id IN (1, 2, 3)'),
+            'SELECT * FROM t2 WHERE id IN (...)')
+
+    @istest
+    def logs_repeated_queries_with_their_stack(self):
+        def lazy_load(profile, pk):
+            profile.queries.append(('SELECT * FROM sa_api_dataset WHERE id = %s' % pk,
+                                    instrumentation.get_stack()))
+
+        def view(request):
+            profile = instrumentation.current()
+            for pk in range(3):
+                lazy_load(profile, pk)
+            profile.queries.append(('SELECT * FROM sa_api_place', instrumentation.get_stack()))
+            return HttpResponse()
+
+        with patch('sa_api.middleware.logging.getLogger') as getLogger:
+            self.handle(view)
+        warning = getLogger.return_value.warning
+        assert_equal(warning.call_count, 1)
+        message = warning.call_args[0][0]
+        assert_in('made 3 queries like: SELECT * FROM sa_api_dataset WHERE id = ?', message)
+        assert_in('in lazy_load', message)
+
+
+class TestRequestTracing (object):
+
+    def setup(self):
+        cache.clear()
+        self.trace_file = tempfile.NamedTemporaryFile(suffix='.jsonl')
+
+    def teardown(self):
+        self.trace_file.close()
+
+    def handle(self, view, min_duration=0):
+        with patch('django.conf.settings.API_TRACE_FILE', self.trace_file.name):
+            with patch('django.conf.settings.API_TRACE_MIN_DURATION', min_duration):
+                middleware = RequestInstrumentation()
+                request = RequestFactory().get('/api/v1/')
+                middleware.process_request(request)
+                return middleware.process_response(request, view(request))
+
+    def read_traces(self):
+        with open(self.trace_file.name) as trace_file:
+            return [json.loads(line) for line in trace_file]
+
+    @istest
+    def writes_a_tree_of_spans_per_request(self):
+        def view(request):
+            with instrumentation.span('cache_lookup'):
+                cache.get('a')
+            with instrumentation.span('invalidate', model='Place'):
+                with instrumentation.span('invalidate', model='DataSet'):
+                    pass
+            with instrumentation.timed('render'):
+                pass
+            return HttpResponse(status=201)
+
+        self.handle(view)
+        traces = self.read_traces()
+        assert_equal(len(traces), 1)
+        trace = traces[0]
+        assert_equal((trace['method'], trace['path'], trace['status']), ('GET', '/api/v1/', 201))
+
+        spans = trace['spans']
+        assert_equal([span['name'] for span in spans], ['cache_lookup', 'invalidate', 'render'])
+        assert_equal(spans[0]['children'][0]['name'], 'cache')
+        assert_equal(spans[1]['attrs'], {'model': 'Place'})
+        assert_equal(spans[1]['children'][0]['attrs'], {'model': 'DataSet'})
+        assert_true(all([span['start'] >= 0 and span['duration'] >= 0 for span in spans]))
+
+    @istest
+    def only_writes_slow_requests(self):
+        self.handle(lambda request: HttpResponse(), min_duration=60)
+        assert_equal(self.read_traces(), [])
@@ -0,0 +1,81 @@
+from django.core.cache import cache
+from mock import patch
+from nose.tools import istest, assert_equal, assert_is_none
+from ..cache_serializers import CompactSerializer
+from ..localcache import TieredCache, LocalBroadcast
+from .. import metrics
+
+
+class TestTieredCache (object):
+
+    def setup(self):
+        cache.clear()
+        broadcast = LocalBroadcast()
+        # Two processes, sharing one cache and one invalidation channel.
+        self.worker1 = TieredCache(max_entries=2, timeout=60, broadcast=broadcast)
+        self.worker2 = TieredCache(max_entries=2, timeout=60, broadcast=broadcast)
+
+    @istest
+    def serves_values_from_the_local_tier(self):
+        self.worker1.set('a', {'x': 1})
+        cache.delete('a')
+
+        assert_equal(self.worker1.get('a'), {'x': 1})
+        assert_is_none(self.worker2.get('a'))
+
+    @istest
+    def gives_each_caller_its_own_copy(self):
+        self.worker1.set('a', {'x': 1})
+        self.worker1.get('a')['x'] = 2
+
+        assert_equal(self.worker1.get('a'), {'x': 1})
+
+    @istest
+    def deletes_are_broadcast_to_other_processes(self):
+        self.worker1.set('a', 1)
+        assert_equal(self.worker2.get('a'), 1)
+
+        self.worker1.delete_many(['a'])
+        assert_is_none(self.worker2.get('a'))
+        assert_is_none(self.worker1.get('a'))
+
+    @istest
+    def evicts_the_least_recently_used_values(self):
+        for key in ['a', 'b']:
+            self.worker1.set(key, key)
+        self.worker1.get('a')
+        self.worker1.set('c', 'c')
+
+        assert_equal(self.worker1.entries.keys(), ['a', 'c'])
+
+    @istest
+    def expires_local_values(self):
+        worker = TieredCache(max_entries=2, timeout=-1, broadcast=LocalBroadcast())
+        worker.set('a', 1)
+        cache.set('a', worker.serializer.dumps(2))
+
+        assert_equal(worker.get('a'), 2)
+
+    @istest
+    def stores_values_with_the_given_serializer(self):
+        worker = TieredCache(max_entries=2, timeout=60, broadcast=LocalBroadcast(),
+                             serializer=CompactSerializer())
+        worker.set('a', set(['/places/1', '/places/2']))
+
+        assert_equal(CompactSerializer().loads(cache.get('a')), set(['/places/1', '/places/2']))
+        assert_equal(worker.get('a'), set(['/places/1', '/places/2']))
+
+    @istest
+    def counts_lookups_per_tier(self):
+        counts = metrics.Counts()
+        with patch.object(metrics, 'counts', counts):
+            self.worker1.set('a', 1)
+            self.worker1.get('a')
+            self.worker2.get('a')
+            self.worker2.get('b')
+        counts.flush_counts()
+
+        counts = metrics.get_many(['local_cache_hits', 'local_cache_misses',
+                                   'shared_cache_hits', 'shared_cache_misses'])
+        assert_equal(counts, {'local_cache_hits': 1, 'local_cache_misses': 2,
+                              'shared_cache_hits': 1, 'shared_cache_misses': 1})
@@ -0,0 +1,46 @@
+from django.core.cache import cache
+from mock import patch
+from nose.tools import istest, assert_equal
+from .. import metrics
+
+
+class TestCounts (object):
+
+    def setup(self):
+        cache.clear()
+        self.counts = metrics.Counts()
+
+    @istest
+    def adds_up_counts_in_process_until_flushed(self):
+        self.counts.count('cache_hits')
+        self.counts.count('cache_hits')
+        self.counts.count('response_bytes_saved', 300)
+        assert_equal(metrics.get_many(['cache_hits', 'response_bytes_saved']),
+                     {'cache_hits': 0, 'response_bytes_saved': 0})
+
+        self.counts.flush_counts()
+        assert_equal(metrics.get_many(['cache_hits', 'response_bytes_saved']),
+                     {'cache_hits': 2, 'response_bytes_saved': 300})
+
+    @istest
+    def flushes_after_enough_events_or_time(self):
+        self.counts.flush_counts_every = 3
+        for _ in range(3):
+            self.counts.count('cache_hits')
+        assert_equal(metrics.get('cache_hits'), 3)
+
+        self.counts.count('cache_hits')
+        assert_equal(metrics.get('cache_hits'), 3)
+        with patch('time.time', return_value=self.counts.last_flush + self.counts.flush_interval):
+            self.counts.count('cache_hits')
+        assert_equal(metrics.get('cache_hits'), 5)
+
+    @istest
+    def registers_names_along_with_the_counts(self):
+        self.counts.count_many({'request_seconds_count:a': 1}, {'views': ['a']})
+        self.counts.count_many({'request_seconds_count:b': 2}, {'views': ['b']})
+        assert_equal(metrics.get_names('views'), set())
+
+        self.counts.flush_counts()
+        assert_equal(metrics.get_names('views'), set(['a', 'b']))
+        assert_equal(metrics.get('request_seconds_count:b'), 2)
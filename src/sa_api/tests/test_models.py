@@ -3,12 +3,13 @@ from django.test.client import Client
 from django.test.client import RequestFactory
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from djangorestframework.response import ErrorResponse
 from mock import patch
 from nose.tools import (istest, assert_equal, assert_not_equal, assert_in,
                         assert_raises)
 from ..models import DataSet, Place, Submission, SubmissionSet
-from ..models import SubmittedThing, Activity
+from ..models import SubmittedThing, Activity, DataSetSummary
 from ..views import SubmissionCollectionView
 from ..views import raise_error_if_not_authenticated
 from ..views import ApiKeyCollectionView
@@ -61,3 +62,23 @@ class TestSubmittedThingModel(TestCase):
         qs = Activity.objects.all()
         self.assertEqual(qs.count(), 1)
 
+
+class TestDataSetSummaryModel(TestCase):
+
+    @istest
+    def records_changes_within_the_callers_transaction(self):
+        owner = User.objects.create(username='myuser')
+        dataset = DataSet.objects.create(slug='data', owner=owner)
+        place = Place.objects.create(dataset=dataset, location='POINT(0 0)')
+
+        def fail(summary):
+            raise ValueError()
+
+        # The test runs in a managed transaction, which must be neither
+        # committed nor rolled back by the failed change.
+        with patch.object(transaction, 'commit') as commit:
+            with patch.object(transaction, 'rollback') as rollback:
+                assert_raises(ValueError, DataSetSummary.record_change, place, fail)
+        assert_equal(commit.call_count, 0)
+        assert_equal(rollback.call_count, 0)
+        assert_equal(Place.objects.filter(pk=place.pk).count(), 1)
@@ -0,0 +1,93 @@
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from mock import patch
+from nose.tools import istest, assert_equal, assert_in, assert_not_in, assert_true
+import mock
+from .. import profiler
+from ..middleware import RequestProfiler
+
+
+def inner():
+    return sum(range(20000))
+
+
+def outer():
+    for _ in range(20):
+        inner()
+
+
+class TestProfileFormats (object):
+
+    def get_stats(self):
+        import pstats
+        request_profiler, _ = profiler.profile_call(outer)
+        return pstats.Stats(request_profiler)
+
+    @istest
+    def collapses_the_call_graph_into_stacks(self):
+        lines = profiler.format_collapsed(self.get_stats()).splitlines()
+        stacks = [line.rsplit(' ', 1)[0].split(';') for line in lines]
+        assert_true(any([stack[-2].endswith('(outer)') and stack[-1].endswith('(inner)')
+                         for stack in stacks if len(stack) > 1]), lines)
+
+    @istest
+    def splits_the_time_by_component(self):
+        stats = self.get_stats()
+        with patch('sa_api.profiler.COMPONENTS', (('summing', ('sum',)),)):
+            times = profiler.get_component_times(stats)
+            text = profiler.format_stats(stats, 'total;dur=1.0')
+        assert_equal(set(times), set(['summing', 'other']))
+        assert_in('Phases: total;dur=1.0', text)
+        assert_in('summing', text)
+        assert_in('cumulative', text)
+
+
+class TestRequestProfiler (object):
+
+    def setup(self):
+        cache.clear()
+        self.middleware = RequestProfiler()
+        self.seen = []
+
+    def view(self, request):
+        self.seen.append(request.GET.copy())
+        return HttpResponse('places')
+
+    def handle(self, path, is_superuser=True, **headers):
+        request = RequestFactory().get(path, **headers)
+        request.user = mock.Mock(is_superuser=is_superuser)
+        response = self.middleware.process_view(request, self.view, (), {})
+        return request, response
+
+    @istest
+    def sends_superusers_the_profile_of_the_view(self):
+        # The view is too quick to get a stack of its own otherwise.
+        with patch('sa_api.profiler.MIN_STACK_SECONDS', 0):
+            request, response = self.handle('/api/v1/?_profile=collapsed&visible=all')
+        assert_equal(response['X-Shareabouts-Profiled-Status'], '200')
+        assert_in('(view)', response.content)
+        assert_equal(request.META['QUERY_STRING'], 'visible=all')
+        assert_not_in('_profile', self.seen[0])
+
+        request, response = self.handle('/api/v1/', HTTP_X_SHAREABOUTS_PROFILE='pstats')
+        assert_equal(response['Content-Type'], 'application/octet-stream')
+
+    @istest
+    def does_not_profile_for_other_users(self):
+        request, response = self.handle('/api/v1/?_profile=stats', is_superuser=False)
+        assert_equal(response, None)
+        assert_not_in('_profile', request.GET)
+
+    @istest
+    def limits_the_rate_of_profiling(self):
+        with patch('django.conf.settings.API_PROFILE_RATE_LIMIT', 2):
+            statuses = [self.handle('/api/v1/?_profile')[1].status_code for _ in range(3)]
+        assert_equal(statuses, [200, 200, 429])
+
+    @istest
+    def serves_the_normal_response_when_profiling_is_off(self):
+        with patch('django.conf.settings.API_PROFILE_RATE_LIMIT', 0):
+            request, response = self.handle('/api/v1/?_profile=stats&visible=all')
+        assert_equal(response, None)
+        assert_equal(request.META['QUERY_STRING'], 'visible=all')
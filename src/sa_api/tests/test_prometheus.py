@@ -0,0 +1,48 @@
+from django.core.cache import cache
+from nose.tools import istest, assert_equal, assert_in
+from .. import instrumentation
+from .. import metrics
+from .. import prometheus
+
+
+class TestPrometheusExposition (object):
+
+    def setup(self):
+        cache.clear()
+
+    @istest
+    def exposes_the_counters_and_hit_ratios(self):
+        metrics.incr('cache_hits', 3)
+        metrics.incr('cache_misses')
+        metrics.incr('cache_invalidations:Place', 2)
+        metrics.incr('cache_keys_deleted:Place', 7)
+
+        text = prometheus.render(model_names=['Place'])
+        assert_in('# TYPE shareabouts_cache_hits_total counter\nshareabouts_cache_hits_total 3\n', text)
+        assert_in('shareabouts_cache_hit_ratio{cache="response"} 0.75\n', text)
+        assert_in('shareabouts_cache_hit_ratio{cache="local"} 0.0\n', text)
+        assert_in('shareabouts_cache_invalidations_total{model="Place"} 2\n', text)
+        assert_in('shareabouts_cache_keys_deleted_total{model="Place"} 7\n', text)
+
+    @istest
+    def exposes_cumulative_request_histograms_and_auth_timings(self):
+        for duration in (0.001, 0.002, 20):
+            profile = instrumentation.RequestProfile()
+            profile.view_name = 'place_collection'
+            profile.end_time = profile.start_time + duration
+            profile.add('auth', 0.5, 'BasicAuthentication')
+            instrumentation.view_timings.record(profile)
+        instrumentation.view_timings.flush_counts()
+
+        text = prometheus.render(model_names=[])
+        assert_in('shareabouts_request_duration_seconds_bucket{le="0.01",view="place_collection"} 2\n', text)
+        assert_in('shareabouts_request_duration_seconds_bucket{le="10",view="place_collection"} 2\n', text)
+        assert_in('shareabouts_request_duration_seconds_bucket{le="+Inf",view="place_collection"} 3\n', text)
+        assert_in('shareabouts_request_duration_seconds_count{view="place_collection"} 3\n', text)
+        assert_in('shareabouts_request_phase_seconds_total{phase="auth",view="place_collection"} 1.5\n', text)
+        assert_in('shareabouts_auth_attempts_total{backend="BasicAuthentication"} 3\n', text)
+        assert_in('shareabouts_auth_seconds_total{backend="BasicAuthentication"} 1.5\n', text)
+
+    @istest
+    def escapes_label_values(self):
+        assert_equal(prometheus.escape_label_value('a "b"\\\n'), u'a \\"b\\"\\\\\\n')
@@ -0,0 +1,238 @@
+"""
+Regression tests for the database work done by each endpoint: the number of
+queries that a request makes must not grow with the size of the dataset,
+and the main collection queries must be able to use their indexes.
+
+Requests are made with cold caches, so that every query that an endpoint
+can make is counted.
+"""
+import difflib
+import re
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+from django.test.client import Client
+from mock import patch
+from nose.tools import istest, assert_equal
+from .. import instrumentation
+from .. import synthetic
+from .. import urls
+from ..localcache import tiered_cache
+from ..models import Place, Submission
+
+
+# The sizes of the fixture datasets (in places, and in submissions) that the
+# query counts are compared between.
+SMALL, LARGE = 10, 1000
+
+# Endpoints that can't be checked with a GET request.
+SKIPPED = {
+    'owner_password': 'only takes PUT requests',
+}
+
+# Endpoints that are requested by a logged in superuser.
+SUPERUSER_ONLY = set([
+    'api_key_collection_by_dataset',
+    'api_key_collection_by_dataset_1',
+    'metrics',
+])
+
+# The indexes (as a table and the possible leading columns) that the queries
+# behind the main collections have to be able to use.
+EXPECTED_INDEXES = {
+    'dataset_collection_by_user': [
+        ('sa_api_dataset', ('owner_id',)),
+    ],
+    'place_collection_by_dataset': [
+        ('sa_api_submittedthing', ('dataset_id',)),
+    ],
+    'submission_collection_by_dataset': [
+        ('sa_api_submissionset', ('place_id',)),
+        ('sa_api_submission', ('parent_id',)),
+    ],
+    'all_submissions_by_dataset': [
+        ('sa_api_submittedthing', ('dataset_id',)),
+    ],
+    'activity_collection_by_dataset': [
+        ('sa_api_activity', ('data_id', 'id')),
+    ],
+}
+
+INDEX_SCAN_PATTERN = re.compile(r'Index (?:Only )?Scan (?:Backward )?(?:using|on) "?(\w+)"?')
+
+
+def get_index_columns():
+    """
+    Get the table, and the leading column, of each index in the database.
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT c.relname, t.relname, a.attname FROM pg_index i '
+        'JOIN pg_class c ON c.oid = i.indexrelid '
+        'JOIN pg_class t ON t.oid = i.indrelid '
+        'JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = i.indkey[0]')
+    return dict([(index, (table, column)) for index, table, column in cursor.fetchall()])
+
+
+def explain(sql):
+    """
+    Get the plan for a query, with sequential scans discouraged, so that the
+    plan shows whether an index *can* be used, however few rows there are.
+    """
+    cursor = connection.cursor()
+    cursor.execute('SET enable_seqscan = off')
+    try:
+        # The query has its parameters filled in already.
+        cursor.execute('EXPLAIN ' + sql.replace('%', '%%'), [])
+        return '\n'.join([row[0] for row in cursor.fetchall()])
+    finally:
+        cursor.execute('RESET enable_seqscan')
+
+
+class QueryFixture (object):
+    """
+    A synthetic dataset of a given size, and the arguments for requesting
+    each endpoint for it.
+    """
+    def __init__(self, size):
+        generator = synthetic.DataSetGenerator(places=size, submissions=size,
+                                               attachment_share=0.5, seed=1)
+        self.owner = 'queries-%s' % size
+        self.dataset = generator.generate(self.owner, self.owner)
+
+        self.place = Place.objects.filter(
+            dataset=self.dataset, submission_sets__submission_type='comments')[0]
+        self.submission = Submission.objects.filter(parent__place=self.place,
+                                                    parent__submission_type='comments')[0]
+
+    def get_kwargs(self, pattern):
+        # Instance ids are for submissions on the submission endpoints, and
+        # for places otherwise.
+        params = pattern.regex.groupindex
+        thing = self.submission if 'submission_type' in params else self.place
+        values = {
+            'pk': thing.pk,
+            'thing_id': thing.pk,
+            'place_id': self.place.pk,
+            'submission_type': 'comments',
+            'thing_type': 'places',
+            'export_format': 'geojson',
+        }
+
+        kwargs = {}
+        for param in params:
+            # The owner and dataset are named after the relations that each
+            # view looks them up through (e.g., data__dataset__slug).
+            if param.endswith('owner__username'):
+                kwargs[param] = self.owner
+            elif param.endswith('slug'):
+                kwargs[param] = self.dataset.slug
+            else:
+                kwargs[param] = values[param]
+        return kwargs
+
+    def get_path(self, pattern):
+        return reverse(pattern.name, kwargs=self.get_kwargs(pattern))
+
+
+def get_patterns():
+    return [pattern for pattern in urls.urlpatterns
+            if pattern.name and pattern.name not in SKIPPED]
+
+
+class TestQueriesPerEndpoint (TestCase):
+
+    def setUp(self):
+        self.fixtures = dict([(size, QueryFixture(size)) for size in (SMALL, LARGE)])
+        User.objects.create_superuser('queries-admin', 'admin@example.com', 'password')
+
+    def tearDown(self):
+        cache.clear()
+
+    def request(self, pattern, fixture):
+        """
+        Make a GET request for the endpoint with cold caches.  Returns the
+        response and the SQL of the queries that were made for it.
+        """
+        cache.clear()
+        tiered_cache.invalidate_local(None)
+
+        client = Client()
+        if pattern.name in SUPERUSER_ONLY:
+            client.login(username='queries-admin', password='password')
+
+        connection.use_debug_cursor = True
+        try:
+            # Exports are read a chunk at a time, by design; read them in one.
+            with patch('django.conf.settings.API_EXPORT_CHUNK_SIZE', LARGE * 10):
+                response = client.get(fixture.get_path(pattern))
+                response.content
+            # The queries are reset at the start of each request.
+            queries = [query['sql'] for query in connection.queries]
+        finally:
+            connection.use_debug_cursor = None
+        return response, queries
+
+    @istest
+    def query_counts_do_not_grow_with_the_dataset(self):
+        failures = []
+        for pattern in get_patterns():
+            counted = {}
+            for size, fixture in sorted(self.fixtures.items()):
+                response, queries = self.request(pattern, fixture)
+                if response.status_code != 200:
+                    failures.append('%s: %s for %s rows' % (pattern.name, response.status_code, size))
+                counted[size] = [instrumentation.fingerprint(sql) for sql in queries]
+
+            if len(counted[SMALL]) != len(counted[LARGE]):
+                diff = difflib.unified_diff(
+                    counted[SMALL], counted[LARGE], lineterm='',
+                    fromfile='%s rows' % SMALL, tofile='%s rows' % LARGE)
+                failures.append('%s: %s queries for %s rows, but %s for %s rows\n%s' % (
+                    pattern.name, len(counted[SMALL]), SMALL, len(counted[LARGE]), LARGE,
+                    '\n'.join(diff)))
+
+        if failures:
+            self.fail('\n\n'.join(failures))
+
+    @istest
+    def collection_queries_use_their_indexes(self):
+        index_columns = get_index_columns()
+        patterns = dict([(pattern.name, pattern) for pattern in get_patterns()])
+        fixture = self.fixtures[LARGE]
+
+        failures = []
+        for name, expected in sorted(EXPECTED_INDEXES.items()):
+            _, queries = self.request(patterns[name], fixture)
+            plans = [explain(sql) for sql in queries if sql.lstrip().upper().startswith('SELECT')]
+
+            used = set()
+            for plan in plans:
+                for index in INDEX_SCAN_PATTERN.findall(plan):
+                    if index in index_columns:
+                        used.add(index_columns[index])
+
+            missing = [(table, columns) for table, columns in expected
+                       if not any((table, column) in used for column in columns)]
+            if missing:
+                expected_lines = ['%s (%s)' % (table, ' or '.join(columns)) for table, columns in expected]
+                used_lines = ['%s (%s)' % index for index in sorted(used)]
+                diff = difflib.unified_diff(expected_lines, used_lines, lineterm='',
+                                            fromfile='expected indexes', tofile='used indexes')
+                failures.append('%s:\n%s\n\nPlans:\n%s' % (
+                    name, '\n'.join(diff), '\n\n'.join(plans)))
+
+        if failures:
+            self.fail('\n\n'.join(failures))
+
+
+class TestEndpointCoverage (object):
+
+    @istest
+    def lists_only_existing_endpoints(self):
+        names = set([pattern.name for pattern in urls.urlpatterns if pattern.name])
+        assert_equal(sorted(set(SKIPPED) - names), [])
+        assert_equal(sorted(SUPERUSER_ONLY - names), [])
+        assert_equal(sorted(set(EXPECTED_INDEXES) - names), [])
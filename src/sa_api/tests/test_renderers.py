@@ -66,3 +66,29 @@ class TestCSVRenderer (TestCase):
         dump = renderer.render([{u'a': 1, u'b': u'hello\u2014goodbye', u'c': 'http://example.com/'}])
         self.assertEqual(dump, (u'a,b,c\r\n1,hello—goodbye,http://example.com/\r\n').encode('utf-8'))
 
+
+    def test_tablize_items_with_the_same_keys_and_different_shapes(self):
+        renderer = CSVRenderer(None)
+
+        flat = renderer.tablize([{'a': 1},
+                                 {'a': [2, 3]},
+                                 {'a': {'x': 4}}])
+        self.assertEqual(flat, [['a' , 'a.0', 'a.1', 'a.x'],
+                                [1   , None , None , None ],
+                                [None, 2    , 3    , None ],
+                                [None, None , None , 4    ]])
+
+    def test_iter_rows_with_given_headers(self):
+        renderer = CSVRenderer(None)
+
+        rows = renderer.iter_rows([{'a': 1, 'b': {'x': 2}},
+                                   {'b': {'x': 3}, 'c': 4}], ['b.x', 'c'])
+        self.assertEqual([list(row) for row in rows], [[2, None],
+                                                       [3, 4   ]])
+
+    def test_render_for_a_view_in_chunks_of_rows(self):
+        renderer = CSVRenderer(object())
+        renderer.rows_per_chunk = 2
+
+        chunks = renderer.render([{'a': 1}, {'a': 2}, {'a': 3}])
+        self.assertEqual(list(chunks), ['a\r\n1\r\n', '2\r\n3\r\n'])
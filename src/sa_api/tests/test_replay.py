@@ -0,0 +1,121 @@
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from nose.tools import istest, assert_equal, assert_is_none
+from .. import replay
+import json
+
+
+class TestTraceParsing (object):
+
+    @istest
+    def reads_access_log_lines(self):
+        line = ('1.2.3.4 - - [01/Apr/2013:10:00:00 +0000] '
+                '"GET /api/v1/openplans/datasets/chicago/places/12/?format=json HTTP/1.1" '
+                '200 512 "-" "Mozilla/5.0"')
+        traced = replay.parse_line(line)
+        assert_equal(traced.method, 'GET')
+        assert_equal(traced.path, '/api/v1/openplans/datasets/chicago/places/12/')
+        assert_equal(traced.query_string, 'format=json')
+
+    @istest
+    def reads_method_and_path_lines(self):
+        traced = replay.parse_line('post /api/v1/openplans/datasets/chicago/places/\n')
+        assert_equal(traced.method, 'POST')
+        assert_equal(traced.full_path, '/api/v1/openplans/datasets/chicago/places/')
+
+    @istest
+    def reads_json_lines(self):
+        traced = replay.parse_line(
+            '{"method": "PUT", "path": "http://example.com/api/v1/a/datasets/b/places/1/?x=1", '
+            '"body": {"name": "Place"}}')
+        assert_equal(traced.method, 'PUT')
+        assert_equal(traced.full_path, '/api/v1/a/datasets/b/places/1/?x=1')
+        assert_equal(traced.body, '{"name": "Place"}')
+
+    @istest
+    def skips_lines_that_are_not_requests(self):
+        requests = list(replay.read_trace(['\n', '{"no": "path"}\n', 'GET /api/v1/\n']))
+        assert_equal([traced.path for traced in requests], ['/api/v1/'])
+
+
+class TestFixtureMapping (object):
+
+    def setup(self):
+        self.fixture = replay.Fixture(
+            'replay', 'replay', 'key', [10, 20],
+            {(10, 'comments'): [101, 102], (20, 'comments'): [201]})
+
+    @istest
+    def maps_ids_consistently(self):
+        kwargs = {'dataset__owner__username': 'openplans', 'dataset__slug': 'chicago',
+                  'place_id': '7', 'submission_type': 'votes', 'pk': '3'}
+        mapped = self.fixture.map_kwargs('submission_instance_by_dataset', kwargs)
+        assert_equal(mapped, {'dataset__owner__username': 'replay', 'dataset__slug': 'replay',
+                              'place_id': 10, 'submission_type': 'comments', 'pk': 101})
+
+        mapped = self.fixture.map_kwargs('place_instance_by_dataset', {'pk': '8'})
+        assert_equal(mapped, {'pk': 20})
+        mapped = self.fixture.map_kwargs('place_instance_by_dataset', {'pk': '7'})
+        assert_equal(mapped, {'pk': 10})
+
+
+class TestReplaySummary (object):
+
+    @istest
+    def reports_percentiles_per_url_name(self):
+        results = [replay.Result('place_instance_by_dataset', 200, seconds / 100.0, 2)
+                   for seconds in range(1, 101)]
+        results.append(replay.Result('place_collection_by_dataset', 404, 0.5))
+
+        summary = replay.summarize(results, 2.0)
+        assert_equal(summary['count'], 101)
+        assert_equal(summary['throughput'], 50.5)
+
+        places = summary['url_names']['place_instance_by_dataset']
+        assert_equal((places['p50'], places['p95'], places['p99']), (0.5, 0.95, 0.99))
+        assert_equal(places['queries'], 2.0)
+        assert_equal(places['statuses'], {200: 100})
+        assert_is_none(summary['url_names']['place_collection_by_dataset']['queries'])
+
+
+class TestRequestCapture (object):
+
+    @istest
+    def records_replayable_requests_with_private_data_redacted(self):
+        body = json.dumps({'name': 'Place', 'private-email': 'me@example.com',
+                           'location': {'lat': 40, 'lng': -75}})
+        request = RequestFactory().post(
+            '/api/v1/datasets/openplans/chicago/places/?apikey=abc&visible=all',
+            data=body, content_type='application/json')
+        content_type = replay.get_captured_content_type(request)
+        assert_equal(content_type, 'application/json')
+
+        capture = replay.get_capture(request, HttpResponse('{"id": 1}', status=201), 0.05,
+                                     request.body, content_type)
+        assert_equal(capture['url_name'], 'place_collection_by_dataset')
+        assert_equal(capture['kwargs'], {'dataset__owner__username': 'openplans',
+                                         'dataset__slug': 'chicago'})
+        assert_equal(capture['query_string'], 'apikey=REDACTED&visible=all')
+        assert_equal(capture['body']['private-email'], 'REDACTED')
+        assert_equal((capture['status'], capture['size'], capture['duration']), (201, 9, 50.0))
+
+        traced = replay.parse_line(json.dumps(capture))
+        assert_equal(traced.method, 'POST')
+        assert_equal(traced.full_path, '/api/v1/openplans/datasets/chicago/places/?apikey=REDACTED&visible=all')
+        assert_equal(json.loads(traced.body)['name'], 'Place')
+        assert_equal(traced.content_type, 'application/json')
+
+    @istest
+    def skips_bodies_that_it_cannot_redact(self):
+        request = RequestFactory().put('/api/v1/openplans/password', data='secret',
+                                       content_type='text/plain')
+        assert_is_none(replay.get_captured_content_type(request))
+
+        capture = replay.get_capture(request, HttpResponse(status=204), 0.01)
+        assert_is_none(capture['body'])
+        assert_equal(capture['url_name'], 'owner_password')
+
+    @istest
+    def skips_requests_that_are_not_for_the_api(self):
+        request = RequestFactory().get('/not/an/api/path')
+        assert_is_none(replay.get_capture(request, HttpResponse(), 0.01))
@@ -205,6 +205,112 @@ class TestPlaceResource(TestCase):
         for place in models.Place.objects.all():
             assert_in(place.id, expected_result)
 
+    @istest
+    def submission_sets_are_patched_as_submissions_are_added_and_removed(self):
+        from ..resources import models, PlaceResource
+        from django.core.cache import cache
+        cache.clear()
+        self.populate()
+        place_cache = PlaceResource().model.cache
+        place_cache.get_submission_sets(self.ds.id)
+
+        ss1 = models.SubmissionSet.objects.get(submission_type='foo')
+        models.Submission.objects.create(parent=ss1, dataset_id=self.ds.id)
+        for submission in models.Submission.objects.filter(parent__submission_type='bar'):
+            submission.delete()
+
+        expected_result = {
+            123: [{'length': 4, 'url': '/api/v1/user/datasets/dataset/places/123/foo/', 'type': 'foo'}],
+        }
+        with mock.patch.object(place_cache, 'calculate_submission_sets') as calculate:
+            assert_equal(dict(place_cache.get_submission_sets(self.ds.id)), expected_result)
+            assert_equal(calculate.call_count, 0)
+
+        counts = dict(models.SubmissionSet.objects.values_list('submission_type', 'submission_count'))
+        assert_equal(counts, {'foo': 4, 'bar': 0})
+
+    @istest
+    def submission_sets_calculated_before_a_patch_are_not_cached(self):
+        from ..resources import models, PlaceResource
+        from django.core.cache import cache
+        cache.clear()
+        self.populate()
+        place_cache = PlaceResource().model.cache
+        calculate = place_cache.calculate_submission_sets
+        ss1 = models.SubmissionSet.objects.get(submission_type='foo')
+
+        # A submission is counted while the map is being calculated, when
+        # there is no map to patch yet.
+        def calculate_then_submit(dataset_id):
+            submission_sets = calculate(dataset_id)
+            models.Submission.objects.create(parent=ss1, dataset_id=self.ds.id)
+            return submission_sets
+
+        with mock.patch.object(place_cache, 'calculate_submission_sets',
+                               side_effect=calculate_then_submit):
+            stale = place_cache.get_submission_sets(self.ds.id)
+        assert_equal(stale[123][0]['length'], 3)
+
+        assert_equal(place_cache.get_submission_sets(self.ds.id)[123][0]['length'], 4)
+
+    @istest
+    def submission_sets_are_patched_with_each_cache_serializer(self):
+        from ..resources import models, PlaceResource
+        from ..cache_serializers import msgpack
+        from ..localcache import tiered_cache
+        from django.core.cache import cache
+        self.populate()
+        place_cache = PlaceResource().model.cache
+
+        serializers = ['sa_api.cache_serializers.PickleSerializer',
+                       'sa_api.cache_serializers.CompactSerializer']
+        if msgpack is not None:
+            serializers.append('sa_api.cache_serializers.MsgpackSerializer')
+
+        for serializer in serializers:
+            with mock.patch('django.conf.settings.API_CACHE_SERIALIZER', serializer):
+                cache.clear()
+                tiered_cache.invalidate_local(None)
+                place_cache.get_submission_sets(self.ds.id)
+
+                # The first submission on a place that has none.
+                place = models.Place.objects.create(location='POINT (1.0 2.0)', dataset=self.ds)
+                ss = models.SubmissionSet.objects.create(place=place, submission_type='foo')
+                models.Submission.objects.create(parent=ss, dataset=self.ds)
+
+                with mock.patch.object(place_cache, 'calculate_submission_sets') as calculate:
+                    submission_sets = place_cache.get_submission_sets(self.ds.id)
+                    assert_equal(calculate.call_count, 0)
+                assert_equal([s['length'] for s in submission_sets[place.id]], [1])
+
+    @istest
+    def dataset_aggregates_only_count_the_owners_datasets(self):
+        from ..resources import models, DataSetResource
+        from django.contrib.auth.models import User
+        from django.core.cache import cache
+        cache.clear()
+        self.populate()
+        other_owner = User.objects.create(username='other')
+        other_ds = models.DataSet.objects.create(owner=other_owner, slug='other')
+        place = models.Place.objects.create(location='POINT (1.0 2.0)', dataset=other_ds)
+        ss = models.SubmissionSet.objects.create(place=place, submission_type='foo')
+        models.Submission.objects.create(parent=ss, dataset=other_ds)
+
+        resource = DataSetResource()
+        assert_equal(resource.places(self.ds)['length'], 2)
+        assert_equal(resource.submissions(self.ds), [
+            {'length': 2, 'url': '/api/v1/user/datasets/dataset/bar/', 'type': 'bar'},
+            {'length': 3, 'url': '/api/v1/user/datasets/dataset/foo/', 'type': 'foo'},
+        ])
+        assert_equal(resource.model.cache.get_places_counts(self.ds.owner_id).keys(), [self.ds.id])
+
+        # Adding a place or a submission clears the owner's totals.
+        models.Place.objects.create(location='POINT (1.0 2.0)', dataset=self.ds)
+        ss1 = models.SubmissionSet.objects.get(place__dataset=self.ds, submission_type='foo')
+        models.Submission.objects.create(parent=ss1, dataset=self.ds)
+        assert_equal(resource.places(self.ds)['length'], 3)
+        assert_equal(resource.submissions(self.ds)[1]['length'], 4)
+
     @istest
     def test_location(self):
         from ..resources import PlaceResource
@@ -269,25 +375,19 @@ class TestDataSetResource(object):
     @istest
     def test_places(self):
         from ..resources import DataSetResource
-        from mock_django.managers import ManagerMock
-        from ..models import Place
-        place1 = mock.Mock()
-        place1.id = 123
-        place2 = mock.Mock()
-        place2.id = 456
-        place_mgr = ManagerMock(Place.objects, place1, place2)
-        place_mgr.values.annotate = mock.Mock(return_value=[{'dataset_id': 1,
-                                                             'length': 2}])
-
-        with mock.patch.object(Place, 'objects', place_mgr):
-            resource = DataSetResource()
-            dataset = mock.Mock()
-            dataset.owner.username = 'mock-user'
-            dataset.slug = 'mock-dataset'
-            dataset.id = 1
+        resource = DataSetResource()
+        dataset = mock.Mock()
+        dataset.owner.username = 'mock-user'
+        dataset.owner_id = 7
+        dataset.slug = 'mock-dataset'
+        dataset.id = 1
+
+        with mock.patch.object(resource.model.cache, 'get_places_counts') as get_places_counts:
+            get_places_counts.return_value = {1: 2}
             assert_equal(resource.places(dataset),
                          {'url': '/api/v1/mock-user/datasets/mock-dataset/places/',
                           'length': 2})
+            get_places_counts.assert_called_once_with(7)
 
 
 class TestActivityResource(object):
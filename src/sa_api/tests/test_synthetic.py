@@ -0,0 +1,40 @@
+from django.test import TestCase
+from nose.tools import istest, assert_equal, assert_greater, assert_in
+import json
+import random
+from .. import synthetic
+from ..models import DataSet, Place, SubmissionSet, Submission, Activity, DataSetSummary
+
+
+class TestPowerLawCounts (object):
+
+    @istest
+    def splits_the_total_unevenly(self):
+        counts = synthetic.get_power_law_counts(10000, 1000, 1.2, random.Random(1))
+        assert_equal(len(counts), 1000)
+        assert_equal(sum(counts), 10000)
+        # Most of the parts get less than their even share.
+        assert_greater(len([count for count in counts if count < 10]), 500)
+
+
+class TestDataSetGenerator (TestCase):
+
+    @istest
+    def generates_a_consistent_dataset(self):
+        generator = synthetic.DataSetGenerator(places=50, submissions=400, batch_size=30, seed=1)
+        dataset = generator.generate('synthetic', 'synthetic')
+
+        assert_equal(Place.objects.filter(dataset=dataset).count(), 50)
+        assert_equal(Submission.objects.filter(dataset=dataset).count(), 400)
+        for submission_set in SubmissionSet.objects.filter(place__dataset=dataset):
+            assert_equal(submission_set.submission_count, submission_set.children.count())
+        assert_greater(Activity.objects.filter(data__dataset=dataset).count(), 450)
+
+        place = Place.objects.filter(dataset=dataset)[0]
+        assert_in('name', json.loads(place.data))
+
+        summary = DataSetSummary.objects.get(dataset=dataset)
+        assert_equal(summary.place_count, 50)
+        assert_equal(sum(summary.get_submission_counts().values()), 400)
+
+        assert_equal(DataSet.objects.get(pk=dataset.pk).api_keys.count(), 1)
@@ -142,3 +142,26 @@ class TestCachedProperty (object):
         assert_equal(foo.parting, 'goodbye 101')
         assert_equal(foo.greeting, 'hello 1')
         assert_equal(foo.parting, 'goodbye 101')
+
+
+class TestContentEncoding (object):
+
+    @istest
+    def compressed_content_decompresses_to_the_original(self):
+        content = 'hello world ' * 100
+        compressed = utils.compress(content)
+        assert_true(len(compressed) < len(content))
+        assert_equal(utils.decompress(compressed), content)
+
+    @istest
+    def accepted_encoding_respects_quality(self):
+        from django.test.client import RequestFactory
+
+        def accepted(header):
+            request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=header)
+            return utils.get_accepted_encoding(request, encodings=('gzip',))
+
+        assert_equal(accepted('gzip, deflate'), 'gzip')
+        assert_equal(accepted('deflate;q=1.0, *;q=0.5'), 'gzip')
+        assert_equal(accepted('gzip;q=0, deflate'), None)
+        assert_equal(accepted(''), None)
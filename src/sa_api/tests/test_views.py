@@ -9,7 +9,7 @@ from mock import patch
 from nose.tools import (istest, assert_equal, assert_not_equal, assert_in,
                         assert_raises, assert_is_not_none, assert_not_in, ok_)
 from ..models import DataSet, Place, Submission, SubmissionSet, Attachment
-from ..models import SubmittedThing, Activity
+from ..models import SubmittedThing, Activity, DataSetSummary
 from ..views import SubmissionCollectionView
 from ..views import raise_error_if_not_authenticated
 from ..views import ApiKeyCollectionView
@@ -208,6 +208,43 @@ class TestDataSetCollectionView(TestCase):
         assert_equal(response_data['slug'], 'test-dataset')
 
 
+    @istest
+    def post_of_a_submission_updates_the_cached_counts(self):
+        from ..views import DataSetCollectionView
+
+        user = User.objects.create(username='bob')
+        dataset = DataSet.objects.create(owner=user, slug='dataset', display_name='dataset')
+        place = Place.objects.create(dataset=dataset, location='POINT(0 0)')
+        comments = SubmissionSet.objects.create(place=place, submission_type='comments')
+        Submission.objects.create(dataset=dataset, parent=comments)
+
+        kwargs = {'owner__username': user.username}
+        url = reverse('dataset_collection_by_user', kwargs=kwargs)
+
+        def get_counts():
+            request = RequestFactory().get(url)
+            request.user = user
+            request.META['HTTP_ACCEPT'] = 'application/json'
+            response = DataSetCollectionView.as_view()(request, **kwargs)
+            data = json.loads(response.content)[0]
+            return ([s['length'] for s in data['submissions']],
+                    data['summary']['submissions'])
+
+        assert_equal(get_counts(), ([1], {'comments': 1}))
+
+        comments_url = reverse('submission_collection_by_dataset',
+                               args=['bob', 'dataset', place.id, 'comments'])
+        request = RequestFactory().post(comments_url, data=json.dumps({'comment': 'hi'}),
+                                        content_type='application/json')
+        request.user = mock.Mock(**{'is_authenticated.return_value': True})
+        response = SubmissionCollectionView.as_view()(
+            request, place_id=place.id, submission_type='comments',
+            dataset__owner__username='bob', dataset__slug='dataset')
+        assert_equal(response.status_code, 201)
+
+        assert_equal(get_counts(), ([2], {'comments': 2}))
+
+
 class TestDataSetInstanceView(TestCase):
 
     def setUp(self):
@@ -251,6 +288,67 @@ class TestDataSetInstanceView(TestCase):
         assert_equal(response.status_code, 403)
 
 
+class TestDataSetSummaryView(TestCase):
+
+    def setUp(self):
+        DataSet.objects.all().delete()
+        User.objects.all().delete()
+        DataSetSummary.objects.all().delete()
+        user = User.objects.create(username='bob')
+        self.dataset = DataSet.objects.create(slug='dataset',
+                                              display_name='dataset',
+                                              owner=user)
+        self.place = Place.objects.create(dataset=self.dataset, location='POINT(2 3)',
+                                          data=json.dumps({'name': 'a', 'private-email': 'a@b.c'}))
+        self.comments = SubmissionSet.objects.create(place=self.place, submission_type='comments')
+        Submission.objects.create(dataset=self.dataset, parent=self.comments,
+                                  data=json.dumps({'comment': 'hi'}))
+
+    def get_summary(self):
+        from ..views import DataSetSummaryView
+        kwargs = dict(owner__username='bob', slug='dataset')
+        request = RequestFactory().get(reverse('dataset_summary_by_user', kwargs=kwargs))
+        request.user = mock.Mock(**{'is_authenticated.return_value': False})
+        response = DataSetSummaryView.as_view()(request, **kwargs)
+        assert_equal(response.status_code, 200)
+        return json.loads(response.content)
+
+    @istest
+    def summarizes_the_dataset(self):
+        summary = self.get_summary()
+        assert_equal(summary['places'], {'length': 1})
+        assert_equal(summary['submissions'], {'comments': 1})
+        assert_equal(summary['bbox'], [2, 3, 2, 3])
+        assert_equal(summary['attributes'], ['comment', 'name'])
+        assert_is_not_none(summary['last_modified'])
+
+    @istest
+    def updates_the_summary_as_things_are_written(self):
+        place = Place.objects.create(dataset=self.dataset, location='POINT(-1 5)',
+                                     data=json.dumps({'color': 'red'}))
+        votes = SubmissionSet.objects.create(place=place, submission_type='votes')
+        Submission.objects.create(dataset=self.dataset, parent=votes)
+        self.comments.children.get().delete()
+
+        with patch.object(DataSetSummary, 'calculate') as calculate:
+            summary = self.get_summary()
+            assert_equal(calculate.call_count, 0)
+
+        assert_equal(summary['places'], {'length': 2})
+        assert_equal(summary['submissions'], {'votes': 1})
+        assert_equal(summary['bbox'], [-1, 3, 2, 5])
+        assert_equal(summary['attributes'], ['color', 'comment', 'name'])
+
+    @istest
+    def does_not_hide_a_submission_type_named_summary(self):
+        from django.core.urlresolvers import resolve
+        url = reverse('all_submissions_by_dataset', args=['bob', 'dataset', 'summary'])
+        assert_equal(resolve(url).url_name, 'all_submissions_by_dataset')
+
+        url = reverse('dataset_summary_by_user', args=['bob', 'dataset'])
+        assert_equal(resolve(url).url_name, 'dataset_summary_by_user')
+
+
 class TestMakingAGetRequestToASubmissionTypeCollectionUrl (TestCase):
 
     @istest
@@ -418,6 +516,56 @@ class TestSubmissionInstanceAPI (TestCase):
         assert_equal(response.status_code, 200)
         self.assertDictContainsSubset(data, response_data)
 
+    @istest
+    def put_request_with_if_match_should_only_modify_unchanged_instance(self):
+        kwargs = dict(place_id=self.place.id,
+                      pk=self.submission.id,
+                      submission_type='comments',
+                      dataset__owner__username=self.owner.username,
+                      dataset__slug=self.dataset.slug)
+
+        request = RequestFactory().get(self.url)
+        request.user = self.owner
+        request.META['HTTP_ACCEPT'] = 'application/json'
+        etag = self.view(request, **kwargs)['ETag']
+
+        def put(data, etag):
+            request = RequestFactory().put(self.url, data=json.dumps(data),
+                                           content_type='application/json',
+                                           HTTP_ACCEPT='application/json',
+                                           HTTP_IF_MATCH=etag)
+            request.user = self.owner
+            return self.view(request, **kwargs)
+
+        # The first update is made against the latest version...
+        response = put({'comment': 'first'}, etag)
+        assert_equal(response.status_code, 200)
+
+        # ...so the same ETag is stale for the second.
+        response = put({'comment': 'second'}, etag)
+        assert_equal(response.status_code, 412)
+        assert_equal(json.loads(Submission.objects.get(id=self.submission.id).data)['comment'], 'first')
+
+    @istest
+    def get_request_returns_not_modified_when_not_modified_since(self):
+        kwargs = dict(place_id=self.place.id,
+                      pk=self.submission.id,
+                      submission_type='comments',
+                      dataset__owner__username=self.owner.username,
+                      dataset__slug=self.dataset.slug)
+
+        def get(**headers):
+            request = RequestFactory().get(self.url, HTTP_ACCEPT='application/json', **headers)
+            request.user = self.owner
+            return self.view(request, **kwargs)
+
+        last_modified = get()['Last-Modified']
+        response = get(HTTP_IF_MODIFIED_SINCE=last_modified)
+        assert_equal(response.status_code, 304)
+
+        response = get(HTTP_IF_MODIFIED_SINCE='Sat, 01 Jan 2000 00:00:00 GMT')
+        assert_equal(response.status_code, 200)
+
     @istest
     def delete_request_should_delete_submission(self):
         request = RequestFactory().delete(self.url)
@@ -791,6 +939,274 @@ class TestActivityView(TestCase):
 
         self.assertNotEqual(response1.content, response2.content)
 
+    @istest
+    def returns_not_modified_for_a_matching_etag(self):
+        from ..views import ActivityView
+        view = ActivityView.as_view()
+        kwargs = dict(data__dataset__owner__username='myuser', data__dataset__slug='data')
+
+        def get(**headers):
+            request = RequestFactory().get(self.url, HTTP_ACCEPT='application/json', **headers)
+            request.user = self.owner
+            return view(request, **kwargs)
+
+        response = get()
+        etag = response['ETag']
+
+        response = get(HTTP_IF_NONE_MATCH=etag)
+        assert_equal(response.status_code, 304)
+        assert_equal(response.content, '')
+        assert_equal(response['ETag'], etag)
+
+        response = get(HTTP_IF_NONE_MATCH='"something-else"')
+        assert_equal(response.status_code, 200)
+
+        # After a change, the old ETag no longer matches.
+        self.visible_place.save()
+        response = get(HTTP_IF_NONE_MATCH=etag)
+        assert_equal(response.status_code, 200)
+        assert_not_equal(response['ETag'], etag)
+
+    @istest
+    def serves_stale_response_while_another_worker_rebuilds(self):
+        from ..views import ActivityView
+        view = ActivityView.as_view()
+        kwargs = dict(data__dataset__owner__username='myuser', data__dataset__slug='data')
+
+        def get():
+            request = RequestFactory().get(self.url, HTTP_ACCEPT='application/json')
+            request.user = self.owner
+            return view(request, **kwargs)
+
+        original = get()
+
+        # Pretend that another worker has started rebuilding the response
+        # after a change.
+        self.visible_place.save()
+        lock_key = ':'.join([self.url, 'json', '']) + ':lock'
+        cache.add(lock_key, True)
+
+        with self.assertNumQueries(0):
+            stale = get()
+        assert_equal(stale.content, original.content)
+        assert_in('Warning', stale)
+
+        # Without a recent enough stale response, give up waiting and rebuild.
+        with self.settings(API_CACHE_MAX_STALENESS=0, API_CACHE_LOCK_WAIT=0):
+            rebuilt = get()
+        assert_not_equal(rebuilt.content, original.content)
+        assert_not_in('Warning', rebuilt)
+
+    @istest
+    def serves_compressed_response_from_cache_when_accepted(self):
+        from ..views import ActivityView
+        import gzip
+        from StringIO import StringIO
+        view = ActivityView.as_view()
+        kwargs = dict(data__dataset__owner__username='myuser', data__dataset__slug='data')
+
+        def get(**headers):
+            request = RequestFactory().get(self.url, HTTP_ACCEPT='application/json', **headers)
+            request.user = self.owner
+            return view(request, **kwargs)
+
+        with self.settings(API_CACHE_COMPRESS_MIN_SIZE=0):
+            plain = get()
+            compressed = get(HTTP_ACCEPT_ENCODING='gzip, deflate')
+            uncompressed = get()
+
+        assert_equal(compressed['Content-Encoding'], 'gzip')
+        assert_in('Accept-Encoding', compressed['Vary'])
+        assert_not_equal(compressed['ETag'], plain['ETag'])
+        assert_equal(gzip.GzipFile(fileobj=StringIO(compressed.content)).read(), plain.content)
+
+        # Clients that don't accept gzip get the body decompressed.
+        assert_not_in('Content-Encoding', uncompressed)
+        assert_equal(uncompressed.content, plain.content)
+        assert_in('http://testserver/api/', uncompressed.content)
+
+    @istest
+    def serves_cached_response_with_urls_for_each_host(self):
+        from ..views import ActivityView
+        request1 = RequestFactory().get(self.url, HTTP_HOST='one.example.com')
+        request2 = RequestFactory().get(self.url, HTTP_HOST='two.example.com')
+        for request in (request1, request2):
+            request.user = self.owner
+            request.META['HTTP_ACCEPT'] = 'application/json'
+
+        view = ActivityView.as_view()
+        response1 = view(request1, data__dataset__owner__username='myuser', data__dataset__slug='data')
+
+        # The second host should be served from the same cache entry...
+        with self.assertNumQueries(0):
+            response2 = view(request2, data__dataset__owner__username='myuser', data__dataset__slug='data')
+
+        # ...but with its own host name in the URLs.
+        assert_in('http://one.example.com/api/', response1.content)
+        assert_not_in('two.example.com', response1.content)
+        assert_in('http://two.example.com/api/', response2.content)
+        assert_not_in('one.example.com', response2.content)
+
+    @istest
+    def shares_cached_responses_with_the_deprecated_route(self):
+        from ..views import ActivityView
+        view = ActivityView.as_view()
+        kwargs = dict(data__dataset__owner__username='myuser', data__dataset__slug='data')
+        deprecated_url = reverse('activity_collection_by_dataset_1', kwargs=kwargs)
+
+        def get(url):
+            request = RequestFactory().get(url, HTTP_ACCEPT='application/json')
+            request.user = self.owner
+            return view(request, **kwargs)
+
+        original = get(self.url)
+        with self.assertNumQueries(0):
+            deprecated = get(deprecated_url)
+        assert_equal(deprecated.content, original.content)
+
+        # Invalidating the canonical route invalidates both.
+        self.visible_place.save()
+        assert_not_equal(get(deprecated_url)['ETag'], original['ETag'])
+
+    @istest
+    def renders_every_format_from_the_same_cached_data(self):
+        from ..views import ActivityView
+        from StringIO import StringIO
+        import csv
+        view = ActivityView.as_view()
+        kwargs = dict(data__dataset__owner__username='myuser', data__dataset__slug='data')
+
+        def get(querystring='', accept='application/json'):
+            request = RequestFactory().get(self.url, QUERY_STRING=querystring, HTTP_ACCEPT=accept)
+            request.user = self.owner
+            return view(request, **kwargs)
+
+        original = get('visible=all&limit=10')
+
+        with self.assertNumQueries(0):
+            # Parameter order, the cache buster, and browsers' Accept
+            # headers don't make for new cache entries...
+            reordered = get('limit=10&_=1234&visible=all',
+                            accept='application/json, text/javascript, */*; q=0.01')
+            # ...and JSONP and CSV are made from the cached data.
+            jsonp = get('visible=all&limit=10&format=json-p&callback=cb')
+            table = get('visible=all&limit=10&format=csv')
+            table_content = ''.join(table)
+
+        assert_equal(reordered.content, original.content)
+        assert_equal(jsonp.content, 'cb(%s);' % original.content)
+        assert_equal(jsonp['Content-Type'], 'application/json-p')
+        assert_not_equal(jsonp['ETag'], original['ETag'])
+        assert_equal(table['Content-Type'], 'text/csv')
+        rows = list(csv.reader(StringIO(table_content)))
+        assert_equal(len(rows), len(json.loads(original.content)) + 1)
+
+    @istest
+    def serves_cached_response_from_the_host_cache(self):
+        from ..views import ActivityView
+        import shutil
+        import tempfile
+        view = ActivityView.as_view()
+        kwargs = dict(data__dataset__owner__username='myuser', data__dataset__slug='data')
+        key = ':'.join([self.url, 'json', ''])
+
+        def get():
+            request = RequestFactory().get(self.url, HTTP_ACCEPT='application/json')
+            request.user = self.owner
+            return view(request, **kwargs)
+
+        directory = tempfile.mkdtemp()
+        try:
+            with self.settings(API_HOST_CACHE_DIR=directory):
+                original = get()
+
+                # The body no longer has to come from the shared cache.
+                cache.delete(key + ':body')
+                with self.assertNumQueries(0):
+                    cached = get()
+                assert_equal(cached.content, original.content)
+                assert_equal(cached['ETag'], original['ETag'])
+
+                # But the shared cache still decides whether it is fresh.
+                self.visible_place.save()
+                rebuilt = get()
+                assert_not_equal(rebuilt['ETag'], original['ETag'])
+        finally:
+            shutil.rmtree(directory)
+
+    @istest
+    def warms_the_most_requested_invalidated_responses(self):
+        from ..views import ActivityView
+        from .. import warming
+        view = ActivityView.as_view()
+        kwargs = dict(data__dataset__owner__username='myuser', data__dataset__slug='data')
+        cache.clear()
+
+        def get(url):
+            request = RequestFactory().get(url, HTTP_ACCEPT='application/json')
+            request.user = self.owner
+            return view(request, **kwargs)
+
+        with self.settings(API_CACHE_WARM_COUNT=1):
+            get(self.url)
+            get(self.url)
+            get(self.url + '?visible=all')
+
+            with patch.object(warming, 'get_warmer') as get_warmer:
+                self.visible_place.save()
+
+        scheduled = [key for args, _ in get_warmer.return_value.schedule.call_args_list
+                     for key in args[0]]
+        hot_key = ':'.join([self.url, 'json', ''])
+        assert_equal(set(scheduled), set([hot_key]))
+
+        # Warming the key re-renders the response into the cache.
+        warming.warm_keys(scheduled)
+        with self.assertNumQueries(0):
+            response = get(self.url)
+        assert_equal(response.status_code, 200)
+
+    @istest
+    def warms_responses_without_a_deleted_instance(self):
+        from ..views import ActivityView
+        from .. import warming
+        view = ActivityView.as_view()
+        kwargs = dict(data__dataset__owner__username='myuser', data__dataset__slug='data')
+        cache.clear()
+
+        def get_ids():
+            request = RequestFactory().get(self.url, HTTP_ACCEPT='application/json')
+            request.user = self.owner
+            return [activity['id'] for activity in json.loads(view(request, **kwargs).content)]
+
+        deleted_activity = Activity.objects.get(data_id=self.visible_submission.id)
+        with self.settings(API_CACHE_WARM_COUNT=1):
+            assert_in(deleted_activity.id, get_ids())
+
+            # Warm the keys as soon as they are scheduled.
+            with patch.object(warming, 'get_warmer') as get_warmer:
+                get_warmer.return_value.schedule.side_effect = warming.warm_keys
+                self.visible_submission.delete()
+            assert_equal(get_warmer.return_value.schedule.call_count, 1)
+
+            with self.assertNumQueries(0):
+                assert_not_in(deleted_activity.id, get_ids())
+
+    @istest
+    def does_not_count_hits_when_warming_is_off(self):
+        from ..views import ActivityView
+        from .. import metrics
+        kwargs = dict(data__dataset__owner__username='myuser', data__dataset__slug='data')
+        request = RequestFactory().get(self.url, HTTP_ACCEPT='application/json')
+        request.user = self.owner
+
+        with self.settings(API_CACHE_WARM_COUNT=0):
+            with patch.object(metrics, 'count') as count:
+                ActivityView.as_view()(request, **kwargs)
+
+        counted = [args[0] for args, _ in count.call_args_list]
+        assert_equal([name for name in counted if name.startswith('hits:')], [])
+
 
 class TestAbsUrlMixin (object):
 
@@ -813,6 +1229,32 @@ class TestAbsUrlMixin (object):
         assert_equal(data['children'][1]['url'],
                      'http://testserver/dogs')
 
+    @istest
+    def test_process_urls_with_url_root(self):
+        data = [{'url': '/foo/bar'}, {'url': 'http://example.com/cats.jpg'}]
+        from ..views import AbsUrlMixin
+        aum = AbsUrlMixin()
+        aum.request = RequestFactory().get('/path_is_irrelevant')
+        aum.process_urls(data, 'ROOT')
+        assert_equal(data[0]['url'], 'ROOT/foo/bar')
+        assert_equal(data[1]['url'], 'http://example.com/cats.jpg')
+
+    @istest
+    def test_fill_url_root(self):
+        from django.http import HttpResponse
+        from ..views import AbsUrlMixin
+        from ..utils import URL_ROOT_PLACEHOLDER
+        aum = AbsUrlMixin()
+        aum.request = RequestFactory().get('/path_is_irrelevant')
+
+        response = HttpResponse('{"url": "%s/foo"}' % URL_ROOT_PLACEHOLDER)
+        aum.fill_url_root(response)
+        assert_equal(response.content, '{"url": "http://testserver/foo"}')
+
+        response = HttpResponse(iter(['url\r\n', '%s/foo\r\n' % URL_ROOT_PLACEHOLDER]))
+        aum.fill_url_root(response)
+        assert_equal(response.content, 'url\r\nhttp://testserver/foo\r\n')
+
 
 class TestPlaceCollectionView(TestCase):
 
@@ -1332,6 +1774,37 @@ class TestOwnerPasswordView(TestCase):
         assert_equal(response.status_code, 403)
 
 
+class TestMetricsView (TestCase):
+
+    def get_metrics(self, user, **headers):
+        from ..views import MetricsView
+        request = RequestFactory().get(reverse('metrics'), **headers)
+        request.user = user
+        return MetricsView.as_view()(request)
+
+    @istest
+    def is_only_readable_by_superusers(self):
+        user = mock.Mock(is_active=True, is_superuser=False)
+        response = self.get_metrics(user)
+        assert_equal(response.status_code, 403)
+
+        user.is_superuser = True
+        response = self.get_metrics(user)
+        assert_equal(response.status_code, 200)
+        assert_equal(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        assert_in('shareabouts_cache_hits_total', response.content)
+
+    @istest
+    def is_readable_with_the_metrics_token(self):
+        user = mock.Mock(**{'is_authenticated.return_value': False, 'is_active': False})
+        with patch('django.conf.settings.API_METRICS_TOKEN', 'abc', create=True):
+            response = self.get_metrics(user, HTTP_AUTHORIZATION='Bearer abc')
+            assert_equal(response.status_code, 200)
+
+            response = self.get_metrics(user, HTTP_AUTHORIZATION='Bearer xyz')
+            assert_equal(response.status_code, 403)
+
+
 class TestAttachmentView (TestCase):
     def setUp(self):
         User.objects.all().delete()
@@ -56,6 +56,17 @@ urlpatterns = patterns('sa_api',
         views.ActivityView.as_view(),
         name='activity_collection_by_dataset'),
 
+    url(r'^(?P<owner__username>[^/]+)/datasets/(?P<slug>[^/]+)/export/(?P<thing_type>[^/.]+)\.(?P<export_format>geojson|ndjson|csv)$',
+        views.DataSetExportView.as_view(),
+        name='dataset_export'),
+
+    # The summary has to come before the submission collections, or it would
+    # be taken for a submission type.  The underscore keeps it from hiding the
+    # collections of a submission type named "summary".
+    url(r'^(?P<owner__username>[^/]+)/datasets/(?P<slug>[^/]+)/_summary/$',
+        views.DataSetSummaryView.as_view(),
+        name='dataset_summary_by_user'),
+
     url(r'^(?P<dataset__owner__username>[^/]+)/datasets/(?P<dataset__slug>[^/]+)/(?P<submission_type>[^/]+)/$',
         views.AllSubmissionCollectionsView.as_view(),
         name='all_submissions_by_dataset'),
@@ -67,6 +78,10 @@ urlpatterns = patterns('sa_api',
     url(r'^(?P<owner__username>[^/]+)/password$',
         views.OwnerPasswordView.as_view(),
         name='owner_password'),
+
+    url(r'^metrics$',
+        views.MetricsView.as_view(),
+        name='metrics'),
 )
 
 places_base_regex = r'^datasets/(?P<dataset__owner__username>[^/]+)/(?P<dataset__slug>[^/]+)/places/'
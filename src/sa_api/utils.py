@@ -1,6 +1,13 @@
 import time
+import zlib
+from django.core.urlresolvers import resolve, reverse, Resolver404, NoReverseMatch
 from djangorestframework import status
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 def isiterable(obj):
     try:
@@ -58,6 +65,107 @@ def unpack_data_blob(data):
         data.update(data_blob)
 
 
+# Stands in for the scheme and host at the start of the URLs in a rendered
+# response until it is sent, so that the rendered response doesn't depend on
+# the host name that it was requested under.
+URL_ROOT_PLACEHOLDER = '__sa_api_url_root__'
+
+
+def get_url_root(request):
+    """
+    Get the scheme and host of the request, without a trailing slash.
+    """
+    return str(request.build_absolute_uri('/')[:-1])
+
+
+# The deprecated routes (with 'datasets/' before the owner's name) are named
+# like their canonical routes, with this suffix.
+DEPRECATED_URL_NAME_SUFFIX = '_1'
+
+
+def get_canonical_path(request):
+    """
+    Get the path of the canonical route for a request on a deprecated route,
+    or the request's own path if it is already canonical (or isn't on a
+    route at all).
+    """
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        return request.path
+
+    url_name = match.url_name or ''
+    if not url_name.endswith(DEPRECATED_URL_NAME_SUFFIX):
+        return request.path
+
+    canonical_name = url_name[:-len(DEPRECATED_URL_NAME_SUFFIX)]
+    try:
+        return reverse(canonical_name, args=match.args, kwargs=match.kwargs)
+    except NoReverseMatch:
+        return request.path
+
+
+# The content encodings that we can compress responses with, most preferred
+# first.  Brotli is only available if the brotli package is installed.
+CONTENT_ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def compress(content, encoding='gzip'):
+    if encoding == 'br':
+        return brotli.compress(content)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(content) + compressor.flush()
+
+
+def decompress(content, encoding='gzip'):
+    if encoding == 'br':
+        return brotli.decompress(content)
+    return zlib.decompress(content, 16 + zlib.MAX_WBITS)
+
+
+def get_accepted_encoding(request, encodings=CONTENT_ENCODINGS):
+    """
+    Get the first of the given content encodings that the request's
+    Accept-Encoding header allows, or None if it allows none of them.
+    """
+    accepted = {}
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+def prefix_urls(data, url_root):
+    """
+    Recursively prepend url_root to all the 'url' attributes in data that are
+    absolute paths (i.e., that start with a '/').  Operation is done in place.
+    """
+    if isinstance(data, list):
+        for val in data:
+            prefix_urls(val, url_root)
+
+    elif isinstance(data, dict):
+        url = data.get('url')
+        if isinstance(url, basestring) and url.startswith('/'):
+            data['url'] = url_root + url
+
+        for val in data.itervalues():
+            prefix_urls(val, url_root)
+
+    return data
+
+
 def cached_method(f):
     @wraps(f)
     def get(self, *args, **kwargs):
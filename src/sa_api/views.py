@@ -1,24 +1,44 @@
+from . import cache_serializers
+from . import export
 from . import forms
+from .hostcache import host_cache
+from . import instrumentation
+from . import metrics
 from . import models
 from . import parsers
+from . import prometheus
 from . import renderers
 from . import resources
 from . import utils
+from . import warming
 from django.conf import settings
 from django.contrib import auth
+from django.contrib.auth.models import AnonymousUser
 from django.contrib.gis import geos
 from django.core.cache import cache
-from django.http import HttpResponse
+from django.db.models.query import QuerySet
+from django.http import HttpResponse, HttpResponseNotModified
 from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_vary_headers
+from django.utils.crypto import constant_time_compare
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
 from django.views.decorators.csrf import csrf_exempt
 from djangorestframework import views, permissions, mixins, authentication, status
+from djangorestframework.renderers import JSONPRenderer
 from djangorestframework.response import Response, ErrorResponse
+from djangorestframework.utils.mediatypes import get_media_type_params
+from operator import itemgetter
 import apikey.auth
 import ujson as json
+import cPickle as pickle
+import calendar
+import datetime
+import hashlib
 import logging
 import os
-import re
 import time
+import urllib
+import urlparse
 
 logger = logging.getLogger('sa_api.views')
 
@@ -126,7 +146,8 @@ class AuthMixin(object):
         self.request = request  # Not sure what needs this.
 
         # This triggers authentication (view.user is a property).
-        user = self.user
+        with instrumentation.span('authenticate'):
+            user = self.user
 
         if self.allowed_user_kwarg:
             self.allowed_username = kwargs[self.allowed_user_kwarg]
@@ -136,6 +157,10 @@ class AuthMixin(object):
             logger.error("Subclass %s of AuthMixin is supposed to provide .allowed_user_kwarg or .allowed_username" % self)
             return permissions._403_FORBIDDEN_RESPONSE.response
 
+        # Superusers get to see how the time for the request was spent.
+        if getattr(user, 'is_superuser', False):
+            instrumentation.show_timing()
+
         if request.method not in ('GET', 'HEAD', 'OPTIONS'):
             try:
                 for perm in getattr(self, 'unsafe_permissions', []):
@@ -147,11 +172,36 @@ class AuthMixin(object):
                 return response
         return super(AuthMixin, self).dispatch(request, *args, **kwargs)
 
+    def _authenticate(self):
+        # Like the base AuthMixin, but time each authentication backend.
+        for authentication_cls in self.authentication:
+            authentication = authentication_cls(self)
+            with instrumentation.timed('auth', authentication_cls.__name__):
+                user = authentication.authenticate(self.request)
+            if user:
+                return user
+        return AnonymousUser()
+
 
 class CachedMixin (object):
-    @property
+    # How often (in seconds) to check whether another worker has finished
+    # rebuilding a response.
+    cache_lock_poll_interval = 0.1
+
+    # Query string parameters that don't change the data in a response.
+    # Those that choose the renderer are accounted for by the format in the
+    # cache key instead (see get_cache_format).
+    cache_ignored_params = ('_', 'callback', 'format', '_accept')
+
+    # Set to the callback for JSONP requests, which are served the cached
+    # JSON body, wrapped.
+    jsonp_callback = None
+
+    @utils.cached_property
     def cache_prefix(self):
-        return self.request.path
+        # Requests on the deprecated routes share the cache entries (and the
+        # invalidation) of their canonical routes.
+        return utils.get_canonical_path(self.request)
 
     def get_cache_prefix(self):
         return self.cache_prefix
@@ -166,47 +216,367 @@ class CachedMixin (object):
         if request.method.lower() != 'get':
             return super(CachedMixin, self).dispatch(request, *args, **kwargs)
 
+        # Renderer negotiation looks at the view's request and kwargs.
+        self.request, self.args, self.kwargs = request, args, kwargs
+        try:
+            key = self.get_cache_key(request, *args, **kwargs)
+        except ErrorResponse:
+            # Nothing can render the response for the request's Accept header,
+            # so let the view respond with the error.
+            metrics.count('cache_uncacheable')
+            return super(CachedMixin, self).dispatch(request, *args, **kwargs)
+        self.cache_data_key = self.get_cache_data_key(request)
+
         # Check whether the response data is in the cache.
-        key = self.get_cache_key(request, *args, **kwargs)
-        response_data = cache.get(key) or None
+        if not request.META.get(warming.WARMING_META_KEY):
+            warming.record_hit(key)
+        with instrumentation.span('cache_lookup'):
+            fresh, self.cached_body = self.get_cached_body(key)
+
+        if fresh:
+            metrics.count('cache_hits')
+            response = self.dispatch_from_cache(request, self.cached_body, *args, **kwargs)
+        else:
+            response = self.dispatch_and_cache(request, key, *args, **kwargs)
+
+        if self.jsonp_callback is not None:
+            response = self.wrap_jsonp(response, self.jsonp_callback)
+
+        if response.status_code == 200:
+            # Cached bodies may have been stored compressed, and may be sent
+            # compressed.
+            patch_vary_headers(response, ['Accept-Encoding'])
+            encoding = self.get_content_encoding(request, response)
+            if encoding is not None and response.has_header('ETag'):
+                # Each encoding of a response is a different set of bytes, so
+                # it gets its own strong ETag.
+                etag = parse_etags(response['ETag'])[0]
+                response['ETag'] = quote_etag('%s-%s' % (etag, encoding))
+
+            # Don't re-send a body that the client already has.
+            if self.is_not_modified(request, response):
+                response = self.respond_not_modified(response)
+            else:
+                response = self.encode_response(request, key, response, encoding)
+
+        # Disable client-side caching. Cause IE wrongly assumes that it should
+        # cache.  Clients still revalidate with the ETag or Last-Modified.
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    def get_cached_body(self, key):
+        """
+        Get the most recently cached body for the request's cache key, and
+        whether it is still fresh.
+
+        The body is kept under a key of its own that invalidation doesn't
+        touch, so that it can be served while the response is being rebuilt
+        (see dispatch_and_cache).  The request's cache key just holds the
+        generation of the body that it is fresh for.
+
+        If there is a host cache (see sa_api.hostcache), a fresh body is read
+        from there instead when it can be.
+        """
+        metakey = self.get_cache_metakey()
+        body_key = key + ':body'
+
+        if host_cache.enabled:
+            values = cache.get_many([key, metakey])
+            generation = values.get(key)
+            keyset = cache_serializers.loads(values.get(metakey), set())
+            if generation is not None and key in keyset:
+                stored = host_cache.get(key, generation)
+                if stored is not None:
+                    metrics.count('host_cache_hits')
+                    (cached_at, status, headers), content = stored
+                    return True, (generation, cached_at, content, status, headers)
+                metrics.count('host_cache_misses')
+            values[body_key] = cache.get(body_key)
+        else:
+            values = cache.get_many([key, body_key, metakey])
+        body = values.get(body_key)
 
         # Also check whether the request cache key is managed in the cache.
         # This is important, because if it's not managed, then we'll never
         # know when to invalidate it. If it's not managed we should just
         # assume that it's invalid.
-        metakey = self.get_cache_metakey()
-        keyset = cache.get(metakey) or set()
+        keyset = cache_serializers.loads(values.get(metakey), set())
+
+        fresh = (body is not None and key in keyset and
+                 values.get(key) == body[0])
+        if fresh and host_cache.enabled:
+            self.cache_body_on_host(key, body)
+        return fresh, body
+
+    def cache_body_on_host(self, key, body):
+        generation, cached_at, content, status, headers = body
+        host_cache.set(key, generation, (cached_at, status, headers), content)
+
+    def dispatch_from_cache(self, request, body, *args, **kwargs):
+        generation, cached_at, content, status, headers = body
+        cached_response = self.respond_from_cache((content, status, headers))
+        self.cache_generation = generation
 
-        if (response_data is not None) and (key in keyset):
-            cached_response = self.respond_from_cache(response_data)
+        # Patch the HTTP method
+        setattr(self, self.method.lower(),
+                lambda *args, **kwargs: cached_response)
 
-            # Patch the HTTP method
-            setattr(self, self.method.lower(),
-                    lambda *args, **kwargs: cached_response)
+        return super(CachedMixin, self).dispatch(request, *args, **kwargs)
+
+    def dispatch_and_cache(self, request, key, *args, **kwargs):
+        """
+        Build the response and cache it.  Only one worker at a time rebuilds
+        a given response.  While it does, other workers serve the previous
+        body, if it is recent enough (see API_CACHE_MAX_STALENESS), or else
+        wait for a while for the new one.
+        """
+        lock_key = key + ':lock'
+        if not cache.add(lock_key, True, settings.API_CACHE_LOCK_TIMEOUT):
+            stale_body = self.cached_body
+            if stale_body is not None and \
+                    time.time() - stale_body[1] <= settings.API_CACHE_MAX_STALENESS:
+                metrics.count('cache_stale_hits')
+                response = self.dispatch_from_cache(request, stale_body, *args, **kwargs)
+                if response.status_code == 200:
+                    response['Warning'] = '110 - "Response is Stale"'
+                return response
 
-            response = super(CachedMixin, self).dispatch(request, *args, **kwargs)
+            fresh_body = self.wait_for_rebuild(key, lock_key)
+            if fresh_body is not None:
+                metrics.count('cache_lock_waits')
+                return self.dispatch_from_cache(request, fresh_body, *args, **kwargs)
+
+            # The other worker is taking too long, so just rebuild the
+            # response here too.
+            metrics.count('cache_lock_timeouts')
+            lock_key = None
+
+        try:
+            # If the data for the response has been cached for another
+            # format, just render it in this one.
+            data = self.get_cached_data(self.cache_data_key)
+            if data is not None:
+                metrics.count('cache_data_hits')
+                response = self.dispatch_from_data(request, data, *args, **kwargs)
+            else:
+                metrics.count('cache_misses')
+                response = super(CachedMixin, self).dispatch(request, *args, **kwargs)
+        except:
+            self.release_cache_lock(lock_key)
+            raise
+
+        # Only cache on OK resposne
+        if response.status_code == 200:
+            with instrumentation.span('cache_store'):
+                if data is None:
+                    self.cache_data(self.cache_data_key)
+                self.cache_response(key, response, lock_key)
         else:
-            response = super(CachedMixin, self).dispatch(request, *args, **kwargs)
+            metrics.count('cache_uncacheable')
+            self.release_cache_lock(lock_key)
+        return response
 
-            # Only cache on OK resposne
-            if response.status_code == 200:
-                self.cache_response(key, response)
+    def dispatch_from_data(self, request, data, *args, **kwargs):
+        """
+        Render the (filtered) data for a response, as the view would have.
+        """
+        renderer, media_type = self._determine_renderer(request)
+        self.last_modified = self.get_last_modified(data)
+        with instrumentation.timed('render'):
+            rendered_response = HttpResponse(renderer.render(data, media_type),
+                                             mimetype=renderer.media_type)
 
-        # Disable client-side caching. Cause IE wrongly assumes that it should
-        # cache.
-        response['Cache-Control'] = 'no-cache'
+        # Patch the HTTP method
+        setattr(self, self.method.lower(),
+                lambda *args, **kwargs: rendered_response)
+
+        return super(CachedMixin, self).dispatch(request, *args, **kwargs)
+
+    def get_cached_data(self, data_key):
+        cached_data = cache.get(data_key)
+        if cached_data is None:
+            return None
+        return pickle.loads(utils.decompress(cached_data))
+
+    def cache_data(self, data_key):
+        """
+        Cache the data that the view just rendered, so that it can be
+        rendered in other formats without going back to the database.  The
+        data has already been filtered, so it is format-independent.
+        """
+        drf_response = getattr(self, 'response', None)
+        data = getattr(drf_response, 'cleaned_content', None)
+        if data is None:
+            return
+
+        cached_data = utils.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+        cache.set(data_key, cached_data, settings.API_CACHE_TIMEOUT)
+        self.add_managed_cache_key(data_key)
+
+    def _determine_renderer(self, request):
+        """
+        Render JSONP requests as plain JSON; the JSON is wrapped in the
+        callback once it has been cached (see wrap_jsonp).
+        """
+        renderer, media_type = super(CachedMixin, self)._determine_renderer(request)
+        if self.jsonp_callback is not None and isinstance(renderer, JSONPRenderer):
+            renderer = renderer._get_renderer()
+            media_type = renderer.media_type
+        return renderer, media_type
+
+    def wrap_jsonp(self, response, callback):
+        if not response.content:
+            return response
+
+        content = response.content
+        if response.get('Content-Encoding') == 'gzip':
+            del response['Content-Encoding']
+            content = utils.decompress(content)
+        response.content = '%s(%s);' % (callback, content)
+        response['Content-Type'] = JSONPRenderer.media_type
+
+        if response.has_header('ETag'):
+            etag = parse_etags(response['ETag'])[0]
+            callback_hash = hashlib.md5(callback).hexdigest()
+            response['ETag'] = quote_etag('%s-%s' % (etag, callback_hash))
         return response
 
+    def wait_for_rebuild(self, key, lock_key):
+        """
+        Wait for another worker to cache a fresh body for the key.  Gives up
+        (and returns None) after API_CACHE_LOCK_WAIT seconds, or as soon as
+        the other worker lets go of the lock without having cached anything.
+        """
+        deadline = time.time() + settings.API_CACHE_LOCK_WAIT
+        while time.time() < deadline:
+            time.sleep(self.cache_lock_poll_interval)
+            fresh, body = self.get_cached_body(key)
+            if fresh:
+                return body
+            if cache.get(lock_key) is None:
+                return None
+        return None
+
+    def release_cache_lock(self, lock_key):
+        if lock_key is not None:
+            cache.delete(lock_key)
+
+    def filter_response(self, obj):
+        filtered = super(CachedMixin, self).filter_response(obj)
+        self.last_modified = self.get_last_modified(filtered)
+        return filtered
+
+    def get_last_modified(self, data):
+        """
+        Get the time (in seconds since the epoch) of the latest update to the
+        things in the serialized data, or None if they have no timestamps.
+        """
+        items = data if isinstance(data, list) else [data]
+        timestamps = []
+        for item in items:
+            if isinstance(item, dict):
+                timestamp = item.get('updated_datetime') or item.get('created_datetime')
+                if isinstance(timestamp, datetime.datetime):
+                    timestamps.append(calendar.timegm(timestamp.utctimetuple()))
+        return max(timestamps) if timestamps else None
+
+    def get_validator_headers(self, content):
+        """
+        Get the ETag and Last-Modified headers for the given response content.
+        The ETag is a hash of the content, which is the same whatever host the
+        response is served under (see AbsUrlMixin).
+        """
+        etag = hashlib.md5(content).hexdigest()
+        last_modified = getattr(self, 'last_modified', None)
+
+        # The latest update time doesn't change when something is deleted
+        # from a collection, so check the validators of the previously cached
+        # body (which outlives invalidation), and never let Last-Modified stay
+        # put or go back in time when the content has changed.
+        previous_body = getattr(self, 'cached_body', None)
+        if previous_body is not None:
+            previous_headers = dict(previous_body[4])
+            previous_etag = previous_body[0]
+            previous_last_modified = parse_http_date_safe(previous_headers.get('Last-Modified', ''))
+            if etag == previous_etag:
+                last_modified = previous_last_modified
+            elif previous_last_modified is not None and \
+                    (last_modified is None or last_modified <= previous_last_modified):
+                last_modified = time.time()
+
+        headers = [('ETag', quote_etag(etag))]
+        if last_modified is not None:
+            headers.append(('Last-Modified', http_date(last_modified)))
+        return headers
+
+    def is_not_modified(self, request, response):
+        """
+        Check the request's If-None-Match or If-Modified-Since headers against
+        the response.  If-Modified-Since is ignored when If-None-Match is
+        given.
+        """
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            if not response.has_header('ETag'):
+                return False
+            etags = parse_etags(if_none_match)
+            return '*' in etags or parse_etags(response['ETag'])[0] in etags
+
+        if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since is not None:
+            if_modified_since = parse_http_date_safe(if_modified_since)
+            if if_modified_since is None or not response.has_header('Last-Modified'):
+                return False
+            last_modified = parse_http_date_safe(response['Last-Modified'])
+            return last_modified is not None and last_modified <= if_modified_since
+
+        return False
+
+    def respond_not_modified(self, response):
+        not_modified = HttpResponseNotModified()
+        for header in ('ETag', 'Last-Modified', 'Vary'):
+            if response.has_header(header):
+                not_modified[header] = response[header]
+        return not_modified
+
     def get_cache_key(self, request, *args, **kwargs):
-        querystring = request.META['QUERY_STRING']
-        contenttype = request.META['HTTP_ACCEPT']
+        return ':'.join([self.cache_prefix,
+                         self.get_cache_format(request),
+                         self.get_canonical_querystring(request)])
 
-        # TODO: Eliminate the jQuery cache busting parameter for now. Get
-        # rid of this after the old API has been deprecated.
-        cache_buster_pattern = re.compile(r'&?_=\d+')
-        querystring = re.sub(cache_buster_pattern, '', querystring)
+    def get_cache_data_key(self, request):
+        return ':'.join([self.cache_prefix, 'data',
+                         self.get_canonical_querystring(request)])
 
-        return ':'.join([self.cache_prefix, contenttype, querystring])
+    def get_cache_format(self, request):
+        """
+        Get the format of the renderer negotiated for the request, instead
+        of using the raw Accept header, which differs between browsers.
+        Media type parameters that change the rendering (e.g., indent) are
+        included.  JSONP requests use the JSON body.
+        """
+        renderer, media_type = self._determine_renderer(request)
+        if isinstance(renderer, JSONPRenderer):
+            self.jsonp_callback = renderer._get_callback().encode('utf-8')
+            renderer = renderer._get_renderer()
+
+        params = get_media_type_params(media_type)
+        params.pop('q', None)
+        if params:
+            return '%s;%s' % (renderer.format, urllib.urlencode(sorted(params.items())))
+        return renderer.format
+
+    def get_canonical_querystring(self, request):
+        """
+        Get the request's query string with the parameters sorted, and
+        without the ones that don't change the response data (like jQuery's
+        cache buster).  Values for the same parameter stay in order.
+        """
+        params = urlparse.parse_qsl(request.META.get('QUERY_STRING', ''),
+                                    keep_blank_values=True)
+        params = [(name, value) for name, value in params
+                  if name not in self.cache_ignored_params]
+        return urllib.urlencode(sorted(params, key=itemgetter(0)))
 
     def respond_from_cache(self, cached_data):
         # Given some cached data, construct a response.
@@ -218,48 +588,246 @@ class CachedMixin (object):
 
         return response
 
-    def cache_response(self, key, response):
-        content = response.content
+    def cache_response(self, key, response, lock_key=None):
         status = response.status_code
         headers = response.items()
 
-        # Cache enough info to recreate the response.
-        cache.set(key, (content, status, headers), settings.API_CACHE_TIMEOUT)
-
-        # Also, add the key to the set of pages cached from this view.
+        # A streamed response (e.g., CSV) can only be read once, so cache its
+        # content as it is sent instead of reading it all up front.  Its
+        # validators can't be known until then either, so they are only sent
+        # with the responses that come from the cache.
+        if response._base_content_is_iter:
+            response.content = self.iter_and_cache_content(key, response._container, status, headers, lock_key)
+        else:
+            content = response.content
+            validator_headers = self.get_validator_headers(content)
+            for header, value in validator_headers:
+                response[header] = value
+            self.cache_content(key, content, status, headers + validator_headers)
+            self.release_cache_lock(lock_key)
+
+    def iter_and_cache_content(self, key, chunks, status, headers, lock_key=None):
+        try:
+            content = []
+            for chunk in chunks:
+                content.append(chunk)
+                yield chunk
+
+            # Only cache once the whole response has been sent.
+            content = ''.join(content)
+            headers = headers + self.get_validator_headers(content)
+            self.cache_content(key, content, status, headers)
+        finally:
+            self.release_cache_lock(lock_key)
+
+    def cache_content(self, key, content, status, headers):
+        generation = parse_etags(dict(headers)['ETag'])[0]
+
+        # Store large bodies compressed, both to save memory in the cache and
+        # so that they can be served compressed (see encode_response).
+        if len(content) >= settings.API_CACHE_COMPRESS_MIN_SIZE:
+            compressed = utils.compress(content)
+            metrics.count('cache_entries_compressed')
+            metrics.count('cache_bytes_saved', len(content) - len(compressed))
+            content = compressed
+            headers = headers + [('Content-Encoding', 'gzip')]
+
+        # Cache enough info to recreate the response, and mark it as fresh.
+        body = (generation, time.time(), content, status, headers)
+        cache.set_many({key: generation, key + ':body': body}, settings.API_CACHE_TIMEOUT)
+        self.add_managed_cache_key(key)
+        if host_cache.enabled:
+            self.cache_body_on_host(key, body)
+
+    def add_managed_cache_key(self, key):
+        # Add the key to the set of pages cached from this view.
         meta_key = self.cache_prefix + '_keys'
-        keys = cache.get(meta_key) or set()
+        keys = cache_serializers.loads(cache.get(meta_key), set())
         keys.add(key)
-        cache.set(meta_key, keys, settings.API_CACHE_TIMEOUT)
+        cache.set(meta_key, cache_serializers.dumps(keys), settings.API_CACHE_TIMEOUT)
+
+    def get_content_encoding(self, request, response):
+        """
+        Get the encoding that a response whose body was cached compressed
+        will be sent in, or None if it will be sent uncompressed.
+        """
+        if response.get('Content-Encoding') != 'gzip':
+            return None
+        return utils.get_accepted_encoding(request)
+
+    def encode_response(self, request, key, response, encoding):
+        """
+        Given a response whose body was cached compressed, send it in the
+        given encoding, or decompress it if the encoding is None.
+
+        The cached body still has the placeholder for the URL root in it (see
+        AbsUrlMixin), so the encoded body for each generation of the body and
+        URL root is cached too, alongside the response.
+        """
+        if response.get('Content-Encoding') != 'gzip':
+            return response
+
+        content = response.content
+        if encoding is None:
+            del response['Content-Encoding']
+            response.content = utils.decompress(content)
+            return response
+
+        url_root = utils.get_url_root(request)
+        encoded_key = ':'.join([key, encoding, self.cache_generation, url_root])
+        encoded_data = self.get_encoded_data(encoded_key)
+
+        if encoded_data is None:
+            body = utils.decompress(content).replace(utils.URL_ROOT_PLACEHOLDER, url_root)
+            encoded_data = (utils.compress(body, encoding), len(body))
+            cache.set(encoded_key, encoded_data, settings.API_CACHE_TIMEOUT)
+            self.add_managed_cache_key(encoded_key)
+            if host_cache.enabled:
+                host_cache.set(encoded_key, self.cache_generation, encoded_data[1], encoded_data[0])
+
+        encoded_content, length = encoded_data
+        metrics.count('responses_compressed')
+        metrics.count('response_bytes_saved', length - len(encoded_content))
+
+        response.content = encoded_content
+        response['Content-Encoding'] = encoding
+        return response
+
+    def get_encoded_data(self, encoded_key):
+        """
+        Get the (encoded content, decoded length) cached for the encoded key.
+        The key is specific to a generation of the body, so anything cached
+        for it is fresh.
+        """
+        if host_cache.enabled:
+            stored = host_cache.get(encoded_key, self.cache_generation)
+            if stored is not None:
+                metrics.count('host_cache_hits')
+                length, encoded_content = stored
+                return encoded_content, length
+
+        encoded_data = cache.get(encoded_key)
+        if encoded_data is not None and host_cache.enabled:
+            metrics.count('host_cache_misses')
+            host_cache.set(encoded_key, self.cache_generation, encoded_data[1], encoded_data[0])
+        return encoded_data
 
 
 class AbsUrlMixin (object):
+    """
+    Makes the 'url' attributes in a response absolute.  URLs that are
+    absolute paths are given a placeholder for the scheme and host, which is
+    only filled in on the rendered response, so that the same rendered (and
+    cached) response can be served under any host name.
+    """
+    def dispatch(self, request, *args, **kwargs):
+        response = super(AbsUrlMixin, self).dispatch(request, *args, **kwargs)
+        self.fill_url_root(response)
+        return response
+
+    def get_url_root(self):
+        return utils.get_url_root(self.request)
+
+    def fill_url_root(self, response):
+        placeholder = utils.URL_ROOT_PLACEHOLDER
+        url_root = self.get_url_root()
+
+        if response.has_header('Content-Encoding'):
+            # Encoded responses already have the URL root filled in (see
+            # CachedMixin.encode_response).
+            return
+        elif response._base_content_is_iter:
+            # Streamed content (e.g., CSV) is written in whole rows, so a
+            # placeholder is never split across chunks.
+            response.content = (chunk.replace(placeholder, url_root)
+                                for chunk in response._container)
+        elif placeholder in response.content:
+            response.content = response.content.replace(placeholder, url_root)
+
     def filter_response(self, obj):
         """
         Given the response content, filter it into a serializable object.
         """
-        filtered = super(AbsUrlMixin, self).filter_response(obj)
-        return self.process_urls(filtered)
-
-    def process_urls(self, data):
+        if isinstance(obj, QuerySet):
+            with instrumentation.span('queryset'):
+                obj = list(obj)
+        with instrumentation.timed('serialize'):
+            filtered = super(AbsUrlMixin, self).filter_response(obj)
+        with instrumentation.timed('urls'):
+            return self.process_urls(filtered, utils.URL_ROOT_PLACEHOLDER)
+
+    def render(self, response):
+        with instrumentation.timed('render'):
+            return super(AbsUrlMixin, self).render(response)
+
+    def process_urls(self, data, url_root=None):
         """
-        Recursively replace all 'url' attributes with absolute URIs.  Operation
-        is done in place.
+        Recursively replace all 'url' attributes with absolute URIs.  Absolute
+        paths are prefixed with url_root (the scheme and host of the request,
+        by default).  Operation is done in place.
         """
+        if url_root is None:
+            url_root = self.get_url_root()
+
         if isinstance(data, list):
             for val in data:
-                self.process_urls(val)
+                self.process_urls(val, url_root)
 
         elif isinstance(data, dict):
-            if data.get('url') is not None:
-                data['url'] = self.request.build_absolute_uri(data['url'])
+            url = data.get('url')
+            if isinstance(url, basestring):
+                if url.startswith('/') and not url.startswith('//'):
+                    data['url'] = url_root + url
+                else:
+                    data['url'] = self.request.build_absolute_uri(url)
 
             for val in data.itervalues():
-                self.process_urls(val)
+                self.process_urls(val, url_root)
 
         return data
 
 
+class IfMatchMixin (object):
+    """
+    Honors the If-Match header on PUT, so that a client can make sure that
+    the thing it is updating hasn't changed since the client last got it.
+    The ETag of the thing is that of its current representation, as a GET
+    with the same Accept header would return it.
+    """
+    def put(self, request, *args, **kwargs):
+        if_match = request.META.get('HTTP_IF_MATCH')
+        if if_match is not None:
+            etags = parse_etags(if_match)
+            if '*' not in etags and not self.etag_matches(etags, request, *args, **kwargs):
+                raise ErrorResponse(
+                    status.HTTP_412_PRECONDITION_FAILED,
+                    {'detail': 'The resource has changed since the given ETag was issued.'})
+
+        return super(IfMatchMixin, self).put(request, *args, **kwargs)
+
+    def etag_matches(self, etags, request, *args, **kwargs):
+        # The client may have gotten the ETag with a compressed response (see
+        # CachedMixin.encode_response).
+        etag = self.get_current_etag(request, *args, **kwargs)
+        current_etags = [etag] + ['%s-%s' % (etag, encoding)
+                                  for encoding in utils.CONTENT_ENCODINGS]
+        return any(current_etag in etags for current_etag in current_etags)
+
+    def get_current_etag(self, request, *args, **kwargs):
+        try:
+            instance = self.get(request, *args, **kwargs)
+        except ErrorResponse as e:
+            if e.response.status == status.HTTP_404_NOT_FOUND:
+                raise ErrorResponse(
+                    status.HTTP_412_PRECONDITION_FAILED,
+                    {'detail': 'The resource does not exist.'})
+            raise
+
+        renderer, media_type = self._determine_renderer(request)
+        content = HttpResponse(renderer.render(self.filter_response(instance), media_type)).content
+        return hashlib.md5(content).hexdigest()
+
+
 class Ignore_CacheBusterMixin (object):
     @csrf_exempt
     def dispatch(self, request, *args, **kwargs):
@@ -398,7 +966,7 @@ class PlaceCollectionView (Ignore_CacheBusterMixin, AuthMixin, AbsUrlMixin, Acti
         return response
 
 
-class PlaceInstanceView (Ignore_CacheBusterMixin, AuthMixin, AbsUrlMixin, ActivityGeneratingMixin, ModelViewWithDataBlobMixin, CachedMixin, views.InstanceModelView):
+class PlaceInstanceView (Ignore_CacheBusterMixin, AuthMixin, AbsUrlMixin, ActivityGeneratingMixin, ModelViewWithDataBlobMixin, CachedMixin, IfMatchMixin, views.InstanceModelView):
 
     allowed_user_kwarg = 'dataset__owner__username'
 
@@ -510,7 +1078,7 @@ class SubmissionCollectionView (Ignore_CacheBusterMixin, AuthMixin, AbsUrlMixin,
         return super(SubmissionCollectionView, self).get_instance_data(model, content,)
 
 
-class SubmissionInstanceView (Ignore_CacheBusterMixin, AuthMixin, AbsUrlMixin, ActivityGeneratingMixin, ModelViewWithDataBlobMixin, CachedMixin, views.InstanceModelView):
+class SubmissionInstanceView (Ignore_CacheBusterMixin, AuthMixin, AbsUrlMixin, ActivityGeneratingMixin, ModelViewWithDataBlobMixin, CachedMixin, IfMatchMixin, views.InstanceModelView):
     resource = resources.SubmissionResource
 
     allowed_user_kwarg = 'dataset__owner__username'
@@ -634,6 +1202,123 @@ class TabularAllSubmissionCollectionsView (AllSubmissionCollectionsView):
     resource = resources.TabularSubmissionResource
 
 
+class DataSetExportView (Ignore_CacheBusterMixin, AuthMixin, views.View):
+    """
+    Stream all of the places or submissions in a dataset as GeoJSON,
+    newline-delimited JSON, or CSV.  The response is compressed on the fly
+    if the client accepts gzip encoding.
+
+    Query String Parameters
+    -----------------------
+    - `after` -- Only export things with ids greater than the given id.  Use
+                 the id of the last thing received to resume an interrupted
+                 export.
+    - `visible` -- Set to `all` to export both visible and invisible things.
+    - `show_private` -- Include private data (only for the dataset owner).
+
+    Examples
+    --------
+    Get all the places in a dataset as GeoJSON:
+
+        /<owner>/datasets/<slug>/export/places.geojson
+
+    Get all the comments in a dataset as CSV, after comment 1234:
+
+        /<owner>/datasets/<slug>/export/comments.csv?after=1234
+    """
+    allowed_user_kwarg = 'owner__username'
+    permissions = (CanShowPrivateData,)
+    show_private_data = False
+
+    def get(self, request, owner__username, slug, thing_type, export_format):
+        dataset = get_object_or_404(models.DataSet.objects.select_related('owner'),
+                                    owner__username=owner__username, slug=slug)
+
+        after = request.GET.get('after') or None
+        if after is not None:
+            try:
+                after = int(after)
+            except ValueError:
+                raise ErrorResponse(
+                    status.HTTP_400_BAD_REQUEST,
+                    {'detail': 'The after parameter should be the id of a place or submission.'})
+
+        content = export.export_things(
+            dataset, thing_type, export_format,
+            after=after,
+            include_invisible=(request.GET.get('visible') == 'all'),
+            include_private=self.show_private_data,
+            url_root=request.build_absolute_uri('/')[:-1])
+
+        # Exports are only streamed with gzip.
+        gzipped = utils.get_accepted_encoding(request, ('gzip',)) == 'gzip'
+        if gzipped:
+            content = export.gzip_stream(content)
+
+        response = HttpResponse(content, content_type=export.MEDIA_TYPES[export_format])
+        response['Content-Disposition'] = 'attachment; filename=%s.%s' % (thing_type, export_format)
+        response['Vary'] = 'Accept-Encoding'
+        if gzipped:
+            response['Content-Encoding'] = 'gzip'
+        return response
+
+
+class DataSetSummaryView (Ignore_CacheBusterMixin, AuthMixin, views.View):
+    """
+    Get the totals and bounds of a dataset: how many places and submissions
+    of each type it has, the extent of its places (as `[min lng, min lat,
+    max lng, max lat]`), the attributes used in it, and when it was last
+    changed.  The summary is kept up to date as the dataset is written (see
+    models.DataSetSummary), so the dataset's places aren't read.
+
+    Query String Parameters
+    -----------------------
+    - `show_private` -- Include private attributes (only for the dataset
+                        owner).
+    """
+    allowed_user_kwarg = 'owner__username'
+    permissions = (CanShowPrivateData,)
+    show_private_data = False
+
+    def get(self, request, owner__username, slug):
+        try:
+            summary = models.DataSetSummary.objects.get(
+                dataset__owner__username=owner__username, dataset__slug=slug)
+        except models.DataSetSummary.DoesNotExist:
+            dataset = get_object_or_404(models.DataSet, owner__username=owner__username, slug=slug)
+            summary, _ = models.DataSetSummary.get_for_dataset(dataset.id)
+
+        return summary.document(include_private=self.show_private_data)
+
+
+class MetricsView (views.View):
+    """
+    Get the API's metrics in the Prometheus text format: request counts and
+    time histograms per view, response cache hit, miss and uncacheable
+    counts, invalidations per model, and authentication backend timings (see
+    sa_api.prometheus).
+
+    Only superusers can read the metrics, or a scraper that sends the
+    API_METRICS_TOKEN setting as a bearer token in the Authorization header.
+    """
+    authentication = [BasicAuthentication,
+                      UserLoggedInAuthentication]
+
+    def get(self, request):
+        if not self.is_authorized(request):
+            raise permissions._403_FORBIDDEN_RESPONSE
+        # Include this process's latest counts.
+        metrics.counts.flush_counts()
+        return HttpResponse(prometheus.render(), content_type=prometheus.CONTENT_TYPE)
+
+    def is_authorized(self, request):
+        token = settings.API_METRICS_TOKEN
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if token and constant_time_compare(authorization, 'Bearer ' + token):
+            return True
+        return getattr(self.user, 'is_superuser', False)
+
+
 class AttachmentView (Ignore_CacheBusterMixin, AuthMixin, views.ListOrCreateModelView):
     resource = resources.AttachmentResource
     allowed_user_kwarg = 'dataset__owner__username'
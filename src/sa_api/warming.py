@@ -0,0 +1,163 @@
+"""
+Re-rendering of hot cached API responses after they are invalidated.
+
+While warming is on (API_CACHE_WARM_COUNT is above 0), every GET request for
+a cached view counts a hit against its cache key (see CachedMixin).  When an instance changes and the keys for its responses are
+cleared, the most requested of them are re-rendered by a background thread,
+so that the next clients to ask for them don't have to wait for a rebuild.
+Responses are re-rendered through the same views that normally serve them,
+with a request rebuilt from the cache key.
+"""
+import Queue
+import threading
+import urllib
+import urlparse
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.urlresolvers import resolve, Resolver404
+from django.db import connection
+from django.test.client import RequestFactory
+from . import metrics
+
+import logging
+logger = logging.getLogger('sa_api.warming')
+
+
+HIT_COUNTER_PREFIX = 'hits:'
+
+# Set on the requests that the warmer makes, so that they don't count as
+# hits themselves.
+WARMING_META_KEY = 'sa_api.cache_warming'
+
+
+def record_hit(key):
+    """
+    Count a request for the cache key.  Hits are only counted while warming
+    is on, and are added up in-process (see metrics.count).
+    """
+    if settings.API_CACHE_WARM_COUNT:
+        metrics.count(HIT_COUNTER_PREFIX + key)
+
+
+def get_hot_keys(keys, count=None):
+    """
+    Get the (at most count) most requested of the given cache keys, most
+    requested first.  Keys that have never been requested are left out.
+    """
+    if count is None:
+        count = settings.API_CACHE_WARM_COUNT
+
+    keys = list(keys)
+    hits = metrics.get_many([HIT_COUNTER_PREFIX + key for key in keys])
+    counted = [(hits[HIT_COUNTER_PREFIX + key], key) for key in keys]
+    counted = sorted([(n, key) for n, key in counted if n > 0], reverse=True)
+    return [key for n, key in counted[:count]]
+
+
+def make_request(key):
+    """
+    Rebuild an anonymous GET request from a cache key (see
+    CachedMixin.get_cache_key).  The key's format is asked for with the
+    format parameter, and any media type parameters in the Accept header.
+    """
+    path, format, querystring = key.split(':', 2)
+    format, _, params = format.partition(';')
+
+    querystring = '&'.join(filter(None, [querystring, urllib.urlencode({'format': format})]))
+    accept = '; '.join(['*/*'] + ['%s=%s' % param for param in urlparse.parse_qsl(params)])
+    request = RequestFactory().get(path, HTTP_ACCEPT=accept,
+                                   QUERY_STRING=querystring)
+    request.META[WARMING_META_KEY] = True
+    request.user = AnonymousUser()
+    return request
+
+
+def warm_key(key):
+    """
+    Render the response for the cache key through its view, which caches it.
+    Return the response's status code, or None if the key isn't for a view.
+    """
+    try:
+        path = key.split(':', 1)[0]
+        view, args, kwargs = resolve(path)
+    except (ValueError, Resolver404):
+        logger.debug('Not warming "%s"; it is not a request key.' % key)
+        return None
+
+    response = view(make_request(key), *args, **kwargs)
+
+    # Read the whole response, so that a streamed one gets cached too.
+    for chunk in response:
+        pass
+    return response.status_code
+
+
+def warm_keys(keys):
+    for key in keys:
+        try:
+            status = warm_key(key)
+            logger.debug('Warmed "%s" (%s)' % (key, status))
+        except Exception:
+            logger.exception('Failed to warm "%s"' % key)
+        else:
+            if status is not None:
+                metrics.count('cache_keys_warmed')
+
+
+class CacheWarmer (threading.Thread):
+    """
+    A daemon thread that warms the batches of keys that are put on its queue.
+    Keys that are already waiting to be warmed aren't queued again.
+    """
+    def __init__(self):
+        super(CacheWarmer, self).__init__(name='sa_api-cache-warmer')
+        self.daemon = True
+        self.queue = Queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def schedule(self, keys):
+        with self.lock:
+            keys = [key for key in keys if key not in self.pending]
+            self.pending.update(keys)
+        if keys:
+            self.queue.put(keys)
+
+    def run(self):
+        while True:
+            keys = self.queue.get()
+            with self.lock:
+                self.pending.difference_update(keys)
+            try:
+                warm_keys(keys)
+            finally:
+                # Don't hold on to a database connection between batches.
+                connection.close()
+
+
+_warmer = None
+_warmer_lock = threading.Lock()
+
+
+def get_warmer():
+    global _warmer
+    with _warmer_lock:
+        if _warmer is None or not _warmer.is_alive():
+            _warmer = CacheWarmer()
+            _warmer.start()
+    return _warmer
+
+
+def schedule_invalidated(keys):
+    """
+    Warm the hottest of the given (just invalidated) keys in the background.
+    Does nothing when API_CACHE_WARM_COUNT is 0.
+    """
+    if not settings.API_CACHE_WARM_COUNT:
+        return
+
+    # Include this process's latest hits.
+    metrics.counts.flush_counts()
+    hot_keys = get_hot_keys(keys)
+    if hot_keys:
+        get_warmer().schedule(hot_keys)
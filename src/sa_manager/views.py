@@ -26,6 +26,8 @@ class ShareaboutsApi (object):
         'submission_instance': r'{username}/datasets/{dataset_slug}/places/{place_pk}/{type}/{pk}/?show_private=true',
         'all_submissions': r'{username}/datasets/{dataset_slug}/{type}/?show_private=true',
         'all_submissions_table': r'{username}/datasets/{dataset_slug}/{type}/table?show_private=true',
+        'place_export': r'{username}/datasets/{dataset_slug}/export/places.{format}?visible=all&show_private=true',
+        'submission_export': r'{username}/datasets/{dataset_slug}/export/{type}.{format}?show_private=true',
     }
 
     def __init__(self, request=None, root='/api/v1/'):
@@ -46,7 +48,7 @@ class ShareaboutsApi (object):
         self.csrf_token = request.META.get('CSRF_COOKIE', '')
         self.cookies = request.META.get('HTTP_COOKIE', '')
 
-    def send(self, method, url, data=None, content_type='application/json'):
+    def send(self, method, url, data=None, content_type='application/json', stream=False):
         if data is not None and content_type == 'application/json':
             data = json.dumps(data)
 
@@ -64,7 +66,7 @@ class ShareaboutsApi (object):
         if method == 'DELETE':
             headers.update({'Content-Length': '0'})
 
-        response = requests.request(method, url, data=data, headers=headers)
+        response = requests.request(method, url, data=data, headers=headers, stream=stream)
         return response
 
     def get(self, url, default=None):
@@ -732,13 +734,19 @@ class ExistingSubmissionView (SubmissionMixin, View):
             pass
 
 
+# How many bytes of an export to pass along to the client at a time.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
 def download_places_view(request, dataset_slug):
     api = ShareaboutsApi(request)
     api.authenticate(request)
-    places_uri = api.build_uri('place_collection_table', username=request.user.username, dataset_slug=dataset_slug)
+    places_uri = api.build_uri('place_export', username=request.user.username, dataset_slug=dataset_slug, format='csv')
 
-    api_response = api.send('GET', places_uri, content_type='text/csv')
-    places_csv = api_response.text
+    # Pass the export along as it arrives, instead of reading it all into
+    # memory first.
+    api_response = api.send('GET', places_uri, content_type='text/csv', stream=True)
+    places_csv = api_response.iter_content(DOWNLOAD_CHUNK_SIZE)
 
     response = HttpResponse(places_csv, content_type='text/csv')
     response['Content-disposition'] = 'attachment; filename=places.csv'
@@ -748,10 +756,10 @@ def download_places_view(request, dataset_slug):
 def download_submissions_view(request, dataset_slug, submission_type):
     api = ShareaboutsApi(request)
     api.authenticate(request)
-    submissions_uri = api.build_uri('all_submissions_table', username=request.user.username, dataset_slug=dataset_slug, type=submission_type)
+    submissions_uri = api.build_uri('submission_export', username=request.user.username, dataset_slug=dataset_slug, type=submission_type, format='csv')
 
-    api_response = api.send('GET', submissions_uri, content_type='text/csv')
-    submissions_csv = api_response.text
+    api_response = api.send('GET', submissions_uri, content_type='text/csv', stream=True)
+    submissions_csv = api_response.iter_content(DOWNLOAD_CHUNK_SIZE)
 
     response = HttpResponse(submissions_csv, content_type='text/csv')
     response['Content-disposition'] = 'attachment; filename=' + submission_type + '.csv'